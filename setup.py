@@ -19,7 +19,12 @@ setup_args = {
     "download_url": "https://pypi.org/project/bdast/",
     "entry_points": {"console_scripts": ["bdast = bdast:main"]},
     "package_dir": {"": "src"},
-    "install_requires": ["requests>=2.32.3", "PyYAML>=6.0.1", "obslib>=0.7.1"],
+    "install_requires": [
+        "requests>=2.32.3",
+        "PyYAML>=6.0.1",
+        "obslib>=0.7.1",
+        "Jinja2>=3.1.4",
+    ],
 }
 
 if __name__ == "__main__":
@@ -1,11 +1,17 @@
 """ """
 
+import concurrent.futures
 import logging
+import mimetypes
 import os
 import re
 import shlex
 import subprocess
 import sys
+import time
+import urllib.parse
+from collections import ChainMap
+from collections.abc import Mapping
 from string import Template
 from enum import Enum
 
@@ -16,6 +22,10 @@ from .exception import SpecRunException
 
 logger = logging.getLogger(__name__)
 
+# Delay (in seconds) before the first retry of a failed asset upload. The delay
+# doubles for each retry
+UPLOAD_RETRY_BACKOFF = 1
+
 
 class StepState(Enum):
     NOT_STARTED = 0
@@ -31,6 +41,10 @@ class CommonState:
         self.spec = spec
         self.step_state = {}
 
+        # Parsed env_files content, keyed by path. Each entry holds the file
+        # modification time and content
+        self.env_file_cache = {}
+
     def get_step_state(self, step_name):
         if step_name not in self.step_state:
             self.step_state[step_name] = StepState.NOT_STARTED
@@ -52,16 +66,17 @@ class ScopeState:
     def __init__(self, *, parent=None):
         self.parent = parent
 
-        # Copy parent vars, if specified
+        # Layer over the parent vars, if specified
         if self.parent is not None:
-            # Create a new env scope, independent of the parents env vars
-            self.envs = self.parent.envs.copy()
+            # Create a new env scope on top of the parents env vars. Changes in
+            # this scope are held in its own layer and don't affect the parent
+            self.envs = self.parent.envs.new_child()
             self.common = self.parent.common
 
             return
 
         # Create a new env state and common state
-        self.envs = os.environ.copy()
+        self.envs = ChainMap(os.environ.copy())
         self.common = CommonState()
 
     def merge_envs(self, new_envs, all_scopes=False):
@@ -71,13 +86,18 @@ class ScopeState:
                 "Invalid type passed to merge_envs. Must be a dictionary"
             )
 
-        # Merge new_envs dictionary in to the current envs
-        for key in new_envs.keys():
-            self.envs[key] = str(new_envs[key])
+        new_envs = {key: str(new_envs[key]) for key in new_envs}
+
+        # Merge new_envs dictionary in to the current envs and, if all_scopes is
+        # required, the envs for each parent scope
+        scope = self
+        while scope is not None:
+            scope.envs.maps[0].update(new_envs)
 
-        # Call merge for parent, if all_scopes required
-        if all_scopes and self.parent is not None:
-            self.parent.merge_envs(new_envs, all_scopes=True)
+            if not all_scopes:
+                break
+
+            scope = scope.parent
 
 
 def template_if_string(val, mapping):
@@ -167,27 +187,49 @@ def merge_spec_envs(spec, state, all_scopes=False):
         if file == "":
             raise SpecRunException("Empty file name specified in env_files")
 
-        with open(file, "r", encoding="utf-8") as file:
-            content = yaml.safe_load(file)
-
-        if not isinstance(content, dict):
-            raise SpecRunException(f"Yaml read from file ({file}) is not a dictionary")
-
         # Merge vars in to existing envs dictionary
-        for key in content.keys():
-            envs[key] = str(content[key])
+        envs.update(load_env_file(file, state.common))
 
     state.merge_envs(envs, all_scopes=all_scopes)
     logger.debug("envs: %s", envs)
 
 
+def load_env_file(file, common):
+    if not isinstance(file, str) or file == "":
+        raise SpecRunException("Invalid file name passed to load_env_file")
+
+    if not isinstance(common, CommonState):
+        raise SpecRunException("Invalid CommonState passed to load_env_file")
+
+    # Use the parsed content from the cache, unless the file has been modified
+    # since it was parsed
+    path = os.path.abspath(file)
+    mtime = os.stat(path).st_mtime_ns
+
+    cached = common.env_file_cache.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    logger.debug("Parsing env file: %s", path)
+    with open(path, "r", encoding="utf-8") as handle:
+        content = yaml.safe_load(handle)
+
+    if not isinstance(content, dict):
+        raise SpecRunException(f"Yaml read from file ({file}) is not a dictionary")
+
+    content = {key: str(content[key]) for key in content}
+    common.env_file_cache[path] = (mtime, content)
+
+    return content
+
+
 def spec_extract_value(spec, key, *, template_map, failemptystr=False, default=None):
     # Check that we have a valid spec
     if spec is None or not isinstance(spec, dict):
         raise SpecRunException("spec is missing or is not a dictionary")
 
     # Check type for template_map
-    if template_map is not None and not isinstance(template_map, dict):
+    if template_map is not None and not isinstance(template_map, Mapping):
         raise SpecRunException("Invalid type passed as template_map")
 
     # Handle a missing key in the spec
@@ -261,8 +303,46 @@ def process_spec_step_github_release(step, state):
     )
     logger.debug("api_version: %s", api_version)
 
+    api_url = str(
+        spec_extract_value(
+            step,
+            "api_url",
+            default="https://api.github.com",
+            failemptystr=True,
+            template_map=state.envs,
+        )
+    )
+    logger.debug("api_url: %s", api_url)
+
+    assets = validate_str_list(
+        spec_extract_value(step, "assets", default=[], template_map=state.envs),
+        allow_empty_str=False,
+    )
+    logger.debug("assets: %s", assets)
+
+    upload_parallel = int(
+        spec_extract_value(step, "upload_parallel", default=4, template_map=state.envs)
+    )
+    logger.debug("upload_parallel: %s", upload_parallel)
+
+    upload_retries = int(
+        spec_extract_value(step, "upload_retries", default=3, template_map=state.envs)
+    )
+    logger.debug("upload_retries: %s", upload_retries)
+
+    if upload_parallel < 1:
+        raise SpecRunException("upload_parallel must be at least 1")
+
+    if upload_retries < 0:
+        raise SpecRunException("upload_retries must not be negative")
+
+    # Check the assets exist before creating the release
+    for asset in assets:
+        if not os.path.isfile(asset):
+            raise SpecRunException(f"Release asset is not a file: {asset}")
+
     # Construct URL for post
-    url = f"https://api.github.com/repos/{owner}/{repo}/releases"
+    url = f"{api_url.rstrip('/')}/repos/{owner}/{repo}/releases"
     logger.info("Repo URL: %s", url)
 
     # Headers for post
@@ -287,6 +367,188 @@ def process_spec_step_github_release(step, state):
     logger.debug("Response code: %s", response.status_code)
     logger.debug("Response text: %s", response.text)
 
+    if len(assets) > 0:
+        # The upload url is a URI template, with the query holding the asset name
+        # and label (e.g. '.../assets{?name,label}')
+        upload_url = response.json().get("upload_url")
+        assert_not_emptystr(upload_url, "No upload_url in github release response")
+        upload_url = re.sub("{[^}]*}$", "", upload_url)
+
+        upload_release_assets(
+            upload_url,
+            assets,
+            assets_url=response.json().get("assets_url"),
+            token=token,
+            api_version=api_version,
+            parallel=upload_parallel,
+            retries=upload_retries,
+        )
+
+
+def upload_release_assets(
+    upload_url, assets, *, assets_url, token, api_version, parallel, retries
+):
+    # Headers common to each upload
+    headers = {
+        "Accept": "application/vnd.github.v3+json",
+        "Authorization": f"token {token}",
+        "X-GitHub-Api-Version": api_version,
+    }
+
+    # Connections are shared between the uploads, with one per concurrent upload
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=parallel)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    with session:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+            futures = {
+                asset: executor.submit(
+                    upload_release_asset,
+                    session,
+                    upload_url,
+                    assets_url,
+                    asset,
+                    headers,
+                    retries,
+                )
+                for asset in assets
+            }
+
+            # Report all failed uploads before failing the step
+            failures = 0
+            for asset, future in futures.items():
+                try:
+                    future.result()
+                except (requests.exceptions.RequestException, OSError) as e:
+                    failures += 1
+                    log_raw(f"Failed to upload asset {asset}: {e}")
+
+    if failures > 0:
+        raise SpecRunException(f"{failures} of {len(assets)} asset uploads failed")
+
+
+def is_existing_asset_response(response):
+    # Github responds with 422 and an 'already_exists' error for an asset name that
+    # is already in use
+    if response.status_code != 422:
+        return False
+
+    try:
+        errors = response.json().get("errors", [])
+    except (ValueError, AttributeError):
+        return False
+
+    return any(
+        isinstance(x, dict) and x.get("code") == "already_exists" for x in errors
+    )
+
+
+def find_release_asset(session, assets_url, name, headers):
+    # Search the pages of release assets for the asset with this name
+    page = 1
+    while True:
+        response = session.get(
+            assets_url,
+            timeout=(10, 30),
+            headers=headers,
+            params={"per_page": 100, "page": page},
+        )
+        response.raise_for_status()
+
+        release_assets = response.json()
+        for release_asset in release_assets:
+            if release_asset.get("name") == name:
+                return release_asset
+
+        if len(release_assets) < 100:
+            return None
+
+        page += 1
+
+
+def upload_release_asset(session, upload_url, assets_url, asset, headers, retries):
+    name = os.path.basename(asset)
+    size = os.path.getsize(asset)
+
+    # Compressed files (e.g. .tar.gz) are uploaded as binary content, rather
+    # than the type of the uncompressed content
+    content_type, encoding = mimetypes.guess_type(name)
+    if content_type is None or encoding is not None:
+        content_type = "application/octet-stream"
+
+    upload_headers = {
+        **headers,
+        "Content-Type": content_type,
+        "Content-Length": str(size),
+    }
+
+    url = f"{upload_url}?{urllib.parse.urlencode({'name': name})}"
+    logger.debug("Upload url: %s", url)
+
+    attempt = 0
+    while True:
+        start = time.monotonic()
+
+        # The file object is passed as the body, so the content is streamed from
+        # disk, rather than read in to memory
+        try:
+            with open(asset, "rb") as file:
+                response = session.post(
+                    url, timeout=(10, 300), headers=upload_headers, data=file
+                )
+
+            existing = None
+            if (
+                attempt > 0
+                and assets_url is not None
+                and is_existing_asset_response(response)
+            ):
+                # The server may have completed an earlier attempt that failed here
+                existing = find_release_asset(session, assets_url, name, headers)
+
+            if existing is not None:
+                if existing.get("state") == "uploaded" and existing.get("size") == size:
+                    logger.info("Asset %s was uploaded by an earlier attempt", name)
+                    break
+
+                # Remove the incomplete asset, so the upload can be retried
+                session.delete(
+                    existing["url"], timeout=(10, 30), headers=headers
+                ).raise_for_status()
+                error = "incomplete asset left by an earlier attempt"
+            elif response.status_code < 500 and response.status_code != 429:
+                # Only retry server errors and rate limiting
+                response.raise_for_status()
+                break
+            else:
+                error = f"status code {response.status_code}"
+        except requests.exceptions.ConnectionError as e:
+            error = str(e)
+        except requests.exceptions.Timeout as e:
+            error = str(e)
+
+        if attempt >= retries:
+            raise requests.exceptions.RetryError(
+                f"Giving up after {attempt + 1} attempts: {error}"
+            )
+
+        delay = UPLOAD_RETRY_BACKOFF * (2**attempt)
+        attempt += 1
+        logger.warning(
+            "Upload of %s failed after %.2fs (%s). Retry %s of %s in %ss",
+            name,
+            time.monotonic() - start,
+            error,
+            attempt,
+            retries,
+            delay,
+        )
+        time.sleep(delay)
+
+    log_raw(f"Uploaded asset {name} ({size} bytes) in {time.monotonic() - start:.2f}s")
+
 
 def process_spec_step_semver(step, state):
     # Capture step properties
@@ -407,7 +669,7 @@ def process_spec_step_command(step, state):
 
     # Arguments to subprocess.run
     subprocess_args = {
-        "env": state.envs.copy(),
+        "env": dict(state.envs),
         "stdout": None,
         "stderr": subprocess.STDOUT,
         "shell": step_shell,
@@ -463,59 +725,75 @@ def process_spec_step_command(step, state):
 
 
 def process_spec_step(step_name, step, state):
+    # Dependencies are processed using an explicit stack of steps waiting on their
+    # dependencies, rather than recursion, so long dependency chains don't reach
+    # the recursion limit.
+    # All steps, including dependencies, use 'state' as their parent scope
+    stack = [begin_spec_step(step_name, step, state)]
+
+    while len(stack) > 0:
+        frame = stack[-1]
+
+        # Find the next dependency for this step that hasn't been completed
+        # Anything that is already pending is an error as it is already on the
+        # stack and means there is a circular dependency
+        dep_name = None
+        for item in frame["depends_on"]:
+            dep_state = state.common.get_step_state(item)
+
+            if dep_state == StepState.COMPLETED:
+                continue
+
+            if dep_state == StepState.PENDING:
+                raise SpecRunException(
+                    f"Circular reference in step dependencies - Step {item} already visited, but not completed"
+                )
+
+            # Step has not been started, so we'll start processing of this step
+            if item not in state.common.spec["steps"]:
+                raise SpecRunException(f"Reference to step that does not exist: {item}")
+
+            dep_name = item
+            break
+
+        if dep_name is not None:
+            dep_ref = state.common.spec["steps"][dep_name]
+            stack.append(begin_spec_step(dep_name, dep_ref, state))
+            continue
+
+        # All dependencies have completed, so run the step
+        stack.pop()
+        run_spec_step(frame["name"], frame["step"], state)
+
+
+def begin_spec_step(step_name, step, state):
     # Validate action type
     assert_type(step, dict, "Step is not a dictionary")
 
     # Create a new scope state
-    parent_state = state
-    state = ScopeState(parent=parent_state)
+    scope = ScopeState(parent=state)
 
     # Merge environment variables in early
-    merge_spec_envs(step, state)
-
-    #
-    # Handle dependencies
-    #
+    merge_spec_envs(step, scope)
 
     # Record this step as having been seen
-    state.common.touch_step(step_name)
+    scope.common.touch_step(step_name)
 
     # Capture dependencies for this step
     step_depends_on = validate_str_list(
-        spec_extract_value(step, "depends_on", template_map=state.envs, default=[]),
+        spec_extract_value(step, "depends_on", template_map=scope.envs, default=[]),
         allow_empty_str=False,
     )
 
-    # Process dependencies
-    # Call step processing for any steps that haven't been completed
-    # Anything that is already pending is an error as there is already a function call handling this and means
-    # there is a circular dependency
-    for dep_name in step_depends_on:
-        dep_state = state.common.get_step_state(dep_name)
+    # Return the step with an iterator over the dependencies still to check
+    return {"name": step_name, "step": step, "depends_on": iter(step_depends_on)}
 
-        if dep_state == StepState.COMPLETED:
-            continue
 
-        if dep_state == StepState.PENDING:
-            raise SpecRunException(
-                f"Circular reference in step dependencies - Step {dep_name} already visited, but not completed"
-            )
-
-        # Step has not been started, so we'll start processing of this step
-        if dep_name not in state.common.spec["steps"]:
-            raise SpecRunException(f"Reference to step that does not exist: {dep_name}")
-
-        dep_ref = state.common.spec["steps"][dep_name]
-        process_spec_step(dep_name, dep_ref, parent_state)
-
-    # Dependencies may have captured a var, so merge parent vars in to a new scope state
-    state = ScopeState(parent=parent_state)
+def run_spec_step(step_name, step, state):
+    # Dependencies may have captured a var, so merge step vars in to a new scope state
+    state = ScopeState(parent=state)
     merge_spec_envs(step, state)
 
-    #
-    # End dependency handling
-    #
-
     log_raw("")
     log_raw(f"**************** STEP {step_name}")
 
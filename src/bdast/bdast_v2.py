@@ -1,18 +1,44 @@
 """ """
 
+import base64
+import codecs
+import collections.abc
+import concurrent.futures
+import email.message
+import email.utils
+import importlib
+import io
+import itertools
+import json
 import logging
 import os
+import random
 import re
+import secrets
 import shlex
 import subprocess
 import sys
 import copy
 import glob
-
+import hashlib
+import http.cookiejar
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+import urllib.parse
+import zlib
+
+import jinja2
 import requests
+import urllib3
 import yaml
 import obslib
 
+from jinja2.meta import find_undeclared_variables
+
 from .exception import BdastArgumentException
 from .exception import BdastLoadException
 from .exception import BdastRunException
@@ -21,6 +47,28 @@ logger = logging.getLogger(__name__)
 
 EVAL_IGNORE_VARS = ["bdast", "env"]
 
+# Jinja2 environment for obslib sessions, matching the obslib default. References
+# between vars are parsed with the same environment used to render them
+JINJA_ENVIRONMENT = jinja2.Environment(
+    undefined=jinja2.StrictUndefined, keep_trailing_newline=True
+)
+
+# Default number of connections kept open to each host by url steps
+DEFAULT_HTTP_POOL_SIZE = 10
+
+# Response codes retried by url steps, by default, when retries are enabled
+DEFAULT_RETRY_ON = [429, 500, 502, 503, 504]
+
+# Default limit on the time (in seconds) a url step spends retrying a request
+DEFAULT_RETRY_BUDGET = 60
+
+# Methods that can be repeated without further effect on the server, so are
+# retried after a read timeout
+IDEMPOTENT_METHODS = ["GET", "HEAD", "OPTIONS", "TRACE", "PUT", "DELETE"]
+
+# Captured values larger than this (in bytes) are stored on disk, rather than in memory
+DEFAULT_SPILL_THRESHOLD = 1024 * 1024
+
 
 def val_arg(val, message):
     if not val:
@@ -37,8 +85,29 @@ def val_run(val, message):
         raise BdastRunException(message)
 
 
+# Output from steps running concurrently is held in a per-thread buffer and
+# written in one piece when the step finishes
+OUTPUT_BUFFER = threading.local()
+OUTPUT_LOCK = threading.Lock()
+
+
 def log_raw(msg):
-    print(msg, flush=True)
+    write_raw(f"{msg}\n")
+
+
+def write_raw(msg):
+
+    parts = getattr(OUTPUT_BUFFER, "parts", None)
+    if parts is not None:
+        parts.append(msg)
+        return
+
+    sys.stdout.write(msg)
+    sys.stdout.flush()
+
+
+def is_output_buffered():
+    return getattr(OUTPUT_BUFFER, "parts", None) is not None
 
 
 def get_obslib_session(template_vars, bdast_vars=None):
@@ -61,108 +130,2606 @@ def get_obslib_session(template_vars, bdast_vars=None):
     template_vars["env"] = os.environ.copy()
     template_vars["bdast"] = bdast_vars
 
-    return obslib.Session(template_vars, ignore_list=EVAL_IGNORE_VARS)
+    return obslib.Session(
+        template_vars, environment=JINJA_ENVIRONMENT, ignore_list=EVAL_IGNORE_VARS
+    )
 
 
-def process_step_nop(action_state, impl_config):
+def get_var_refs(value, environment=None):
+
+    # Validate incoming parameters
+    val_arg(
+        isinstance(environment, (jinja2.Environment, type(None))),
+        "Invalid environment passed to get_var_refs",
+    )
+
+    if environment is None:
+        environment = JINJA_ENVIRONMENT
+
+    # Collect the names referenced by any template strings within the value
+    refs = set()
+
+    def add_refs(item):
+        if isinstance(item, str):
+            refs.update(find_undeclared_variables(environment.parse(item)))
+
+        return item
+
+    obslib.walk_object(value, add_refs)
+
+    return refs
+
+
+def get_var_order(new_vars, allow_self_ref=True):
+    """
+    Determine an order to resolve new_vars in, where each var comes after the other
+    vars in new_vars that it references. With allow_self_ref, a reference from a var
+    to itself refers to an existing value and is not a dependency.
+    Returns the ordered keys and the set of keys that could not be ordered due to
+    circular references.
+    """
 
     # Validate incoming parameters
+    val_arg(isinstance(new_vars, dict), "Invalid vars passed to get_var_order")
+
+    # Map each var to the other vars it references
+    dep_map = {}
+    for key in new_vars:
+        try:
+            dep_map[key] = get_var_refs(new_vars[key])
+        except jinja2.TemplateSyntaxError as e:
+            raise BdastLoadException(f"Invalid template in var {key}: {e}") from e
+
+        dep_map[key].intersection_update(new_vars.keys())
+
+        if allow_self_ref:
+            dep_map[key].discard(key)
+
+    # Repeatedly take the vars with no outstanding references, keeping
+    # declaration order within each pass
+    order = []
+    while len(dep_map) > 0:
+        ready = [x for x in dep_map if len(dep_map[x]) == 0]
+
+        if len(ready) == 0:
+            break
+
+        for key in ready:
+            dep_map.pop(key)
+            order.append(key)
+
+        for key in dep_map:
+            dep_map[key].difference_update(ready)
+
+    return order, set(dep_map.keys())
+
+
+def resolve_vars(session, new_vars):
+    """
+    Resolve a set of vars that may reference each other, in a single pass.
+    Each var is resolved against the session vars, plus any of the new vars it
+    references.
+    """
+
+    # Validate incoming parameters
+    val_arg(
+        isinstance(session, obslib.Session), "Invalid session passed to resolve_vars"
+    )
+    val_arg(isinstance(new_vars, dict), "Invalid vars passed to resolve_vars")
+
+    order, unresolvable = get_var_order(new_vars)
+    val_run(
+        len(unresolvable) == 0,
+        f"Circular references between vars: {sorted(unresolvable)}",
+    )
+
+    # Resolve against a single working session, adding each var as it is resolved,
+    # rather than rebuilding the session for every var
+    working_vars = session.vars.copy()
+    working_session = obslib.Session(
+        working_vars, environment=JINJA_ENVIRONMENT, ignore_list=EVAL_IGNORE_VARS
+    )
+
+    result = {}
+    for key in order:
+        result[key] = working_session.resolve(new_vars[key])
+        working_vars[key] = result[key]
+
+    # Return the vars in their original order
+    return {key: result[key] for key in new_vars}
+
+
+class SpilledText:
+    """
+    Read-only, string-like handle for a large text value that has been written to
+    disk. The content is only read back when the value is used, such as when it is
+    rendered in a template. The length and sha256 digest of the content are
+    recorded when it is spilled, so len() and comparisons don't read it. Values
+    hash as the equivalent str does, so the hash is computed on first use.
+    """
+
+    def __init__(self, path, size, length, digest):
+
+        # Check incoming parameters
+        val_arg(isinstance(path, str), "Invalid path passed to SpilledText")
+        val_arg(isinstance(size, int), "Invalid size passed to SpilledText")
+        val_arg(isinstance(length, int), "Invalid length passed to SpilledText")
+        val_arg(isinstance(digest, str), "Invalid digest passed to SpilledText")
+
+        self.path = path
+        self.size = size
+        self.length = length
+        self.digest = digest
+        self._hash = None
+
+    def read(self):
+        # The file holds the text exactly, so newlines aren't translated
+        with open(
+            self.path, "r", encoding="utf-8", errors="replace", newline=""
+        ) as file:
+            return file.read()
+
+    def __str__(self):
+        return self.read()
+
+    def __repr__(self):
+        return f"SpilledText({self.path!r}, {self.size} bytes)"
+
+    def __len__(self):
+        return self.length
+
+    def __bool__(self):
+        return self.size > 0
+
+    def __eq__(self, other):
+        if isinstance(other, SpilledText):
+            return self.digest == other.digest
+
+        if not isinstance(other, str) or len(other) != self.length:
+            return False
+
+        return hashlib.sha256(other.encode("utf-8")).hexdigest() == self.digest
+
+    def __hash__(self):
+        # Values compare equal to the equivalent str, so must hash the same way
+        if self._hash is None:
+            self._hash = hash(self.read())
+
+        return self._hash
+
+    def __contains__(self, item):
+        return item in self.read()
+
+    def __iter__(self):
+        return iter(self.read())
+
+    def __getitem__(self, key):
+        return self.read()[key]
+
+    def __add__(self, other):
+        return self.read() + str(other)
+
+    def __radd__(self, other):
+        return str(other) + self.read()
+
+    def __copy__(self):
+        # The backing file is never modified, so copies can share it
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __getattr__(self, name):
+        # Make str methods (strip, splitlines, etc.) available on the handle
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        return getattr(self.read(), name)
+
+
+class CaptureBuffer:
+    """
+    Accumulates output captured from a command. Output over the action state spill
+    threshold is written to disk as it arrives. With max_bytes, only the beginning
+    and end of the output are kept, up to max_bytes in total.
+    """
+
+    def __init__(self, action_state, max_bytes=None):
+
+        # Check incoming parameters
+        val_arg(
+            isinstance(action_state, ActionState),
+            "Invalid action state passed to CaptureBuffer",
+        )
+        val_arg(
+            isinstance(max_bytes, (int, type(None))),
+            "Invalid max_bytes passed to CaptureBuffer",
+        )
+
+        self._action_state = action_state
+        self._max_bytes = max_bytes
+
+        # Retained output. With max_bytes, _data is the beginning of the output and
+        # _tail is the most recent output
+        self._data = bytearray()
+        self._tail = bytearray()
+        self._file = None
+        self._path = None
+
+        # Output written to disk is decoded as it arrives, so the size, length and
+        # digest of the text on disk can be recorded without reading it back
+        self._decoder = None
+        self._size = 0
+        self._length = 0
+        self._digest = None
+
+        # Total bytes written, including any that were discarded
+        self.total = 0
+
+    def write(self, data):
+
+        self.total += len(data)
+
+        if self._max_bytes is not None:
+            # Fill the head first, then keep a rolling tail of the remainder
+            head_size = self._max_bytes // 2
+            if len(self._data) < head_size:
+                count = head_size - len(self._data)
+                self._data += data[:count]
+                data = data[count:]
+
+            self._tail += data
+            tail_size = self._max_bytes - head_size
+            if len(self._tail) > tail_size:
+                del self._tail[: len(self._tail) - tail_size]
+
+            return
+
+        if self._file is not None:
+            self._write_file(data)
+            return
+
+        self._data += data
+
+        # Move the output to disk once it is over the spill threshold
+        threshold = self._action_state.spill_threshold
+        if threshold > 0 and len(self._data) > threshold:
+            self._file, self._path = self._action_state.create_spill_file()
+            self._decoder = io.IncrementalNewlineDecoder(
+                codecs.getincrementaldecoder("utf-8")(errors="replace"), translate=True
+            )
+            self._digest = hashlib.sha256()
+            self._write_file(self._data)
+            self._data = bytearray()
+
+    def _write_file(self, data, final=False):
+
+        # Decode with universal newlines, as _decode does for output in memory
+        text = self._decoder.decode(bytes(data), final=final)
+        content = text.encode("utf-8")
+
+        self._file.write(content)
+        self._digest.update(content)
+        self._size += len(content)
+        self._length += len(text)
+
+    def close(self):
+
+        if self._file is not None:
+            self._write_file(b"", final=True)
+            self._file.close()
+            self._file = None
+
+    def result(self, strip=False):
+
+        self.close()
+
+        # Output on disk is returned as a handle to the file
+        if self._path is not None:
+            spilled = SpilledText(
+                self._path, self._size, self._length, self._digest.hexdigest()
+            )
+            if not strip:
+                return spilled
+
+            return self._action_state.spill_text(spilled.read().strip())
+
+        text = self._decode(self._data)
+        omitted = self.total - len(self._data) - len(self._tail)
+        if omitted > 0:
+            text += f"\n[... {omitted} bytes of output omitted ...]\n"
+
+        text += self._decode(self._tail)
+
+        if strip:
+            text = text.strip()
+
+        return self._action_state.spill_text(text)
+
+    def _decode(self, data):
+
+        # Decode with universal newlines, as for text mode streams
+        text = data.decode("utf-8", errors="replace")
+
+        return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+def write_process_input(stream, input_text):
+
+    # Write input to the process. The process may exit without reading all of it
+    try:
+        stream.write(input_text.encode("utf-8"))
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            stream.close()
+        except BrokenPipeError:
+            pass
+
+
+def tee_process_output(stream, output=None):
+
+    # Check incoming parameters
+    val_arg(
+        isinstance(output, (CaptureBuffer, type(None))),
+        "Invalid output passed to tee_process_output",
+    )
+
+    # Display output as it arrives, while also capturing it, if requested
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    handle = stream.fileno()
+    while True:
+        chunk = os.read(handle, 65536)
+        if len(chunk) == 0:
+            break
+
+        forward_output(chunk, decoder, output)
+
+    write_raw(decoder.decode(b"", final=True))
+
+
+def forward_output(data, decoder, output=None):
+
+    # Display output and add it to the capture buffer, if there is one
+    if output is not None:
+        output.write(data)
+
+    write_raw(decoder.decode(data))
+
+
+class MeasuredProcess(subprocess.Popen):
+    """
+    subprocess.Popen that records the resources used by the process when wait()
+    reaps it
+    """
+
+    rusage = None
+
+    def _try_wait(self, wait_flags):
+
+        # wait4 also reports the resources used by the process and any children it
+        # waited for
+        try:
+            pid, status, rusage = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            # Already reaped elsewhere, handled as subprocess.Popen does
+            return (self.pid, 0)
+
+        if pid == self.pid:
+            self.rusage = rusage
+
+        return (pid, status)
+
+
+def spawn_process(call_args, subprocess_args, new_group=False):
+    """
+    Start a process with subprocess.Popen. With new_group, the process is started
+    in its own process group, so it can be stopped along with its children.
+    Returns the process and the time taken to start it, in seconds.
+    """
+
+    # Check incoming parameters
+    val_arg(
+        isinstance(subprocess_args, dict),
+        "Invalid subprocess args passed to spawn_process",
+    )
+    val_arg(isinstance(new_group, bool), "Invalid new_group passed to spawn_process")
+
+    if new_group:
+        subprocess_args = subprocess_args.copy()
+        if sys.version_info >= (3, 11):
+            subprocess_args["process_group"] = 0
+        else:
+            subprocess_args["start_new_session"] = True
+
+    start = time.perf_counter()
+    proc = MeasuredProcess(call_args, **subprocess_args)
+
+    elapsed = time.perf_counter() - start
+    logger.debug("Started process %s in %.2f ms", proc.pid, elapsed * 1000)
+
+    return proc, elapsed
+
+
+# Time, in seconds, allowed for a process group to exit after SIGTERM, before
+# it is sent SIGKILL
+TERMINATE_GRACE_PERIOD = 5
+
+
+def signal_process_group(proc, sig):
+
+    # The group may have already exited
+    try:
+        os.killpg(proc.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def terminate_process_group(proc):
+    """
+    Stop a process started with new_group, along with the rest of its process group.
+    The group is sent SIGTERM, then SIGKILL if the process hasn't exited within
+    the grace period.
+    """
+
+    signal_process_group(proc, signal.SIGTERM)
+
+    try:
+        proc.wait(timeout=TERMINATE_GRACE_PERIOD)
+    except subprocess.TimeoutExpired:
+        pass
+
+    # Also stops any children left running after the process exited
+    signal_process_group(proc, signal.SIGKILL)
+    proc.wait()
+
+
+class ProcessTimeout:
+    """
+    Stops a process group if it is still running when the timeout expires. The group
+    is sent SIGTERM, then SIGKILL after the grace period. Signals are sent from timer
+    threads, so the caller can continue to read output and wait on the process.
+    """
+
+    def __init__(self, proc, timeout):
+
+        # Check incoming parameters
+        val_arg(
+            isinstance(timeout, (int, float, type(None))),
+            "Invalid timeout passed to ProcessTimeout",
+        )
+
+        self._proc = proc
+        self._lock = threading.Lock()
+        self._timer = None
+        self._cancelled = False
+        self.expired = False
+
+        if timeout is not None:
+            self._start_timer(max(timeout, 0), self._terminate)
+
+    def _start_timer(self, interval, function):
+
+        self._timer = threading.Timer(interval, function)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _terminate(self):
+
+        with self._lock:
+            if self._cancelled:
+                return
+
+            self.expired = True
+            logger.debug("Timeout expired, terminating process %s", self._proc.pid)
+            signal_process_group(self._proc, signal.SIGTERM)
+            self._start_timer(TERMINATE_GRACE_PERIOD, self._kill)
+
+    def _kill(self):
+
+        with self._lock:
+            if not self._cancelled:
+                signal_process_group(self._proc, signal.SIGKILL)
+
+    def cancel(self):
+        """
+        Stop the timers, once the process has exited. If the timeout expired, anything
+        left in the process group is killed.
+        """
+
+        with self._lock:
+            self._cancelled = True
+            if self._timer is not None:
+                self._timer.cancel()
+
+            if self.expired:
+                signal_process_group(self._proc, signal.SIGKILL)
+
+
+def get_resource_usage(rusage, elapsed):
+    """
+    Convert the resource usage of a process to a dict of resource name to value.
+    Times are in seconds and max_rss is in bytes.
+    """
+
+    # Check incoming parameters
+    val_arg(
+        isinstance(elapsed, (int, float)),
+        "Invalid elapsed passed to get_resource_usage",
+    )
+
+    # ru_maxrss is in kilobytes, except on macOS, where it is in bytes
+    max_rss = rusage.ru_maxrss
+    if sys.platform != "darwin":
+        max_rss = max_rss * 1024
+
+    return {
+        "elapsed": round(elapsed, 6),
+        "user_time": round(rusage.ru_utime, 6),
+        "system_time": round(rusage.ru_stime, 6),
+        "max_rss": max_rss,
+        "block_input": rusage.ru_inblock,
+        "block_output": rusage.ru_oublock,
+        "voluntary_switches": rusage.ru_nvcsw,
+        "involuntary_switches": rusage.ru_nivcsw,
+    }
+
+
+def format_resource_usage(usage):
+
+    # Check incoming parameters
+    val_arg(isinstance(usage, dict), "Invalid usage passed to format_resource_usage")
+
+    return (
+        f"elapsed {usage['elapsed']:.2f}s, "
+        f"user {usage['user_time']:.2f}s, "
+        f"system {usage['system_time']:.2f}s, "
+        f"max rss {usage['max_rss'] / (1024 * 1024):.1f} MiB, "
+        f"block in/out {usage['block_input']}/{usage['block_output']}, "
+        f"context switches {usage['voluntary_switches']}/"
+        f"{usage['involuntary_switches']}"
+    )
+
+
+def run_process(
+    action_state,
+    call_args,
+    subprocess_args,
+    *,
+    input_text=None,
+    output=None,
+    timeout=None,
+):
+    """
+    Run a process to completion and return the exit code. input_text is sent to the
+    process stdin. With output (a CaptureBuffer), the process stdout is read through
+    a pipe and displayed as it arrives, as well as being captured.
+    The process runs in its own process group. If it is still running after timeout
+    seconds, the group is stopped and BdastRunException is raised.
+    Returns the exit code and the resources used by the process (see
+    get_resource_usage), or None where they aren't available.
+    """
+
+    # Check incoming parameters
     val_arg(
         isinstance(action_state, ActionState),
-        "Invalid action state passed to process_step_nop",
+        "Invalid action state passed to run_process",
     )
     val_arg(
-        isinstance(impl_config, (dict, type(None))),
-        "Invalid impl config passed to process_step_nop",
+        isinstance(subprocess_args, dict),
+        "Invalid subprocess args passed to run_process",
+    )
+    val_arg(
+        isinstance(input_text, (str, type(None))),
+        "Invalid input text passed to run_process",
+    )
+    val_arg(
+        isinstance(output, (CaptureBuffer, type(None))),
+        "Invalid output passed to run_process",
+    )
+    val_arg(
+        isinstance(timeout, (int, float, type(None))),
+        "Invalid timeout passed to run_process",
     )
 
-    # Nothing to actually do, since 'nop'
+    subprocess_args = subprocess_args.copy()
 
-    # Validate no remaining keys on configuration
-    if isinstance(impl_config, dict):
-        val_run(
-            len(impl_config) == 0,
-            f"Expected an empty configuration for nop. Found keys: {impl_config.keys()}",
+    if input_text is not None:
+        subprocess_args["stdin"] = subprocess.PIPE
+
+    # Output for the console is read through a pipe when it is being buffered,
+    # rather than the process writing to the console directly
+    display_pipe = (
+        output is None
+        and subprocess_args.get("stdout") is None
+        and is_output_buffered()
+    )
+
+    if output is not None or display_pipe:
+        subprocess_args["stdout"] = subprocess.PIPE
+
+    sys.stdout.flush()
+    start = time.perf_counter()
+    proc, elapsed = spawn_process(call_args, subprocess_args, new_group=True)
+    action_state.record_spawn(elapsed)
+
+    with proc:
+        process_timeout = ProcessTimeout(proc, timeout)
+
+        try:
+            # Write input on a separate thread, so a process producing output before
+            # reading all of its input can't block
+            writer = None
+            if input_text is not None:
+                writer = threading.Thread(
+                    target=write_process_input,
+                    args=(proc.stdin, input_text),
+                    daemon=True,
+                )
+                writer.start()
+
+            if output is not None or display_pipe:
+                tee_process_output(proc.stdout, output)
+
+            if writer is not None:
+                writer.join()
+
+            returncode = proc.wait()
+        except BaseException:
+            # The process group doesn't receive terminal signals, such as Ctrl-C,
+            # so it must be stopped here
+            process_timeout.cancel()
+            terminate_process_group(proc)
+            raise
+
+        process_timeout.cancel()
+
+    if process_timeout.expired:
+        raise BdastRunException(action_state.timeout_message())
+
+    # Resource usage is only available once wait() has reaped the process
+    usage = None
+    if proc.rusage is not None:
+        usage = get_resource_usage(proc.rusage, time.perf_counter() - start)
+
+    return returncode, usage
+
+
+# Driver scripts for long running interpreters. Each step is sent as a frame of a
+# header line with the lengths of the working directory and script, followed by
+# the working directory and script. The script runs with its own working directory
+# and environment, then a line with the token and exit status ends the output.
+BASH_DRIVER = """\
+while IFS=' ' read -r __bdast_cwd_len __bdast_script_len; do
+  LC_ALL=C read -r -d '' -N "$__bdast_cwd_len" __bdast_cwd
+  __bdast_script=''
+  if [ "$__bdast_script_len" -gt 0 ]; then
+    LC_ALL=C read -r -d '' -N "$__bdast_script_len" __bdast_script
+  fi
+  ( cd -- "$__bdast_cwd" && eval "$__bdast_script" ) </dev/null 2>&1
+  printf '%s %d\\n' '@TOKEN@' "$?"
+done
+"""
+
+PWSH_DRIVER = """\
+$bdastInput = [Console]::In
+function Read-BdastFrame([int]$Length) {
+    $buffer = New-Object char[] $Length
+    $offset = 0
+    while ($offset -lt $Length) {
+        $count = $bdastInput.Read($buffer, $offset, $Length - $offset)
+        if ($count -le 0) { exit 0 }
+        $offset += $count
+    }
+    return [string]::new($buffer)
+}
+while ($true) {
+    $bdastHeader = $bdastInput.ReadLine()
+    if ($null -eq $bdastHeader) { break }
+    $bdastLengths = $bdastHeader.Split(' ')
+    $bdastCwd = Read-BdastFrame ([int]$bdastLengths[0])
+    $bdastScript = ''
+    if ([int]$bdastLengths[1] -gt 0) {
+        $bdastScript = Read-BdastFrame ([int]$bdastLengths[1])
+    }
+    $bdastEnv = [Environment]::GetEnvironmentVariables()
+    $bdastStatus = 0
+    $global:LASTEXITCODE = 0
+    $global:bdastScriptOk = $true
+    $global:bdastScriptExit = 0
+    Push-Location -LiteralPath $bdastCwd
+    try {
+        # The script status is recorded before its output is piped to the console,
+        # as the status after the pipeline is that of Out-Default
+        & {
+            & ([ScriptBlock]::Create($bdastScript))
+            $global:bdastScriptOk = $?
+            $global:bdastScriptExit = $global:LASTEXITCODE
+        } 2>&1 | Out-Default
+        if (-not $global:bdastScriptOk) {
+            $bdastStatus = 1
+            if ($global:bdastScriptExit) { $bdastStatus = $global:bdastScriptExit }
+        }
+    } catch {
+        Write-Host $_
+        $bdastStatus = 1
+    } finally {
+        Pop-Location
+        foreach ($key in @([Environment]::GetEnvironmentVariables().Keys)) {
+            if (-not $bdastEnv.Contains($key)) {
+                [Environment]::SetEnvironmentVariable($key, $null)
+            }
+        }
+        foreach ($key in $bdastEnv.Keys) {
+            [Environment]::SetEnvironmentVariable($key, $bdastEnv[$key])
+        }
+    }
+    [Console]::Out.Write("@TOKEN@ $bdastStatus`n")
+    [Console]::Out.Flush()
+}
+"""
+
+
+class PooledInterpreter:
+    """
+    A long running bash or pwsh process that runs step scripts sent to it
+    using the framing understood by BASH_DRIVER or PWSH_DRIVER.
+    """
+
+    def __init__(self, step_type, envs):
+
+        # Check incoming parameters
+        val_arg(
+            step_type in ("bash", "pwsh"),
+            "Invalid step type passed to PooledInterpreter",
         )
+        val_arg(isinstance(envs, dict), "Invalid envs passed to PooledInterpreter")
 
+        self.step_type = step_type
 
-def process_step_url(action_state, impl_config):
+        # Token marking the end of output for a script. This is random, so it won't
+        # appear in script output
+        self._token = f"__bdast_{secrets.token_hex(16)}__"
 
-    # Headers - headers for the request
-    headers = obslib.extract_property(impl_config, "headers", on_missing=None)
-    headers = action_state.session.resolve(headers, (dict, type(None)), on_none={})
-    for key in headers:
-        headers[key] = action_state.session.resolve(headers[key], str)
+        if step_type == "bash":
+            driver = BASH_DRIVER.replace("@TOKEN@", self._token)
+            call_args = ["bash", "-c", driver]
+        else:
+            driver = PWSH_DRIVER.replace("@TOKEN@", self._token)
+            call_args = ["pwsh", "-noni", "-nop", "-c", driver]
+
+        logger.debug("Starting %s interpreter", step_type)
+        self._proc, _ = spawn_process(
+            call_args,
+            {
+                "env": envs,
+                "stdin": subprocess.PIPE,
+                "stdout": subprocess.PIPE,
+                "stderr": subprocess.STDOUT,
+            },
+            new_group=True,
+        )
 
-    # Url - endpoint to communicate with
-    url = obslib.extract_property(impl_config, "url")
-    url = action_state.session.resolve(url, str)
+    def is_running(self):
+        return self._proc.poll() is None
 
-    # Method - request method (get, post, etc.)
-    method = obslib.extract_property(impl_config, "method", on_missing="post")
-    method = action_state.session.resolve(method, str)
+    def _frame_length(self, text):
 
-    # Body - content to send with the request
-    body = obslib.extract_property(impl_config, "body", on_missing=None)
-    body = action_state.session.resolve(body, (str, type(None)))
+        # bash reads frames in bytes. pwsh reads frames in .NET (UTF-16) characters
+        if self.step_type == "bash":
+            return len(text.encode("utf-8"))
 
-    # Store - variable to store the result
-    store = obslib.extract_property(impl_config, "store", on_missing=None)
-    store = action_state.session.resolve(store, (str, type(None)))
+        return len(text.encode("utf-16-le")) // 2
+
+    def run(self, cwd, script, output=None, timeout=None):
+        """
+        Run the script in the interpreter and return the exit status. Script output
+        is displayed and added to output (a CaptureBuffer), if supplied.
+        If the script is still running after timeout seconds, the interpreter is
+        stopped and None is returned.
+        """
+
+        # Check incoming parameters
+        val_arg(isinstance(cwd, str), "Invalid cwd passed to PooledInterpreter run")
+        val_arg(
+            isinstance(script, str), "Invalid script passed to PooledInterpreter run"
+        )
+
+        header = f"{self._frame_length(cwd)} {self._frame_length(script)}\n"
+        frame = (header + cwd + script).encode("utf-8")
+
+        # Stopping the interpreter ends its output, so reading output finishes
+        process_timeout = ProcessTimeout(self._proc, timeout)
+
+        # Write the frame on a separate thread, as for run_process
+        writer = threading.Thread(target=self._write_frame, args=(frame,), daemon=True)
+        writer.start()
+
+        try:
+            status = self._read_output(output)
+            writer.join()
+        finally:
+            process_timeout.cancel()
+
+        if process_timeout.expired:
+            return None
+
+        return status
+
+    def _write_frame(self, frame):
+
+        try:
+            self._proc.stdin.write(frame)
+            self._proc.stdin.flush()
+        except BrokenPipeError:
+            pass
+
+    def _read_output(self, output):
+
+        # Display output until the token line is seen. The end of the data read so
+        # far is held back, in case it is the start of the token
+        token = self._token.encode("utf-8")
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        handle = self._proc.stdout.fileno()
+        pending = b""
+
+        while True:
+            chunk = os.read(handle, 65536)
+
+            if len(chunk) == 0:
+                # The interpreter exited during the script (e.g. 'exit' in pwsh), so
+                # the step result is the interpreter exit code
+                forward_output(pending, decoder, output)
+                write_raw(decoder.decode(b"", final=True))
+
+                return self._proc.wait()
+
+            pending += chunk
+            index = pending.find(token)
+
+            if index < 0:
+                keep = len(token) - 1
+                if len(pending) > keep:
+                    forward_output(pending[:-keep], decoder, output)
+                    pending = pending[-keep:]
+
+                continue
+
+            forward_output(pending[:index], decoder, output)
+            write_raw(decoder.decode(b"", final=True))
+
+            # Read the remainder of the token line for the exit status
+            status = pending[index + len(token) :]
+            while b"\n" not in status:
+                chunk = os.read(handle, 64)
+                val_run(len(chunk) > 0, "Interpreter exited while reporting status")
+                status += chunk
+
+            return int(status.split(b"\n", 1)[0])
+
+    def close(self):
+
+        # Closing stdin ends the driver loop
+        try:
+            self._proc.stdin.close()
+        except BrokenPipeError:
+            pass
+
+        try:
+            self._proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            terminate_process_group(self._proc)
+
+        self._proc.stdout.close()
+
+
+class InterpreterPool:
+    """
+    Long running interpreters, by step type and environment, that are reused
+    between steps
+    """
+
+    def __init__(self):
+
+        self._lock = threading.Lock()
+
+        # Interpreters that are not currently running a script
+        self._idle = {}
+
+        # All interpreters started by the pool
+        self._interpreters = []
+
+    def run(self, step_type, envs, script, output=None, timeout=None):
+
+        # Check incoming parameters
+        val_arg(isinstance(envs, dict), "Invalid envs passed to InterpreterPool run")
+
+        key = (step_type, tuple(sorted(envs.items())))
+
+        # Use an idle interpreter for this step type and environment, if there is one
+        interpreter = None
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            while len(idle) > 0 and interpreter is None:
+                interpreter = idle.pop()
+                if not interpreter.is_running():
+                    interpreter = None
+
+        if interpreter is None:
+            interpreter = PooledInterpreter(step_type, envs)
+            with self._lock:
+                self._interpreters.append(interpreter)
+
+        sys.stdout.flush()
+        try:
+            status = interpreter.run(os.getcwd(), script, output, timeout)
+        except BaseException:
+            interpreter.close()
+            raise
+
+        # Return the interpreter to the pool, if it is still usable
+        if interpreter.is_running():
+            with self._lock:
+                self._idle[key].append(interpreter)
+
+        return status
+
+    def close(self):
+
+        with self._lock:
+            interpreters = self._interpreters
+            self._interpreters = []
+            self._idle = {}
+
+        for interpreter in interpreters:
+            interpreter.close()
+
+
+class ServiceProcess:
+    """
+    A process left running in the background by a service step. Output from the
+    process is displayed as it arrives and can be matched against a pattern to
+    find when the service is ready.
+    """
+
+    def __init__(self, call_args, subprocess_args, log_pattern=None):
+
+        # Check incoming parameters
+        val_arg(
+            isinstance(subprocess_args, dict),
+            "Invalid subprocess args passed to ServiceProcess",
+        )
+        val_arg(
+            isinstance(log_pattern, (re.Pattern, type(None))),
+            "Invalid log pattern passed to ServiceProcess",
+        )
+
+        self._log_pattern = log_pattern
+
+        # Set when the log pattern is seen, or the output ends
+        self._changed = threading.Event()
+        self.log_matched = False
+
+        subprocess_args = subprocess_args.copy()
+        subprocess_args["stdin"] = subprocess.DEVNULL
+        subprocess_args["stdout"] = subprocess.PIPE
+        subprocess_args["stderr"] = subprocess.STDOUT
+
+        sys.stdout.flush()
+        self._proc, _ = spawn_process(call_args, subprocess_args, new_group=True)
+        self.pid = self._proc.pid
+
+        self._reader = threading.Thread(target=self._read_output, daemon=True)
+        self._reader.start()
+
+    def _read_output(self):
+
+        for line in self._proc.stdout:
+            line = line.decode("utf-8", errors="replace")
+            write_raw(line)
+
+            if (
+                not self.log_matched
+                and self._log_pattern is not None
+                and self._log_pattern.search(line) is not None
+            ):
+                self.log_matched = True
+                self._changed.set()
+
+        self._changed.set()
+
+    def is_running(self):
+        return self._proc.poll() is None
+
+    def wait_ready(self, check, timeout):
+        """
+        Wait until check returns True. check is called at increasing intervals, and
+        as soon as the service output changes state. Raises BdastRunException if the
+        service exits or the timeout expires first.
+        """
+
+        # Check incoming parameters
+        val_arg(callable(check), "Invalid check passed to ServiceProcess wait_ready")
+        val_arg(
+            isinstance(timeout, (int, float)),
+            "Invalid timeout passed to ServiceProcess wait_ready",
+        )
+
+        end = time.monotonic() + timeout
+
+        def check_service():
+            return not self.is_running() or check()
+
+        # A change to the output ends the first wait early, as the log pattern may
+        # have matched or the service may have exited. The output can also end
+        # while the service keeps running, so the wait then continues without
+        # ending early
+        finished = wait_condition(
+            check_service, end, 0.05, 1, self._changed
+        ) or wait_condition(check_service, end, 0.05, 1, threading.Event())
+
+        val_run(
+            self.is_running(),
+            f"Service exited before it was ready, exit code: {self._proc.poll()}",
+        )
+        val_run(finished, f"Service was not ready within {timeout} seconds")
+
+    def stop(self):
+
+        if self.is_running():
+            logger.debug("Stopping service process %s", self.pid)
+
+        terminate_process_group(self._proc)
+        self._reader.join()
+        self._proc.stdout.close()
+
+
+def probe_tcp(address):
+
+    host, _, port = address.rpartition(":")
+    val_run(host != "" and port.isdigit(), f"Invalid tcp probe address: {address}")
+
+    try:
+        with socket.create_connection((host.strip("[]"), int(port)), timeout=1):
+            return True
+    except OSError:
+        return False
+
+
+def probe_http(session, url, verify, status=None, body_regex=None):
+
+    try:
+        with session.get(url, timeout=(1, 5), verify=verify) as response:
+            if status is None:
+                if not response.ok:
+                    return False
+            elif response.status_code not in status:
+                return False
+
+            return body_regex is None or body_regex.search(response.text) is not None
+    except requests.exceptions.RequestException:
+        return False
+
+
+def process_step_nop(action_state, impl_config):
+
+    # Validate incoming parameters
+    val_arg(
+        isinstance(action_state, ActionState),
+        "Invalid action state passed to process_step_nop",
+    )
+    val_arg(
+        isinstance(impl_config, (dict, type(None))),
+        "Invalid impl config passed to process_step_nop",
+    )
+
+    # Nothing to actually do, since 'nop'
+
+    # Validate no remaining keys on configuration
+    if isinstance(impl_config, dict):
+        val_run(
+            len(impl_config) == 0,
+            f"Expected an empty configuration for nop. Found keys: {impl_config.keys()}",
+        )
+
+
+class HttpCassette:
+    """
+    Directory of recorded http responses. Each response is a JSON file named for
+    the request method, url and body, with a sequence number, so repeated requests
+    (e.g. polling) are replayed in the order they were recorded
+    """
+
+    def __init__(self, directory):
+
+        # Check incoming parameters
+        val_arg(isinstance(directory, str), "Invalid directory passed to HttpCassette")
+
+        self._directory = directory
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def _next_path(self, request):
+
+        body = request.body or b""
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+
+        key = json.dumps(
+            [request.method, request.url, hashlib.sha256(body).hexdigest()]
+        )
+        key = hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+        with self._lock:
+            index = self._counts.get(key, 0)
+            self._counts[key] = index + 1
+
+        return os.path.join(self._directory, key), index
+
+    def record(self, request, response):
+
+        # Read the content now, so it can be saved. The content stays available to
+        # the caller, including for streamed responses
+        content = response.content
+
+        # The content is saved decoded, so drop the headers describing how it was
+        # transferred
+        headers = {
+            key: value
+            for key, value in response.headers.items()
+            if key.lower() not in ("content-encoding", "transfer-encoding")
+        }
+        headers["Content-Length"] = str(len(content))
+
+        entry = {
+            "method": request.method,
+            "url": request.url,
+            "status_code": response.status_code,
+            "reason": response.reason,
+            "headers": headers,
+            "content": base64.b64encode(content).decode("ascii"),
+        }
+
+        os.makedirs(self._directory, exist_ok=True)
+        base, index = self._next_path(request)
+        path = f"{base}.{index}.json"
+
+        temp_path = f"{path}.{secrets.token_hex(8)}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump(entry, file, indent=2)
+
+        os.replace(temp_path, path)
+
+    def replay(self, request):
+        """
+        Return the recorded response details for the request. Requests made more
+        times than recorded receive the last recorded response
+        """
+
+        base, index = self._next_path(request)
+
+        for candidate in range(index, -1, -1):
+            try:
+                with open(f"{base}.{candidate}.json", "r", encoding="utf-8") as file:
+                    return json.load(file)
+            except FileNotFoundError:
+                continue
+
+        raise BdastRunException(
+            f"No recorded response for {request.method} {request.url} in "
+            f"{self._directory}"
+        )
+
+
+class HttpRecordAdapter(requests.adapters.HTTPAdapter):
+    """
+    Transport adapter saving each response to a cassette
+    """
+
+    def __init__(self, cassette, **kwargs):
+        super().__init__(**kwargs)
+        self._cassette = cassette
+
+    def send(self, request, *args, **kwargs):
+        response = super().send(request, *args, **kwargs)
+        self._cassette.record(request, response)
+
+        return response
+
+
+class HttpReplayAdapter(requests.adapters.HTTPAdapter):
+    """
+    Transport adapter serving responses from a cassette, without network access
+    """
+
+    def __init__(self, cassette, **kwargs):
+        super().__init__(**kwargs)
+        self._cassette = cassette
+
+    def send(self, request, *args, **kwargs):
+        entry = self._cassette.replay(request)
+
+        raw = urllib3.HTTPResponse(
+            body=io.BytesIO(base64.b64decode(entry["content"])),
+            headers=entry["headers"],
+            status=entry["status_code"],
+            reason=entry["reason"],
+            preload_content=False,
+            decode_content=False,
+        )
+
+        return self.build_response(request, raw)
+
+
+class HttpSessionPool:
+    """
+    requests sessions shared by url steps, keyed by scheme, host and certificate
+    verification, so connections to a host are reused between steps.
+    With a record directory, responses are saved to a cassette in the directory.
+    With a replay directory, responses are served from a cassette in the directory.
+    """
+
+    def __init__(
+        self,
+        pool_size=DEFAULT_HTTP_POOL_SIZE,
+        keep_alive=True,
+        record_dir=None,
+        replay_dir=None,
+    ):
+
+        # Check incoming parameters
+        val_arg(
+            isinstance(pool_size, int) and pool_size > 0,
+            "Invalid pool size passed to HttpSessionPool",
+        )
+        val_arg(
+            isinstance(keep_alive, bool), "Invalid keep_alive passed to HttpSessionPool"
+        )
+
+        val_arg(
+            isinstance(record_dir, (str, type(None))),
+            "Invalid record_dir passed to HttpSessionPool",
+        )
+        val_arg(
+            isinstance(replay_dir, (str, type(None))),
+            "Invalid replay_dir passed to HttpSessionPool",
+        )
+        val_arg(
+            record_dir is None or replay_dir is None,
+            "HttpSessionPool can't both record and replay",
+        )
+
+        self._pool_size = pool_size
+        self._keep_alive = keep_alive
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+        self._record = None
+        if record_dir is not None:
+            self._record = HttpCassette(record_dir)
+
+        self._replay = None
+        if replay_dir is not None:
+            self._replay = HttpCassette(replay_dir)
+
+    def get_session(self, url, verify):
+
+        # Check incoming parameters
+        val_arg(isinstance(url, str), "Invalid url passed to HttpSessionPool")
+        val_arg(isinstance(verify, bool), "Invalid verify passed to HttpSessionPool")
+
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme.lower(), parts.netloc.lower(), verify)
+
+        with self._lock:
+            session, _ = self._sessions.get(key, (None, None))
+            if session is None:
+                session = requests.Session()
+                session.verify = verify
+
+                # Sessions are shared to reuse connections only. Cookies set by a
+                # response aren't kept, so they aren't sent by later requests
+                session.cookies.set_policy(
+                    http.cookiejar.DefaultCookiePolicy(allowed_domains=[])
+                )
+
+                # A single host is used with each session, so a single connection
+                # pool is needed, holding up to pool_size connections
+                adapter_args = {"pool_connections": 1, "pool_maxsize": self._pool_size}
+                if self._record is not None:
+                    adapter = HttpRecordAdapter(self._record, **adapter_args)
+                elif self._replay is not None:
+                    adapter = HttpReplayAdapter(self._replay, **adapter_args)
+                else:
+                    adapter = requests.adapters.HTTPAdapter(**adapter_args)
+
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+
+                if not self._keep_alive:
+                    session.headers["Connection"] = "close"
+
+                self._sessions[key] = (session, adapter)
+
+        return session
+
+    def get_stats(self):
+        """
+        Return the number of requests made and connections opened, by host
+        """
+
+        stats = {}
+        with self._lock:
+            for (scheme, host, _), (_, adapter) in self._sessions.items():
+                requests_made, connections = stats.get(f"{scheme}://{host}", (0, 0))
+
+                for pool_key in adapter.poolmanager.pools.keys():
+                    pool = adapter.poolmanager.pools[pool_key]
+                    requests_made += pool.num_requests
+                    connections += pool.num_connections
+
+                stats[f"{scheme}://{host}"] = (requests_made, connections)
+
+        return stats
+
+    def close(self):
+
+        for host, (requests_made, connections) in self.get_stats().items():
+            logger.debug(
+                "HTTP connections to %s: %s requests over %s connections",
+                host,
+                requests_made,
+                connections,
+            )
+
+        with self._lock:
+            sessions = self._sessions
+            self._sessions = {}
+
+        for session, _ in sessions.values():
+            session.close()
+
+
+def get_default_http_cache_dir():
+
+    cache_home = os.environ.get("XDG_CACHE_HOME", "")
+    if cache_home == "":
+        cache_home = os.path.join(os.path.expanduser("~"), ".cache")
+
+    return os.path.join(cache_home, "bdast", "http")
+
+
+class HttpCache:
+    """
+    On disk cache of url step responses, revalidated with the ETag and Last-Modified
+    validators from the cached response. Each entry is a JSON file holding the
+    response details, with the body in a separate file.
+    """
+
+    def __init__(self, directory):
+
+        # Check incoming parameters
+        val_arg(isinstance(directory, str), "Invalid directory passed to HttpCache")
+
+        self._directory = directory
+
+    def get_key(self, method, url, headers):
+
+        # Check incoming parameters
+        val_arg(isinstance(headers, dict), "Invalid headers passed to HttpCache")
+
+        key = json.dumps([method.upper(), url, headers], sort_keys=True)
+
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def _paths(self, key):
+        base = os.path.join(self._directory, key)
+        return base + ".json", base + ".body"
+
+    def lookup(self, key):
+
+        entry_path, body_path = self._paths(key)
+
+        try:
+            with open(entry_path, "r", encoding="utf-8") as file:
+                entry = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        if not os.path.exists(body_path):
+            return None
+
+        return entry
+
+    def get_validators(self, entry):
+
+        # Check incoming parameters
+        val_arg(isinstance(entry, dict), "Invalid entry passed to HttpCache")
+
+        headers = {}
+        if entry.get("etag") is not None:
+            headers["If-None-Match"] = entry["etag"]
+
+        if entry.get("last_modified") is not None:
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+        return headers
+
+    def load_text(self, key, entry):
+
+        _, body_path = self._paths(key)
+        with open(body_path, "rb") as file:
+            content = file.read()
+
+        return content.decode(entry.get("encoding") or "utf-8", errors="replace")
+
+    def store(self, key, response):
+        """
+        Store the response, if it has a validator to revalidate it with
+        """
+
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if etag is None and last_modified is None:
+            return
+
+        os.makedirs(self._directory, exist_ok=True)
+        entry_path, body_path = self._paths(key)
+
+        entry = {
+            "url": response.url,
+            "status_code": response.status_code,
+            "headers": dict(response.headers),
+            "encoding": response.encoding,
+            "etag": etag,
+            "last_modified": last_modified,
+        }
+
+        # Write the body first, so an entry is only visible with its body
+        for path, content in (
+            (body_path, response.content),
+            (entry_path, json.dumps(entry).encode("utf-8")),
+        ):
+            temp_path = f"{path}.{secrets.token_hex(8)}.tmp"
+            with open(temp_path, "wb") as file:
+                file.write(content)
+
+            os.replace(temp_path, path)
+
+
+def get_retry_after(response):
+    """
+    Return the delay (in seconds) requested by the Retry-After header on the
+    response, or None if there is no valid Retry-After header
+    """
+
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+
+    # Otherwise, the value is a date to retry after
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+
+    return max(email.utils.mktime_tz(parsed) - time.time(), 0)
+
+
+def send_url_request(action_state, session, args, retry):
+    """
+    Send the request, retrying connection errors, timeouts and responses with a
+    status in retry["retry_on"]. Read timeouts are only retried for idempotent
+    methods, unless retry["retry_unsafe"] is set, as the server may have acted on
+    the request.
+    Retries wait for the Retry-After delay from the response, if present, or
+    otherwise an exponential backoff. Retries stop when the next delay would exceed
+    the retry budget or the time remaining for the step.
+    Returns the last response, which may have a retryable status
+    """
+
+    # Check incoming parameters
+    val_arg(isinstance(args, dict), "Invalid args passed to send_url_request")
+    val_arg(isinstance(retry, dict), "Invalid retry passed to send_url_request")
+
+    start = time.monotonic()
+    attempt = 0
+
+    while True:
+        # Connect and read timeouts, limited to the time remaining for the step
+        # and action
+        timeout = (10, 30)
+        remaining = action_state.time_remaining()
+        if remaining is not None:
+            timeout = tuple(min(x, remaining) for x in timeout)
+
+        attempt_start = time.monotonic()
+        error = None
+        response = None
+
+        try:
+            response = session.request(**args, timeout=timeout)
+        except requests.exceptions.Timeout as e:
+            action_state.check_deadline()
+            error = e
+
+            if (
+                isinstance(e, requests.exceptions.ReadTimeout)
+                and args["method"].upper() not in IDEMPOTENT_METHODS
+                and not retry["retry_unsafe"]
+            ):
+                if retry["retries"] > 0:
+                    logger.info(
+                        "Not retrying %s %s after a read timeout, as the method "
+                        "isn't idempotent",
+                        args["method"].upper(),
+                        args["url"],
+                    )
+
+                raise
+        except requests.exceptions.ConnectionError as e:
+            error = e
+
+        elapsed = time.monotonic() - attempt_start
+
+        if error is not None:
+            reason = str(error)
+            delay = retry["backoff"] * (2**attempt)
+        elif response.status_code in retry["retry_on"]:
+            reason = f"status code {response.status_code}"
+            delay = get_retry_after(response)
+            if delay is None:
+                delay = retry["backoff"] * (2**attempt)
+        else:
+            return response
+
+        # Give up if out of retries or the delay would run past the retry budget
+        # or deadline
+        remaining = action_state.time_remaining()
+        if (
+            attempt >= retry["retries"]
+            or time.monotonic() - start + delay > retry["retry_budget"]
+            or (remaining is not None and delay >= remaining)
+        ):
+            if attempt > 0:
+                logger.info(
+                    "Giving up on %s %s after %s attempts (%.2fs): %s",
+                    args["method"].upper(),
+                    args["url"],
+                    attempt + 1,
+                    time.monotonic() - start,
+                    reason,
+                )
+
+            if error is not None:
+                raise error
+
+            return response
+
+        if response is not None:
+            response.close()
+
+        attempt += 1
+        logger.info(
+            "Request %s %s failed after %.2fs (%s). Retry %s of %s in %.2fs",
+            args["method"].upper(),
+            args["url"],
+            elapsed,
+            reason,
+            attempt,
+            retry["retries"],
+            delay,
+        )
+
+        time.sleep(delay)
+
+
+def parse_select_path(path):
+    """
+    Parse a JSONPath style select path (e.g. '$.items[*].name') in to a list of
+    ("key", name), ("index", number) and ("wildcard", None) tokens
+    """
+
+    # Check incoming parameters
+    val_arg(isinstance(path, str), "Invalid path passed to parse_select_path")
+
+    remainder = path.strip()
+    if remainder.startswith("$"):
+        remainder = remainder[1:]
+
+    if remainder != "" and remainder[0] not in ".[":
+        remainder = "." + remainder
+
+    token_regex = re.compile(
+        r"\.\*|\[\*\]|\.([^.\[\]]+)|\[(-?\d+)\]|\['([^']*)'\]|\[\"([^\"]*)\"\]"
+    )
+
+    tokens = []
+    pos = 0
+    while pos < len(remainder):
+        match = token_regex.match(remainder, pos)
+        val_run(match is not None, f"Invalid select path: {path}")
+
+        if match[1] is not None:
+            tokens.append(("key", match[1]))
+        elif match[2] is not None:
+            tokens.append(("index", int(match[2])))
+        elif match[3] is not None:
+            tokens.append(("key", match[3]))
+        elif match[4] is not None:
+            tokens.append(("key", match[4]))
+        else:
+            tokens.append(("wildcard", None))
+
+        pos = match.end()
+
+    return tokens
+
+
+def select_matches(value, tokens):
+    """
+    Return the list of values matching the select path tokens
+    """
+
+    matches = [value]
+    for kind, arg in tokens:
+        next_matches = []
+        for match in matches:
+            if kind == "key":
+                if isinstance(match, dict) and arg in match:
+                    next_matches.append(match[arg])
+            elif kind == "index":
+                if isinstance(match, list) and -len(match) <= arg < len(match):
+                    next_matches.append(match[arg])
+            elif isinstance(match, dict):
+                next_matches.extend(match.values())
+            elif isinstance(match, list):
+                next_matches.extend(match)
+
+        matches = next_matches
+
+    return matches
+
+
+def finish_select(matches, tokens, path):
+    """
+    Return the selected value. Paths with a wildcard select a list of all matches,
+    otherwise the path must match a single value
+    """
+
+    if any(kind == "wildcard" for kind, _ in tokens):
+        return matches
+
+    val_run(len(matches) > 0, f"No match for select path: {path}")
+
+    return matches[0]
+
+
+class JsonValueScanner:
+    """
+    Finds the end of a JSON value in text that arrives in pieces. String and
+    bracket nesting is tracked between pieces, so the value only needs to be
+    decoded once it is complete. The end of the value is the delimiter that
+    follows it
+    """
+
+    # Characters that end or change the nesting of a value, inside strings, within
+    # arrays or objects and at the top level of the value
+    STRING_CHARS = re.compile(r'["\\]')
+    NESTED_CHARS = re.compile(r'["\[\]{}]')
+    VALUE_CHARS = re.compile(r'["\[\]{}, \t\r\n]')
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+
+    def scan(self, text, pos=0):
+        """
+        Scan text for the end of the value, returning the position of the delimiter
+        following it, or None if the value continues past the end of the text
+        """
+
+        while pos < len(text):
+            if self.escape:
+                pos += 1
+                self.escape = False
+                continue
+
+            if self.in_string:
+                match = self.STRING_CHARS.search(text, pos)
+                if match is None:
+                    return None
+
+                pos = match.end()
+                if match.group() == "\\":
+                    self.escape = True
+                else:
+                    self.in_string = False
+
+                continue
+
+            pattern = self.NESTED_CHARS if self.depth > 0 else self.VALUE_CHARS
+            match = pattern.search(text, pos)
+            if match is None:
+                return None
+
+            char = match.group()
+            if self.depth == 0 and char in ", \t\r\n]}":
+                return match.start()
+
+            pos = match.end()
+            if char == '"':
+                self.in_string = True
+            elif char in "[{":
+                self.depth += 1
+            elif char in "]}":
+                self.depth -= 1
+
+        return None
+
+
+def iter_json_array(chunks, encoding):
+    """
+    Decode a JSON array from an iterable of byte chunks, yielding each element as
+    it is decoded, so the whole document is never held in memory.
+    Raises ValueError if the content isn't a JSON array
+    """
+
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder(encoding)()
+    whitespace = " \t\r\n"
+
+    buffer = ""
+    state = "open"
+    finished = False
+    chunks = iter(chunks)
+
+    # Text of an element that isn't complete yet. Chunks are scanned for the end
+    # of the element as they arrive, and it is only decoded once complete
+    pending = []
+    scanner = JsonValueScanner()
+
+    while True:
+        try:
+            text = text_decoder.decode(next(chunks))
+        except StopIteration:
+            text = text_decoder.decode(b"", final=True)
+            finished = True
+
+        if len(pending) > 0:
+            if scanner.scan(text) is None and not finished:
+                pending.append(text)
+                continue
+
+            buffer = "".join(pending) + text
+            pending = []
+        else:
+            buffer += text
+
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in whitespace:
+                pos += 1
+
+            if pos >= len(buffer) or state == "closed":
+                break
+
+            if state == "open":
+                if buffer[pos] != "[":
+                    raise ValueError("Content is not a JSON array")
+
+                pos += 1
+                state = "first"
+            elif state == "first" and buffer[pos] == "]":
+                pos += 1
+                state = "closed"
+            elif state in ("first", "value"):
+                # A value at the end of the buffer, including a number, may
+                # continue in the next chunk, so wait for the delimiter following it
+                scanner = JsonValueScanner()
+                if scanner.scan(buffer, pos) is None and not finished:
+                    pending.append(buffer[pos:])
+                    pos = len(buffer)
+                    break
+
+                element, pos = decoder.raw_decode(buffer, pos)
+                state = "separator"
+                yield element
+            elif state == "separator":
+                if buffer[pos] not in ",]":
+                    raise ValueError(
+                        f"Expected ',' or ']' in JSON array: {buffer[pos]}"
+                    )
+
+                state = "value" if buffer[pos] == "," else "closed"
+                pos += 1
+
+        buffer = buffer[pos:]
+
+        if finished:
+            if state != "closed" or buffer.strip(whitespace) != "":
+                raise ValueError("Invalid JSON array content")
+
+            return
+
+
+def get_json_encoding(response):
+    """
+    Return the encoding of a JSON response. JSON is UTF-8 unless the response names
+    a charset, where requests would default text/* responses to ISO-8859-1
+    """
+
+    message = email.message.Message()
+    message["Content-Type"] = response.headers.get("Content-Type", "")
+
+    return message.get_content_charset() or "utf-8"
+
+
+def decode_json_response(response, tokens, path):
+    """
+    Decode a JSON response body, applying the select path tokens. Arrays are decoded
+    element by element, with only the selected parts of each element kept
+    """
+
+    encoding = get_json_encoding(response)
+    chunks = response.iter_content(chunk_size=65536)
+
+    # Read up to the first non-whitespace content, to check for an array
+    prefix = b""
+    for chunk in chunks:
+        prefix += chunk
+        if prefix.strip() != b"":
+            break
+
+    if not prefix.strip().startswith(b"["):
+        return decode_text_content(
+            (prefix + b"".join(chunks)).decode(encoding), "json", tokens, path
+        )
+
+    elements = iter_json_array(itertools.chain([prefix], chunks), encoding)
+
+    if len(tokens) == 0:
+        return list(elements)
+
+    kind, arg = tokens[0]
+    if kind == "wildcard":
+        matches = []
+        for element in elements:
+            matches.extend(select_matches(element, tokens[1:]))
+
+        return finish_select(matches, tokens, path)
+
+    if kind == "index" and arg >= 0:
+        # Stop reading once the selected element is found
+        for index, element in enumerate(elements):
+            if index == arg:
+                return finish_select(select_matches(element, tokens[1:]), tokens, path)
+
+        return finish_select([], tokens, path)
+
+    return finish_select(select_matches(list(elements), tokens), tokens, path)
+
+
+def decode_url_text(url, text, response_format, tokens, path):
+
+    try:
+        return decode_text_content(text, response_format, tokens, path)
+    except (ValueError, yaml.YAMLError) as e:
+        raise BdastRunException(
+            f"Invalid {response_format} response from {url}: {e}"
+        ) from e
+
+
+def decode_text_content(text, response_format, tokens, path):
+    """
+    Decode text in the response format, applying the select path tokens
+    """
+
+    if response_format == "json":
+        value = json.loads(text)
+    elif response_format == "yaml":
+        value = yaml.safe_load(text)
+    elif response_format == "lines":
+        value = text.splitlines()
+    else:
+        raise BdastArgumentException(f"Invalid response format: {response_format}")
+
+    if len(tokens) == 0:
+        return value
+
+    return finish_select(select_matches(value, tokens), tokens, path)
+
+
+def download_response(action_state, response, path, checksum=None):
+    """
+    Stream the response body to path. The body is written to a temporary file in the
+    same directory, which is renamed in to place once complete and, if a checksum is
+    supplied, verified.
+    Returns the size and sha256 digest of the content.
+    """
+
+    # Check incoming parameters
+    val_arg(isinstance(path, str), "Invalid path passed to download_response")
+    val_arg(
+        isinstance(checksum, (str, type(None))),
+        "Invalid checksum passed to download_response",
+    )
+
+    temp_path = f"{path}.{secrets.token_hex(8)}.tmp"
+    digest = hashlib.sha256()
+    size = 0
+
+    handle = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(handle, "wb") as file:
+            for chunk in response.iter_content(chunk_size=65536):
+                file.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+
+                action_state.check_deadline()
+
+        val_run(
+            checksum is None or digest.hexdigest() == checksum,
+            f"Checksum mismatch for {path}: expected {checksum}, "
+            f"found {digest.hexdigest()}",
+        )
+
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+
+        raise
+
+    logger.debug("Downloaded %s bytes to %s", size, path)
+
+    return size, digest.hexdigest()
+
+
+def get_text_preview(text, limit=1000):
+    """
+    Return the start of the text, for logging, noting how much was left out
+    """
+
+    if len(text) <= limit:
+        return text
+
+    return f"{text[:limit]}... ({len(text) - limit} more characters)"
+
+
+def process_step_url(action_state, impl_config):
+
+    # Check incoming parameters
+    val_arg(
+        isinstance(action_state, ActionState),
+        "Invalid action state passed to process_step_url",
+    )
+    val_arg(
+        isinstance(impl_config, dict),
+        "Invalid impl config passed to process_step_url",
+    )
+
+    # A list of requests, or a request template and items, are run concurrently
+    if "requests" in impl_config or "items" in impl_config:
+        process_step_url_multi(action_state, impl_config)
+        return
+
+    # Store - variable to store the result
+    store = obslib.extract_property(impl_config, "store", on_missing=None)
+    store = action_state.session.resolve(store, (str, type(None)))
+
+    result = run_url_request(action_state, impl_config)
+
+    # Only store result if requested
+    if store is not None and store != "":
+        if "text" in result:
+            result["text"] = action_state.spill_text(result["text"])
+
+        action_state.update_vars({store: result})
+
+
+def process_step_url_multi(action_state, impl_config):
+
+    # Requests - list of request definitions, or a dict of names to request
+    # definitions. Each is templated when it is run
+    url_requests = obslib.extract_property(impl_config, "requests", on_missing=None)
+    url_requests = action_state.session.resolve(
+        url_requests, (list, dict, type(None)), depth=0
+    )
+
+    # Request - request definition run for each item. The item is available to
+    # the request in the 'item' var
+    request_def = obslib.extract_property(impl_config, "request", on_missing=None)
+    request_def = action_state.session.resolve(request_def, (dict, type(None)), depth=0)
+
+    # Items - list of values to run the request with
+    items = obslib.extract_property(impl_config, "items", on_missing=None)
+    items = action_state.session.resolve(items, (list, type(None)), depth=0)
+
+    # Max_concurrency - limit on the number of requests in progress at once.
+    # Defaults to the number of connections kept open to each host
+    max_concurrency = obslib.extract_property(
+        impl_config, "max_concurrency", on_missing=None
+    )
+    max_concurrency = action_state.session.resolve(
+        max_concurrency, (int, type(None)), on_none=action_state.http_pool_size
+    )
+
+    # Store - variable to store the results. The results are a list or dict,
+    # matching the requests
+    store = obslib.extract_property(impl_config, "store", on_missing=None)
+    store = action_state.session.resolve(store, (str, type(None)))
+
+    if url_requests is not None:
+        val_run(
+            request_def is None and items is None,
+            "requests can't be used with request or items",
+        )
+
+        if isinstance(url_requests, dict):
+            names = list(url_requests.keys())
+            request_defs = [
+                action_state.session.resolve(url_requests[x], dict, depth=0)
+                for x in names
+            ]
+        else:
+            names = None
+            request_defs = [
+                action_state.session.resolve(x, dict, depth=0) for x in url_requests
+            ]
+
+        item_values = [None] * len(request_defs)
+    else:
+        val_run(
+            request_def is not None and items is not None,
+            "request and items must be used together",
+        )
+
+        names = None
+        request_defs = [request_def] * len(items)
+        item_values = [action_state.session.resolve(x) for x in items]
+
+    for request_config in request_defs:
+        for key in ("requests", "request", "items", "store"):
+            val_run(key not in request_config, f"{key} can't be used within a request")
+
+    results = [None] * len(request_defs)
+
+    def run_request(index, task_state):
+
+        if items is not None:
+            task_state.update_vars({"item": item_values[index]})
+
+        request_config = copy.deepcopy(request_defs[index])
+        result = run_url_request(task_state, request_config)
+
+        val_run(
+            len(request_config) == 0,
+            f"Unknown properties in request config: {request_config.keys()}",
+        )
+
+        if store is not None and store != "" and "text" in result:
+            result["text"] = task_state.spill_text(result["text"])
+
+        results[index] = result
+
+    tasks = [
+        lambda task_state, x=index: run_request(x, task_state)
+        for index in range(len(request_defs))
+    ]
+
+    # Each request waits on its connection in a separate thread, with connections
+    # shared through the http pool
+    outcomes = run_concurrent(action_state, tasks, max_concurrency)
+
+    # Report all failures before failing the step
+    failures = 0
+    for index, (_, error) in enumerate(outcomes):
+        if error is not None:
+            failures += 1
+            label = names[index] if names is not None else index
+            log_raw(f"Url request failed: {label}: {error}")
+
+    val_run(
+        failures == 0,
+        f"{failures} of {len(request_defs)} url requests failed",
+    )
+
+    if store is not None and store != "":
+        if names is not None:
+            results = dict(zip(names, results))
+
+        action_state.update_vars({store: results})
+
+
+def run_url_request(action_state, impl_config):
+    """
+    Perform the request described by impl_config, removing the properties used from
+    impl_config.
+    Returns the result of the request. Any response text is left for the caller
+    to spill, if the result is kept
+    """
+
+    # Headers - headers for the request
+    headers = obslib.extract_property(impl_config, "headers", on_missing=None)
+    headers = action_state.session.resolve(headers, (dict, type(None)), on_none={})
+    for key in headers:
+        headers[key] = action_state.session.resolve(headers[key], str)
+
+    # Url - endpoint to communicate with
+    url = obslib.extract_property(impl_config, "url")
+    url = action_state.session.resolve(url, str)
+
+    # Method - request method (get, post, etc.)
+    method = obslib.extract_property(impl_config, "method", on_missing="post")
+    method = action_state.session.resolve(method, str)
+
+    # Body - content to send with the request
+    body = obslib.extract_property(impl_config, "body", on_missing=None)
+    body = action_state.session.resolve(body, (str, type(None)))
+
+    # Verify - whether to verify certificate for the endpoint
+    verify = obslib.extract_property(impl_config, "verify", on_missing=None)
+    verify = action_state.session.resolve(verify, (bool, type(None)), on_none=True)
+
+    # status check - whether to check the response code from the endpoint
+    status_check = obslib.extract_property(impl_config, "status_check", on_missing=None)
+    status_check = action_state.session.resolve(
+        status_check, (list, int, type(None)), on_none=None
+    )
+
+    if isinstance(status_check, int):
+        status_check = [status_check]
+
+    if status_check is not None:
+        status_check = [action_state.session.resolve(x, int) for x in status_check]
+
+    # Download - path to write the response body to. The body is streamed to
+    # the file, rather than held in memory
+    download = obslib.extract_property(impl_config, "download", on_missing=None)
+    download = action_state.session.resolve(download, (str, type(None)), on_none="")
+
+    # Checksum - expected sha256 of the downloaded content, as hex, optionally
+    # prefixed with 'sha256:'
+    checksum = obslib.extract_property(impl_config, "checksum", on_missing=None)
+    checksum = action_state.session.resolve(checksum, (str, type(None)))
+
+    if checksum is not None:
+        val_run(download != "", "checksum can only be used with download")
+
+        checksum = checksum.strip().lower()
+        if checksum.startswith("sha256:"):
+            checksum = checksum[len("sha256:") :]
+
+        val_run(
+            re.fullmatch("[0-9a-f]{64}", checksum) is not None,
+            f"Invalid sha256 checksum: {checksum}",
+        )
+
+    # Format - how to decode the response body. 'text' keeps the body as text.
+    # 'json', 'yaml' and 'lines' store the decoded body as 'data', in place of the
+    # text
+    response_format = obslib.extract_property(impl_config, "format", on_missing=None)
+    response_format = action_state.session.resolve(
+        response_format, (str, type(None)), on_none="text"
+    )
+    val_run(
+        response_format in ("text", "json", "yaml", "lines"),
+        f"Invalid url response format: {response_format}",
+    )
+
+    # Select - JSONPath style path (e.g. '$.items[*].name') of the part of the
+    # decoded body to keep
+    select = obslib.extract_property(impl_config, "select", on_missing=None)
+    select = action_state.session.resolve(select, (str, type(None)))
+
+    select_tokens = []
+    if select is not None:
+        val_run(response_format != "text", "select requires a format other than text")
+        select_tokens = parse_select_path(select)
+
+    if response_format != "text":
+        val_run(download == "", "format can't be used with download")
+
+    # Cache - whether to keep the response in the on-disk cache and revalidate it
+    # on later requests, rather than fetching it again
+    cache = obslib.extract_property(impl_config, "cache", on_missing=None)
+    cache = action_state.session.resolve(cache, (bool, type(None)), on_none=False)
+
+    # Cache_headers - request headers that, along with the method and url, select
+    # the cached response
+    cache_headers = obslib.extract_property(
+        impl_config, "cache_headers", on_missing=None
+    )
+    cache_headers = action_state.session.resolve(
+        cache_headers, (list, type(None)), depth=0, on_none=[]
+    )
+    cache_headers = [action_state.session.resolve(x, str) for x in cache_headers]
+
+    if cache:
+        val_run(
+            method.upper() in ("GET", "HEAD"),
+            "cache can only be used with GET and HEAD requests",
+        )
+        val_run(download == "", "cache can't be used with download")
+    else:
+        val_run(len(cache_headers) == 0, "cache_headers can only be used with cache")
+
+    # Retries - number of times to retry the request after a connection error,
+    # timeout or a response with a status in retry_on
+    retries = obslib.extract_property(impl_config, "retries", on_missing=None)
+    retries = action_state.session.resolve(retries, (int, type(None)), on_none=0)
+    val_run(retries >= 0, "retries must not be negative")
+
+    # Backoff - delay (in seconds) before the first retry, doubling for each retry.
+    # A Retry-After header on the response takes precedence
+    backoff = obslib.extract_property(impl_config, "backoff", on_missing=None)
+    backoff = action_state.session.resolve(backoff, (int, float, type(None)), on_none=1)
+    val_run(backoff >= 0, "backoff must not be negative")
+
+    # Retry_on - response codes to retry the request on
+    retry_on = obslib.extract_property(impl_config, "retry_on", on_missing=None)
+    retry_on = action_state.session.resolve(
+        retry_on, (list, int, type(None)), depth=0, on_none=DEFAULT_RETRY_ON
+    )
+
+    if isinstance(retry_on, int):
+        retry_on = [retry_on]
+
+    retry_on = [action_state.session.resolve(x, int) for x in retry_on]
+
+    # Statuses accepted by status_check aren't retried
+    if status_check is not None:
+        retry_on = [x for x in retry_on if x not in status_check]
+
+    # Retry_budget - limit on the total time (in seconds) spent on the request
+    # and its retries. No retry is made if its delay would exceed the budget
+    retry_budget = obslib.extract_property(impl_config, "retry_budget", on_missing=None)
+    retry_budget = action_state.session.resolve(
+        retry_budget, (int, float, type(None)), on_none=DEFAULT_RETRY_BUDGET
+    )
+
+    # Retry_unsafe - whether requests with methods that aren't idempotent, such as
+    # POST and PATCH, are retried after a read timeout. The server may have acted
+    # on the request before the timeout
+    retry_unsafe = obslib.extract_property(impl_config, "retry_unsafe", on_missing=None)
+    retry_unsafe = action_state.session.resolve(
+        retry_unsafe, (bool, type(None)), on_none=False
+    )
+
+    retry = {
+        "retries": retries,
+        "backoff": backoff,
+        "retry_on": retry_on if retries > 0 else [],
+        "retry_budget": retry_budget,
+        "retry_unsafe": retry_unsafe,
+    }
+
+    # Perform request
+    # Connections are reused from earlier requests to the same host
+    session = action_state.get_http_pool().get_session(url, verify)
+    args = {
+        "method": method,
+        "url": url,
+        "headers": headers,
+        "verify": verify,
+    }
+
+    if body is not None:
+        args["data"] = body
+
+    # Send the validators for a cached response, so the server can respond with
+    # 304 (Not Modified) if it hasn't changed
+    http_cache = None
+    cache_entry = None
+    if cache:
+        http_cache = HttpCache(action_state.http_cache_dir)
+
+        lower_headers = {x.lower(): headers[x] for x in headers}
+        cache_key = http_cache.get_key(
+            method,
+            url,
+            {x.lower(): lower_headers.get(x.lower()) for x in cache_headers},
+        )
+
+        cache_entry = http_cache.lookup(cache_key)
+        if cache_entry is not None:
+            args["headers"] = headers.copy()
+            args["headers"].update(http_cache.get_validators(cache_entry))
+
+    # Downloads are read as the content is written to the file and JSON is
+    # decoded as it is read, unless the content is needed for the cache
+    if download != "" or (response_format == "json" and not cache):
+        args["stream"] = True
+
+    response = send_url_request(action_state, session, args, retry)
+
+    with response:
+        logger.debug("Response code: %s", response.status_code)
+
+        # Use the cached response if it hasn't been modified
+        if cache_entry is not None and response.status_code == 304:
+            logger.debug("Using cached response for %s", url)
+
+            status_code = cache_entry["status_code"]
+            val_run(
+                status_check is None or status_code in status_check,
+                f"Status code ({status_code}) not in {status_check}",
+            )
+
+            # Headers sent with the 304 response update the cached headers,
+            # apart from those describing the (empty) 304 body
+            cached_headers = requests.structures.CaseInsensitiveDict(
+                cache_entry["headers"]
+            )
+            for key, value in response.headers.items():
+                if key.lower() not in ("content-length", "transfer-encoding"):
+                    cached_headers[key] = value
+
+            result = {
+                "headers": cached_headers,
+                "status_code": status_code,
+                "cached": True,
+            }
+
+            text = http_cache.load_text(cache_key, cache_entry)
+            if response_format == "text":
+                result["text"] = text
+            else:
+                result["data"] = decode_url_text(
+                    url, text, response_format, select_tokens, select
+                )
+
+            return result
+
+        if status_check is None:
+            # Use default handling for response codes
+            response.raise_for_status()
+        else:
+            if response.status_code not in status_check:
+                raise BdastRunException(
+                    "Status code (%s) not in %s", response.status_code, status_check
+                )
+
+        if download != "":
+            size, sha256 = download_response(action_state, response, download, checksum)
+        elif args.get("stream", False):
+            try:
+                data = decode_json_response(response, select_tokens, select)
+            except ValueError as e:
+                raise BdastRunException(f"Invalid json response from {url}: {e}") from e
+        else:
+            logger.debug("Response text: %s", get_text_preview(response.text))
+
+            if response_format != "text":
+                data = decode_url_text(
+                    url, response.text, response_format, select_tokens, select
+                )
+
+        if http_cache is not None and response.status_code == 200:
+            http_cache.store(cache_key, response)
+
+    # What we should provide back to the caller
+    # For downloads, this is the file details, rather than the content
+    result = {
+        "headers": response.headers,
+        "status_code": response.status_code,
+    }
+
+    if download != "":
+        result["path"] = os.path.abspath(download)
+        result["size"] = size
+        result["sha256"] = sha256
+    elif response_format != "text":
+        result["data"] = data
+    else:
+        result["text"] = response.text
+
+    if cache:
+        result["cached"] = False
+
+    return result
+
+
+def wait_condition(check, end, interval, max_interval, stop):
+    """
+    Call check until it returns True, waiting between calls with exponential
+    backoff and jitter, so concurrent waits don't poll in step.
+    Returns True if the check succeeded, or False if the end time (monotonic) was
+    reached or stop (threading.Event) was set first
+    """
+
+    while not stop.is_set():
+        if check():
+            return True
+
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            return False
+
+        # Wait between half and all of the current interval
+        delay = interval / 2 + random.uniform(0, interval / 2)
+        stop.wait(min(delay, remaining))
+        interval = min(interval * 2, max_interval)
+
+    return False
+
+
+def process_step_wait_for(action_state, impl_config):
+
+    # Check incoming parameters
+    val_arg(
+        isinstance(action_state, ActionState),
+        "Invalid action state passed to process_step_wait_for",
+    )
+    val_arg(
+        isinstance(impl_config, dict),
+        "Invalid impl config passed to process_step_wait_for",
+    )
+
+    # Conditions - list of conditions to wait on. Each condition is one of
+    # 'http' (url), 'tcp' (host:port) or 'file' (path)
+    conditions = obslib.extract_property(impl_config, "conditions")
+    conditions = action_state.session.resolve(conditions, list, depth=0)
+    conditions = [action_state.session.resolve(x, dict, depth=0) for x in conditions]
+    val_run(len(conditions) > 0, "wait_for requires at least one condition")
+
+    # Mode - whether to wait for 'all' conditions or 'any' condition
+    mode = obslib.extract_property(impl_config, "mode", on_missing=None)
+    mode = action_state.session.resolve(mode, (str, type(None)), on_none="all")
+    val_run(mode in ("all", "any"), f"Invalid wait_for mode: {mode}")
+
+    # Timeout - time in seconds to wait for the conditions
+    timeout = obslib.extract_property(impl_config, "timeout", on_missing=None)
+    timeout = action_state.session.resolve(
+        timeout, (int, float, type(None)), on_none=300
+    )
+    val_run(timeout > 0, "wait_for timeout must be greater than 0")
+
+    # Interval - time in seconds between the first checks of a condition. The
+    # interval doubles after each check, up to max_interval
+    interval = obslib.extract_property(impl_config, "interval", on_missing=None)
+    interval = action_state.session.resolve(
+        interval, (int, float, type(None)), on_none=0.5
+    )
+    val_run(interval > 0, "wait_for interval must be greater than 0")
+
+    # Max_interval - limit on the time in seconds between checks of a condition
+    max_interval = obslib.extract_property(impl_config, "max_interval", on_missing=None)
+    max_interval = action_state.session.resolve(
+        max_interval, (int, float, type(None)), on_none=10
+    )
+    val_run(max_interval >= interval, "wait_for max_interval must be at least interval")
+
+    # Store - variable to store the list of whether each condition was satisfied
+    store = obslib.extract_property(impl_config, "store", on_missing=None)
+    store = action_state.session.resolve(store, (str, type(None)))
+
+    checks = []
+    for condition in conditions:
+        # Http - url to request
+        url = obslib.extract_property(condition, "http", on_missing=None)
+        url = action_state.session.resolve(url, (str, type(None)))
+
+        # Status - response codes satisfying the http condition. Any success
+        # response satisfies the condition by default
+        status = obslib.extract_property(condition, "status", on_missing=None)
+        status = action_state.session.resolve(status, (list, int, type(None)), depth=0)
+
+        if isinstance(status, int):
+            status = [status]
+
+        if status is not None:
+            status = [action_state.session.resolve(x, int) for x in status]
+
+        # Body - regex the http response body must match
+        body = obslib.extract_property(condition, "body", on_missing=None)
+        body = action_state.session.resolve(body, (str, type(None)))
+
+        # Verify - whether to verify the certificate for the http condition
+        verify = obslib.extract_property(condition, "verify", on_missing=None)
+        verify = action_state.session.resolve(verify, (bool, type(None)), on_none=True)
+
+        # Tcp - host:port address that must accept connections
+        address = obslib.extract_property(condition, "tcp", on_missing=None)
+        address = action_state.session.resolve(address, (str, type(None)))
+
+        # File - path that must exist
+        path = obslib.extract_property(condition, "file", on_missing=None)
+        path = action_state.session.resolve(path, (str, type(None)))
+
+        val_run(
+            len(condition) == 0,
+            f"Unknown properties in wait_for condition: {condition.keys()}",
+        )
+
+        targets = [x for x in (url, address, path) if x is not None]
+        val_run(
+            len(targets) == 1, "wait_for condition requires one of http, tcp or file"
+        )
+
+        if url is None:
+            val_run(
+                status is None and body is None,
+                "status and body can only be used with an http condition",
+            )
+
+        if url is not None:
+            session = action_state.get_http_pool().get_session(url, verify)
+            body_regex = re.compile(body) if body is not None else None
+            checks.append(
+                (
+                    f"http {url}",
+                    probe_http,
+                    (session, url, verify, status, body_regex),
+                )
+            )
+        elif address is not None:
+            checks.append((f"tcp {address}", probe_tcp, (address,)))
+        else:
+            checks.append((f"file {path}", os.path.exists, (path,)))
+
+    # Limit the wait to the time remaining for the step and action
+    remaining = action_state.time_remaining()
+    if remaining is not None and remaining < timeout:
+        timeout = remaining
+
+    start = time.monotonic()
+    end = start + timeout
+    stop = threading.Event()
+    results = [False] * len(checks)
+
+    def run_check(index, probe, args):
+
+        results[index] = wait_condition(
+            lambda: probe(*args), end, interval, max_interval, stop
+        )
 
-    # Verify - whether to verify certificate for the endpoint
-    verify = obslib.extract_property(impl_config, "verify", on_missing=None)
-    verify = action_state.session.resolve(verify, (bool, type(None)), on_none=True)
+        # Stop the remaining checks once the outcome is known
+        if results[index] == (mode == "any"):
+            stop.set()
 
-    # status check - whether to check the response code from the endpoint
-    status_check = obslib.extract_property(impl_config, "status_check", on_missing=None)
-    status_check = action_state.session.resolve(
-        status_check, (list, int, type(None)), on_none=None
-    )
+        logger.debug(
+            "wait_for condition %s: %s",
+            checks[index][0],
+            "satisfied" if results[index] else "not satisfied",
+        )
 
-    if isinstance(status_check, int):
-        status_check = [status_check]
+    # Each condition is checked on its own schedule, so a slow check doesn't
+    # delay the others
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(checks)) as executor:
+        futures = [
+            executor.submit(run_check, index, probe, args)
+            for index, (_, probe, args) in enumerate(checks)
+        ]
 
-    if status_check is not None:
-        status_check = [action_state.session.resolve(x, int) for x in status_check]
+        for future in futures:
+            future.result()
 
-    # Perform request
-    args = {
-        "method": method,
-        "url": url,
-        "timeout": (10, 30),
-        "headers": headers,
-        "verify": verify,
-    }
+    elapsed = time.monotonic() - start
+    satisfied = any(results) if mode == "any" else all(results)
 
-    if body is not None:
-        args["data"] = body
+    if not satisfied:
+        for (name, _, _), result in zip(checks, results):
+            if not result:
+                log_raw(f"wait_for condition not satisfied: {name}")
 
-    response = requests.request(**args)
+        action_state.check_deadline()
 
-    logger.debug("Response code: %s", response.status_code)
-    logger.debug("Response text: %s", response.text)
+    val_run(satisfied, f"wait_for conditions not satisfied within {timeout} seconds")
 
-    if status_check is None:
-        # Use default handling for response codes
-        response.raise_for_status()
-    else:
-        if response.status_code not in status_check:
-            raise BdastRunException(
-                "Status code (%s) not in %s", response.status_code, status_check
-            )
+    log_raw(f"wait_for conditions satisfied after {elapsed:.2f} seconds")
 
-    # Only store result if requested
     if store is not None and store != "":
-        # What we should provide back to the caller
-        result = {
-            "text": response.text,
-            "headers": response.headers,
-            "status_code": response.status_code,
-        }
-
-        # Update vars with the request result
-        action_state.update_vars({store: result})
+        action_state.update_vars({store: results})
 
 
 def process_step_semver(action_state, impl_config):
@@ -273,6 +2840,365 @@ def process_step_semver(action_state, impl_config):
     logger.warning("No semver matches found")
 
 
+# Parsed packed-refs files, keyed by path. Each entry holds the file modification
+# time and size, with the parsed refs
+PACKED_REFS_CACHE = {}
+
+# Commits referenced by tag objects (or the object itself, for commits), keyed by
+# object id. Objects don't change, so entries remain valid
+PEELED_OBJECT_CACHE = {}
+
+
+def find_git_dirs(path):
+    """
+    Find the git directory for the repository containing path.
+    Returns the git directory, holding HEAD, and the common directory, holding refs
+    and objects. These differ for linked worktrees.
+    """
+
+    # Check incoming parameters
+    val_arg(isinstance(path, str), "Invalid path passed to find_git_dirs")
+
+    current = os.path.abspath(path)
+    while True:
+        candidate = os.path.join(current, ".git")
+
+        if os.path.isdir(candidate):
+            git_dir = candidate
+            break
+
+        # Worktrees and submodules use a file referencing the git directory
+        if os.path.isfile(candidate):
+            with open(candidate, "r", encoding="utf-8") as file:
+                content = file.read().strip()
+
+            val_run(content.startswith("gitdir:"), f"Invalid .git file: {candidate}")
+            git_dir = os.path.join(current, content[len("gitdir:") :].strip())
+            break
+
+        parent = os.path.dirname(current)
+        val_run(parent != current, f"Not a git repository: {path}")
+        current = parent
+
+    common_dir = git_dir
+    commondir_path = os.path.join(git_dir, "commondir")
+    if os.path.isfile(commondir_path):
+        with open(commondir_path, "r", encoding="utf-8") as file:
+            common_dir = os.path.join(git_dir, file.read().strip())
+
+    return os.path.normpath(git_dir), os.path.normpath(common_dir)
+
+
+def read_packed_refs(common_dir):
+    """
+    Return the refs in packed-refs, as a dict of ref names to (object id, peeled
+    object id) tuples. The peeled object id is the commit for the ref, where
+    packed-refs records it, or None otherwise.
+    """
+
+    path = os.path.join(common_dir, "packed-refs")
+
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return {}
+
+    # Use the parsed content from the cache, unless the file has changed
+    cached = PACKED_REFS_CACHE.get(path)
+    if cached is not None and cached[0] == (stat.st_mtime_ns, stat.st_size):
+        return cached[1]
+
+    refs = {}
+    traits = []
+    last_ref = None
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            line = line.rstrip("\n")
+
+            if line.startswith("# pack-refs with:"):
+                traits = line[len("# pack-refs with:") :].split()
+                continue
+
+            if line == "" or line.startswith("#"):
+                continue
+
+            # Peeled object id for the preceding (annotated tag) ref
+            if line.startswith("^"):
+                if last_ref is not None:
+                    refs[last_ref] = (refs[last_ref][0], line[1:])
+                continue
+
+            object_id, _, name = line.partition(" ")
+            refs[name] = (object_id, None)
+            last_ref = name
+
+    # With the peeled traits, refs without a peeled line aren't annotated tags,
+    # so reference the commit directly. 'peeled' only covers tags
+    for name, (object_id, peeled) in refs.items():
+        if peeled is None and (
+            "fully-peeled" in traits
+            or ("peeled" in traits and name.startswith("refs/tags/"))
+        ):
+            refs[name] = (object_id, object_id)
+
+    PACKED_REFS_CACHE[path] = ((stat.st_mtime_ns, stat.st_size), refs)
+
+    return refs
+
+
+def read_loose_refs(common_dir, prefix):
+    """
+    Return the loose refs under the prefix (e.g. 'refs/tags'), as a dict of ref
+    names to object ids
+    """
+
+    refs = {}
+    base = os.path.join(common_dir, *prefix.split("/"))
+
+    for root, _, files in os.walk(base):
+        for name in files:
+            path = os.path.join(root, name)
+            ref = "/".join([prefix] + os.path.relpath(path, base).split(os.sep))
+
+            with open(path, "r", encoding="utf-8") as file:
+                value = file.read().strip()
+
+            # Symbolic refs aren't expected here, so are ignored
+            if re.fullmatch("[0-9a-f]{40,64}", value) is not None:
+                refs[ref] = value
+
+    return refs
+
+
+# Limit on the symbolic refs followed when resolving a ref, as used by git
+MAX_SYMREF_DEPTH = 5
+
+
+def resolve_git_ref(common_dir, ref):
+    """
+    Return the object id for the ref, or None if the ref doesn't exist
+    """
+
+    for _ in range(MAX_SYMREF_DEPTH + 1):
+        path = os.path.join(common_dir, *ref.split("/"))
+        if not os.path.isfile(path):
+            packed = read_packed_refs(common_dir).get(ref)
+            return packed[0] if packed is not None else None
+
+        with open(path, "r", encoding="utf-8") as file:
+            value = file.read().strip()
+
+        if not value.startswith("ref:"):
+            return value
+
+        ref = value[len("ref:") :].strip()
+
+    raise BdastRunException(
+        f"Symbolic refs nested more than {MAX_SYMREF_DEPTH} deep at {ref}"
+    )
+
+
+def read_loose_object(common_dir, object_id, content_types=("tag",)):
+    """
+    Return the type and content of a loose object, or None if the object isn't
+    stored as a loose object (e.g. it is in a pack). Only the header is decompressed
+    for objects not in content_types, with the content returned as None.
+    """
+
+    path = os.path.join(common_dir, "objects", object_id[:2], object_id[2:])
+
+    try:
+        with open(path, "rb") as file:
+            compressed = file.read()
+    except FileNotFoundError:
+        return None
+
+    decompressor = zlib.decompressobj()
+    data = decompressor.decompress(compressed, 32)
+
+    header, _, _ = data.partition(b"\0")
+    object_type = header.partition(b" ")[0].decode("ascii")
+
+    if object_type not in content_types:
+        return object_type, None
+
+    data = zlib.decompress(compressed)
+
+    return object_type, data.partition(b"\0")[2]
+
+
+def peel_git_object(common_dir, object_id):
+    """
+    Follow annotated tag objects, which may reference other tags, to the commit.
+    Returns None if an object isn't available as a loose object
+    """
+
+    chain = []
+    target = object_id
+
+    while target not in PEELED_OBJECT_CACHE:
+        loose = read_loose_object(common_dir, target)
+        if loose is None:
+            return None
+
+        object_type, content = loose
+        if object_type != "tag":
+            PEELED_OBJECT_CACHE[target] = target
+            break
+
+        # The tag object starts with the referenced object id
+        first_line = content.split(b"\n", 1)[0].decode("ascii")
+        val_run(first_line.startswith("object "), f"Invalid tag object: {target}")
+
+        chain.append(target)
+        target = first_line[len("object ") :]
+
+    commit = PEELED_OBJECT_CACHE[target]
+    for item in chain:
+        PEELED_OBJECT_CACHE[item] = commit
+
+    return commit
+
+
+def peel_git_tags(git_dir, common_dir, tags):
+    """
+    Resolve tags to the commits they reference. tags is a dict of tag names to
+    (object id, peeled object id) tuples.
+    Annotated tag objects are read from the loose object store. The git binary is
+    only used for objects that can't be read directly, such as packed objects.
+    Returns a dict of tag names to commit ids.
+    """
+
+    commits = {}
+    unresolved = {}
+
+    for name, (object_id, peeled) in tags.items():
+        if peeled is None:
+            peeled = peel_git_object(common_dir, object_id)
+
+        if peeled is None:
+            unresolved[name] = object_id
+        else:
+            commits[name] = peeled
+
+    if len(unresolved) > 0:
+        logger.debug("Resolving %s tags with git: %s", len(unresolved), unresolved)
+
+        object_ids = list(dict.fromkeys(unresolved.values()))
+        try:
+            proc = subprocess.run(
+                ["git", f"--git-dir={git_dir}", "rev-parse"]
+                + [f"{x}^{{}}" for x in object_ids],
+                check=False,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True,
+            )
+        except OSError as e:
+            raise BdastRunException(
+                f"Tags {sorted(unresolved.keys())} reference packed objects, which "
+                f"require the git binary to resolve: {e}"
+            ) from e
+        val_run(
+            proc.returncode == 0,
+            f"git rev-parse failed resolving tags: {proc.stderr.strip()}",
+        )
+
+        peeled = dict(zip(object_ids, proc.stdout.split()))
+        PEELED_OBJECT_CACHE.update(peeled)
+
+        for name, object_id in unresolved.items():
+            commits[name] = peeled[object_id]
+
+    return commits
+
+
+def get_version_sort_key(value):
+    """
+    Sort key ordering numeric components by value, so 'v1.10' sorts after 'v1.9'
+    """
+
+    return [
+        (0, int(x), "") if x.isdigit() else (1, 0, x)
+        for x in re.split(r"(\d+)", value)
+        if x != ""
+    ]
+
+
+def process_step_git(action_state, impl_config):
+
+    # Check incoming parameters
+    val_arg(
+        isinstance(action_state, ActionState),
+        "Invalid action state passed to process_step_git",
+    )
+    val_arg(
+        isinstance(impl_config, dict),
+        "Invalid impl config passed to process_step_git",
+    )
+
+    # Path - path within the repository
+    path = obslib.extract_property(impl_config, "path", on_missing=None)
+    path = action_state.session.resolve(path, (str, type(None)), on_none=".")
+
+    # Store - variable to store the repository information
+    store = obslib.extract_property(impl_config, "store")
+    store = action_state.session.resolve(store, str)
+    val_run(store != "", "store must have a value")
+
+    git_dir, common_dir = find_git_dirs(path)
+    logger.debug("Git directory: %s, common directory: %s", git_dir, common_dir)
+
+    # HEAD is either a reference to a branch or, when detached, a commit id
+    with open(os.path.join(git_dir, "HEAD"), "r", encoding="utf-8") as file:
+        head = file.read().strip()
+
+    branch = ""
+    if head.startswith("ref:"):
+        head_ref = head[len("ref:") :].strip()
+        if head_ref.startswith("refs/heads/"):
+            branch = head_ref[len("refs/heads/") :]
+
+        # An unborn branch has no commit
+        commit = resolve_git_ref(common_dir, head_ref) or ""
+    else:
+        commit = head
+
+    # Loose refs take precedence over packed refs with the same name
+    tags = {
+        name: value
+        for name, value in read_packed_refs(common_dir).items()
+        if name.startswith("refs/tags/")
+    }
+    for name, object_id in read_loose_refs(common_dir, "refs/tags").items():
+        tags[name] = (object_id, None)
+
+    tag_commits = peel_git_tags(git_dir, common_dir, tags)
+    tag_commits = {
+        name[len("refs/tags/") :]: value for name, value in tag_commits.items()
+    }
+
+    tag_names = sorted(tag_commits.keys(), key=get_version_sort_key)
+
+    result = {
+        "branch": branch,
+        "commit": commit,
+        "short_commit": commit[:7],
+        "detached": not head.startswith("ref:"),
+        "head_tags": [
+            x for x in tag_names if commit != "" and tag_commits[x] == commit
+        ],
+        "tags": tag_names,
+    }
+
+    log_raw(
+        f"GIT branch: {result['branch']}, commit: {result['commit']}, "
+        f"tags: {result['head_tags']}"
+    )
+
+    action_state.update_vars({store: result})
+
+
 def process_step_command(action_state, impl_config, step_type):
 
     # Check incoming parameters
@@ -302,6 +3228,58 @@ def process_step_command(action_state, impl_config, step_type):
     )
     capture_strip = action_state.session.resolve(capture_strip, bool)
 
+    # Capture_max_bytes - limit on the captured output. Only the beginning and end
+    # of the output are kept beyond this
+    capture_max_bytes = obslib.extract_property(
+        impl_config, "capture_max_bytes", on_missing=None
+    )
+    capture_max_bytes = action_state.session.resolve(
+        capture_max_bytes, (int, type(None))
+    )
+    val_run(
+        capture_max_bytes is None or capture_max_bytes > 0,
+        "capture_max_bytes must be greater than zero",
+    )
+
+    # Capture_file - file to write the command output to, rather than the console.
+    # With capture, the path and size of the file are stored, rather than the output
+    capture_file = obslib.extract_property(impl_config, "capture_file", on_missing=None)
+    capture_file = action_state.session.resolve(capture_file, (str, type(None)))
+
+    if capture_file is not None and capture_file != "":
+        val_run(
+            not capture_strip and capture_max_bytes is None,
+            "capture_strip and capture_max_bytes can't be used with capture_file",
+        )
+
+    # Reuse_interpreter - whether to run the script in a long running interpreter
+    # shared with other steps, rather than starting a new interpreter
+    reuse_interpreter = obslib.extract_property(
+        impl_config, "reuse_interpreter", on_missing=False
+    )
+    reuse_interpreter = action_state.session.resolve(reuse_interpreter, bool)
+
+    if reuse_interpreter:
+        val_run(
+            step_type in ("bash", "pwsh"),
+            "reuse_interpreter is only supported for bash and pwsh steps",
+        )
+        val_run(
+            capture_file is None or capture_file == "",
+            "capture_file can't be used with reuse_interpreter",
+        )
+
+    # Resources - variable to store the resources (CPU time, peak memory, I/O)
+    # used by the command
+    resources = obslib.extract_property(impl_config, "resources", on_missing=None)
+    resources = action_state.session.resolve(resources, (str, type(None)))
+
+    if reuse_interpreter:
+        val_run(
+            resources is None or resources == "",
+            "resources can't be used with reuse_interpreter",
+        )
+
     # Command line
     # This is mandatory
     cmd = obslib.extract_property(impl_config, "cmd")
@@ -313,21 +3291,26 @@ def process_step_command(action_state, impl_config, step_type):
     for key in new_envs:
         new_envs[key] = action_state.session.resolve(new_envs[key], str)
 
-    envs = os.environ.copy()
-    envs.update(new_envs)
+    # Process environment
+    envs = action_state.get_process_env(new_envs)
 
-    # Arguments to subprocess.run
+    # Arguments to subprocess.Popen
     subprocess_args = {
         "env": envs,
         "stdout": None,
         "stderr": subprocess.STDOUT,
         "shell": shell,
-        "text": True,
     }
 
-    # If we're capturing, stdout should come back via pipe
-    if capture is not None and capture != "":
-        subprocess_args["stdout"] = subprocess.PIPE
+    # If we're capturing to a file, stdout is written directly to the file by the
+    # process. Error output is still displayed
+    # Otherwise, if we're capturing, stdout is read back via a pipe while the
+    # command runs
+    output = None
+    if capture_file is not None and capture_file != "":
+        subprocess_args["stderr"] = None
+    elif capture is not None and capture != "":
+        output = CaptureBuffer(action_state, max_bytes=capture_max_bytes)
 
     # Override interpreter if the type is bash or pwsh
     if step_type == "command":
@@ -347,9 +3330,10 @@ def process_step_command(action_state, impl_config, step_type):
         raise BdastRunException(f"Unknown cmd type on command: {str(step_type)}")
 
     # If an interpreter is defined, this is the executable to call instead
+    input_text = None
     if interpreter is not None and interpreter != "":
         call_args = interpreter
-        subprocess_args["input"] = cmd
+        input_text = cmd
     else:
         call_args = cmd
         subprocess_args["stdin"] = subprocess.DEVNULL
@@ -364,30 +3348,350 @@ def process_step_command(action_state, impl_config, step_type):
     debug_args["env"] = "*hidden*"
     logger.debug("Subprocess args: %s", debug_args)
 
-    sys.stdout.flush()
-    proc = subprocess.run(call_args, check=False, **subprocess_args)
+    # Time remaining for the step and action
+    timeout = action_state.time_remaining()
+
+    # Resources used by the process. These aren't known for scripts run in a
+    # reused interpreter
+    usage = None
+
+    if reuse_interpreter:
+        returncode = action_state.get_interpreter_pool().run(
+            step_type, envs, cmd, output, timeout
+        )
+        val_run(returncode is not None, action_state.timeout_message())
+    elif capture_file is not None and capture_file != "":
+        with open(capture_file, "wb") as file:
+            subprocess_args["stdout"] = file
+            returncode, usage = run_process(
+                action_state,
+                call_args,
+                subprocess_args,
+                input_text=input_text,
+                timeout=timeout,
+            )
+    else:
+        returncode, usage = run_process(
+            action_state,
+            call_args,
+            subprocess_args,
+            input_text=input_text,
+            output=output,
+            timeout=timeout,
+        )
+
+    # Report resource usage, whether or not the process succeeded
+    if usage is not None:
+        log_raw(f"**************** RESOURCES: {format_resource_usage(usage)}")
+
+    if resources is not None and resources != "":
+        action_state.update_vars({resources: usage})
 
     # Check if the process failed
-    if proc.returncode != 0:
-        # If the subprocess was called with stdout PIPE, output it here
-        if subprocess_args["stdout"] is not None:
-            log_raw(str(proc.stdout))
+    # Any captured output has already been displayed while the command ran
+    if returncode != 0:
+        if output is not None:
+            output.close()
+
+        raise BdastRunException(f"Process exited with non-zero exit code: {returncode}")
+
+    # Capture the output, if requested
+    if capture is None or capture == "":
+        return
+
+    if capture_file is not None and capture_file != "":
+        stdout_capture = {
+            "path": os.path.abspath(capture_file),
+            "size": os.path.getsize(capture_file),
+        }
+    else:
+        stdout_capture = output.result(strip=capture_strip)
+
+    # Update the action state vars with the result of the command
+    action_state.update_vars({capture: stdout_capture})
+
+
+def process_step_service(action_state, impl_config):
+
+    # Check incoming parameters
+    val_arg(
+        isinstance(action_state, ActionState),
+        "Invalid ActionState passed to process_step_service",
+    )
+    val_arg(
+        isinstance(impl_config, dict),
+        "Invalid impl config passed to process_step_service",
+    )
+
+    # Shell - Whether to use shell parsing for the command
+    shell = obslib.extract_property(impl_config, "shell", on_missing=False)
+    shell = action_state.session.resolve(shell, bool)
+
+    # Command line
+    # This is mandatory
+    cmd = obslib.extract_property(impl_config, "cmd")
+    cmd = action_state.session.resolve(cmd, str)
+
+    # Environment variables
+    new_envs = obslib.extract_property(impl_config, "env", on_missing=None)
+    new_envs = action_state.session.resolve(new_envs, (dict, type(None)), on_none={})
+    for key in new_envs:
+        new_envs[key] = action_state.session.resolve(new_envs[key], str)
+
+    # Stop_after - step after which the service is stopped. A '+' reference is the
+    # end of the group. Without this, the service runs until the action ends
+    stop_after = obslib.extract_property(impl_config, "stop_after", on_missing=None)
+    stop_after = action_state.session.resolve(stop_after, (str, type(None)))
+    if stop_after is not None and stop_after.startswith("+"):
+        stop_after = stop_after[1:] + ":end"
+
+    # Ready - probe to wait on before the step completes
+    ready = obslib.extract_property(impl_config, "ready", on_missing=None)
+    ready = action_state.session.resolve(ready, (dict, type(None)), depth=0, on_none={})
+
+    # Ready tcp - 'host:port' address accepting connections
+    probe_address = obslib.extract_property(ready, "tcp", on_missing=None)
+    probe_address = action_state.session.resolve(probe_address, (str, type(None)))
+
+    # Ready http - url returning a successful response
+    probe_url = obslib.extract_property(ready, "http", on_missing=None)
+    probe_url = action_state.session.resolve(probe_url, (str, type(None)))
+
+    # Ready verify - whether to verify the certificate for the http probe
+    probe_verify = obslib.extract_property(ready, "verify", on_missing=None)
+    probe_verify = action_state.session.resolve(
+        probe_verify, (bool, type(None)), on_none=True
+    )
+
+    # Ready log - regex matching a line of service output
+    probe_log = obslib.extract_property(ready, "log", on_missing=None)
+    probe_log = action_state.session.resolve(probe_log, (str, type(None)))
+
+    # Ready file - path to a file created by the service
+    probe_file = obslib.extract_property(ready, "file", on_missing=None)
+    probe_file = action_state.session.resolve(probe_file, (str, type(None)))
+
+    # Ready timeout - time in seconds to wait for the service to be ready
+    ready_timeout = obslib.extract_property(ready, "timeout", on_missing=None)
+    ready_timeout = action_state.session.resolve(
+        ready_timeout, (int, float, type(None)), on_none=60
+    )
+    val_run(ready_timeout > 0, "Service ready timeout must be greater than 0")
+
+    # Validate no unknown ready properties
+    val_run(len(ready) == 0, f"Unknown properties in service ready: {ready.keys()}")
+
+    probes = [
+        x for x in (probe_address, probe_url, probe_log, probe_file) if x is not None
+    ]
+    val_run(len(probes) <= 1, "Service ready accepts a single probe")
+
+    # Arguments to subprocess.Popen
+    subprocess_args = {
+        "env": action_state.get_process_env(new_envs),
+        "shell": shell,
+    }
+
+    call_args = cmd
+    if not shell:
+        call_args = shlex.split(call_args)
+
+    logger.debug("Service call arguments: %s", call_args)
+
+    log_pattern = None
+    if probe_log is not None:
+        log_pattern = re.compile(probe_log)
+
+    service = ServiceProcess(call_args, subprocess_args, log_pattern=log_pattern)
+    action_state.add_service(service, stop_after)
+    logger.info("Started service process %s", service.pid)
+
+    # Wait for the service, within the time remaining for the step and action
+    remaining = action_state.time_remaining()
+    if remaining is not None and remaining < ready_timeout:
+        ready_timeout = remaining
+
+    if probe_address is not None:
+        service.wait_ready(lambda: probe_tcp(probe_address), ready_timeout)
+    elif probe_url is not None:
+        # The probe must reach the service itself, so it doesn't use the http pool,
+        # which may record or replay responses
+        with requests.Session() as session:
+            service.wait_ready(
+                lambda: probe_http(session, probe_url, probe_verify), ready_timeout
+            )
+    elif probe_log is not None:
+        service.wait_ready(lambda: service.log_matched, ready_timeout)
+    elif probe_file is not None:
+        service.wait_ready(lambda: os.path.exists(probe_file), ready_timeout)
+
+
+def run_concurrent(action_state, tasks, max_parallel=None, fail_fast=False):
+    """
+    Run tasks concurrently. Each task is a callable run with its own fork of the
+    action state (see ActionState fork). Output from each task is buffered and
+    displayed in one piece when the task finishes.
+    With fail_fast, tasks not yet started are skipped once a task fails. Tasks
+    already running are left to finish.
+    Returns a list of (action state, exception) tuples, in task order. The exception
+    is None for successful tasks and the action state is None for skipped tasks.
+    """
+
+    # Check incoming parameters
+    val_arg(
+        isinstance(action_state, ActionState),
+        "Invalid action state passed to run_concurrent",
+    )
+    val_arg(isinstance(tasks, list), "Invalid tasks passed to run_concurrent")
+    val_arg(
+        isinstance(max_parallel, (int, type(None))),
+        "Invalid max_parallel passed to run_concurrent",
+    )
+    val_arg(isinstance(fail_fast, bool), "Invalid fail_fast passed to run_concurrent")
+
+    if len(tasks) == 0:
+        return []
+
+    if max_parallel is None:
+        max_parallel = len(tasks)
+
+    val_run(max_parallel > 0, "max_parallel must be greater than 0")
+
+    # Output from the tasks is added to the output buffer for this thread, if there
+    # is one, so it stays with the output of the enclosing task
+    parent_parts = getattr(OUTPUT_BUFFER, "parts", None)
+    failed = threading.Event()
+
+    def run_task(task, task_state):
+
+        if fail_fast and failed.is_set():
+            return None, None
+
+        OUTPUT_BUFFER.parts = []
+        error = None
+
+        try:
+            task(task_state)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            error = e
+            failed.set()
+        finally:
+            output = "".join(OUTPUT_BUFFER.parts)
+            OUTPUT_BUFFER.parts = None
+
+            with OUTPUT_LOCK:
+                if parent_parts is not None:
+                    parent_parts.append(output)
+                else:
+                    sys.stdout.write(output)
+                    sys.stdout.flush()
+
+        return task_state, error
+
+    sys.stdout.flush()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        futures = [executor.submit(run_task, x, action_state.fork()) for x in tasks]
+
+        return [x.result() for x in futures]
+
+
+def get_matrix_key(combination):
+
+    # Check incoming parameters
+    val_arg(
+        isinstance(combination, dict), "Invalid combination passed to get_matrix_key"
+    )
+
+    return ",".join(f"{name}={value}" for name, value in combination.items())
+
+
+def process_step_matrix(action_state, impl_config):
+
+    # Check incoming parameters
+    val_arg(
+        isinstance(action_state, ActionState),
+        "Invalid ActionState passed to process_step_matrix",
+    )
+    val_arg(
+        isinstance(impl_config, dict),
+        "Invalid impl config passed to process_step_matrix",
+    )
+
+    # Axes - names and lists of values. The step is run for each combination
+    # of values
+    axes = obslib.extract_property(impl_config, "axes")
+    axes = action_state.session.resolve(axes, dict, depth=0)
+    val_run(len(axes) > 0, "Matrix step requires at least one axis")
+
+    for name in axes:
+        values = action_state.session.resolve(axes[name], list, depth=0)
+        axes[name] = [action_state.session.resolve(x) for x in values]
+        val_run(len(axes[name]) > 0, f"Matrix axis has no values: {name}")
+
+    # Step - step definition to run for each combination. The combination is
+    # available to the step in the 'matrix' var
+    # The step is templated when each combination is run
+    step_def = obslib.extract_property(impl_config, "step")
+    step_def = action_state.session.resolve(step_def, dict, depth=0)
+
+    # Max_parallel - limit on the number of combinations run at once
+    max_parallel = obslib.extract_property(impl_config, "max_parallel", on_missing=None)
+    max_parallel = action_state.session.resolve(max_parallel, (int, type(None)))
+
+    # Fail_fast - whether to stop starting combinations once one fails
+    fail_fast = obslib.extract_property(impl_config, "fail_fast", on_missing=None)
+    fail_fast = action_state.session.resolve(
+        fail_fast, (bool, type(None)), on_none=True
+    )
+
+    # Store - variable to store the vars set by each combination, keyed by
+    # combination
+    store = obslib.extract_property(impl_config, "store", on_missing=None)
+    store = action_state.session.resolve(store, (str, type(None)))
+
+    combinations = [
+        dict(zip(axes.keys(), values)) for values in itertools.product(*axes.values())
+    ]
+
+    def run_combination(combination, task_state):
+
+        task_state.update_vars({"matrix": combination})
+
+        step_obj = BdastStep(copy.deepcopy(step_def), task_state, support_deps=False)
+        if step_obj.name == "":
+            step_obj.name = get_matrix_key(combination)
+
+        step_obj.run()
+
+    tasks = [
+        lambda task_state, x=combination: run_combination(x, task_state)
+        for combination in combinations
+    ]
 
-        raise BdastRunException(
-            f"Process exited with non-zero exit code: {proc.returncode}"
-        )
+    results = run_concurrent(action_state, tasks, max_parallel, fail_fast)
 
-    # Capture the output, if requested
-    if capture is not None and capture != "":
-        stdout_capture = str(proc.stdout)
+    # Report all failures before failing the step
+    failures = 0
+    for combination, (_, error) in zip(combinations, results):
+        if error is not None:
+            failures += 1
+            log_raw(
+                f"Matrix combination failed: {get_matrix_key(combination)}: {error}"
+            )
 
-        if capture_strip:
-            stdout_capture = stdout_capture.strip()
+    val_run(
+        failures == 0,
+        f"{failures} of {len(combinations)} matrix combinations failed",
+    )
 
-        # Update the action state vars with the result of the command
-        action_state.update_vars({capture: stdout_capture})
+    if store is not None and store != "":
+        result = {}
+        for combination, (task_state, _) in zip(combinations, results):
+            updates = task_state.var_updates.copy()
+            updates.pop("matrix", None)
+            result[get_matrix_key(combination)] = updates
 
-        log_raw(stdout_capture)
+        action_state.update_vars({store: result})
 
 
 def process_step_block(action_state, impl_config):
@@ -407,6 +3711,35 @@ def process_step_block(action_state, impl_config):
     steps = action_state.session.resolve(steps, (list, type(None)), depth=0, on_none=[])
     steps = [action_state.session.resolve(x, dict, depth=0) for x in steps]
 
+    # Parallel - whether to run the steps concurrently
+    parallel = obslib.extract_property(impl_config, "parallel", on_missing=None)
+    parallel = action_state.session.resolve(parallel, (bool, type(None)), on_none=False)
+
+    # Max_parallel - limit on the number of steps run at once
+    max_parallel = obslib.extract_property(impl_config, "max_parallel", on_missing=None)
+    max_parallel = action_state.session.resolve(max_parallel, (int, type(None)))
+
+    # Fail_fast - whether to stop starting steps once one fails. Defaults to true
+    fail_fast = obslib.extract_property(impl_config, "fail_fast", on_missing=None)
+    fail_fast = action_state.session.resolve(fail_fast, (bool, type(None)))
+
+    if not parallel:
+        val_run(
+            max_parallel is None,
+            "max_parallel can only be used with parallel on a block step",
+        )
+        val_run(
+            fail_fast is None,
+            "fail_fast can only be used with parallel on a block step",
+        )
+
+    if parallel:
+        if fail_fast is None:
+            fail_fast = True
+
+        run_block_parallel(action_state, steps, max_parallel, fail_fast)
+        return
+
     # For each of the steps, create a BdastStep
     # Dependencies aren't supported on these steps
     inline_step_count = 1
@@ -418,6 +3751,37 @@ def process_step_block(action_state, impl_config):
         step_obj.run()
 
 
+def run_block_parallel(action_state, steps, max_parallel, fail_fast):
+
+    # Check incoming parameters
+    val_arg(isinstance(steps, list), "Invalid steps passed to run_block_parallel")
+
+    def run_step(step_def, task_state):
+
+        # Dependencies aren't supported on these steps
+        step_obj = BdastStep(step_def, task_state, support_deps=False)
+        step_obj.run()
+
+    tasks = [lambda task_state, x=item: run_step(x, task_state) for item in steps]
+
+    results = run_concurrent(action_state, tasks, max_parallel, fail_fast)
+
+    # Merge vars set by the steps in the order the steps are declared, so later
+    # steps take precedence, as when run in sequence
+    errors = []
+    for task_state, error in results:
+        if error is not None:
+            errors.append(error)
+        elif task_state is not None:
+            action_state.update_vars(task_state.var_updates)
+
+    if len(errors) > 0:
+        for error in errors[1:]:
+            log_raw(f"Block step failed: {error}")
+
+        raise errors[0]
+
+
 def process_step_vars(action_state, impl_config):
 
     # Check incoming parameters
@@ -430,16 +3794,265 @@ def process_step_vars(action_state, impl_config):
         "Invalid impl config passed to process_step_command",
     )
 
-    # Extract steps to execute
+    # Extract vars to set. Vars in the set may reference each other
     set_vars = obslib.extract_property(impl_config, "set", on_missing=None)
-    set_vars = action_state.session.resolve(set_vars, (dict, type(None)), on_none={})
+    set_vars = action_state.session.resolve(
+        set_vars, (dict, type(None)), depth=0, on_none={}
+    )
+    set_vars = resolve_vars(action_state.session, set_vars)
 
     # Update vars for action state
     action_state.update_vars(set_vars)
 
 
+class VarsView(collections.abc.Mapping):
+    """
+    Read only view of the action vars, for python steps. Values are resolved when
+    they are accessed, as when referenced from a template.
+    """
+
+    def __init__(self, session):
+
+        # Check incoming parameters
+        val_arg(
+            isinstance(session, obslib.Session), "Invalid session passed to VarsView"
+        )
+
+        self._session = session
+
+    def __getitem__(self, key):
+
+        value = copy.deepcopy(self._session.vars[key])
+
+        if key in EVAL_IGNORE_VARS:
+            return value
+
+        return self._session.resolve(value)
+
+    def __iter__(self):
+        return iter(self._session.vars)
+
+    def __len__(self):
+        return len(self._session.vars)
+
+    def snapshot(self):
+        """
+        Resolve all vars that can be resolved now, for passing to another process.
+        Vars that can't be resolved yet (e.g. referencing vars set by later steps)
+        are left out.
+        """
+
+        result = {}
+        for key in self:
+            try:
+                result[key] = self[key]
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                logger.debug("Var '%s' not passed to python step: %s", key, e)
+
+        return result
+
+
+def load_python_function(reference):
+
+    # Check incoming parameters
+    val_arg(
+        isinstance(reference, str), "Invalid reference passed to load_python_function"
+    )
+
+    module_name, _, attr_name = reference.partition(":")
+    val_run(
+        module_name != "" and attr_name != "",
+        f"Python function reference is not in 'module:function' form: {reference}",
+    )
+
+    # Modules are imported with the working directory on the path, as for 'python -m'
+    added_path = os.getcwd() not in sys.path
+    if added_path:
+        sys.path.insert(0, os.getcwd())
+
+    try:
+        target = importlib.import_module(module_name)
+    finally:
+        if added_path:
+            sys.path.remove(os.getcwd())
+
+    for name in attr_name.split("."):
+        target = getattr(target, name)
+
+    val_run(callable(target), f"Python function reference is not callable: {reference}")
+
+    return target
+
+
+# Runs a python step in a separate interpreter. The request (code or function, args and
+# vars) is read from stdin as JSON and the result is written as JSON to the file named
+# by the first argument
+PYTHON_RUNNER = """import importlib
+import json
+import sys
+
+request = json.load(sys.stdin)
+step_vars = request["vars"]
+
+if request["code"] is not None:
+    namespace = {"__name__": "__bdast__", "vars": step_vars}
+    exec(compile(request["code"], "<python step>", "exec"), namespace)
+    result = namespace.get("result")
+else:
+    module_name, _, attr_name = request["function"].partition(":")
+    target = importlib.import_module(module_name)
+    for name in attr_name.split("."):
+        target = getattr(target, name)
+
+    result = target(step_vars, **request["args"])
+
+with open(sys.argv[1], "w", encoding="utf-8") as file:
+    json.dump(result, file)
+"""
+
+
+def process_step_python(action_state, impl_config):
+
+    # Check incoming parameters
+    val_arg(
+        isinstance(action_state, ActionState),
+        "Invalid ActionState passed to process_step_python",
+    )
+    val_arg(
+        isinstance(impl_config, dict),
+        "Invalid impl config passed to process_step_python",
+    )
+
+    # Code - python source to run. The code can read vars through 'vars' and set
+    # 'result' to a dict of vars to update
+    # The code isn't templated, as braces are common in python source
+    code = obslib.extract_property(impl_config, "code", on_missing=None)
+    code = action_state.session.resolve(code, (str, type(None)), template=False)
+
+    # Function - 'module:function' reference to a function to call with the vars.
+    # The function returns a dict of vars to update, or None
+    function = obslib.extract_property(impl_config, "function", on_missing=None)
+    function = action_state.session.resolve(function, (str, type(None)))
+
+    # Args - keyword arguments for the function
+    args = obslib.extract_property(impl_config, "args", on_missing=None)
+    args = action_state.session.resolve(args, (dict, type(None)), on_none={})
+
+    # Isolate - whether to run in a separate python process, rather than in-process
+    isolate = obslib.extract_property(impl_config, "isolate", on_missing=None)
+    isolate = action_state.session.resolve(isolate, (bool, type(None)), on_none=False)
+
+    # Check parameters
+    val_run(
+        (code is None) != (function is None),
+        "Python step requires exactly one of 'code' or 'function'",
+    )
+    val_run(
+        function is not None or len(args) == 0,
+        "'args' can only be used with 'function' on a python step",
+    )
+
+    step_vars = VarsView(action_state.session)
+
+    if isolate:
+        result = run_python_isolated(action_state, code, function, args, step_vars)
+    elif code is not None:
+        namespace = {"__name__": "__bdast__", "vars": step_vars}
+        exec(compile(code, "<python step>", "exec"), namespace)
+        result = namespace.get("result")
+    else:
+        result = load_python_function(function)(step_vars, **args)
+
+    # Merge any result in to the vars
+    val_run(
+        isinstance(result, (dict, type(None))),
+        f"Python step result is not a dict: {type(result)}",
+    )
+
+    if result is not None:
+        action_state.update_vars(result)
+
+
+def get_json_value(value, name):
+    """
+    Convert value to the JSON types, for passing to another process. Mappings
+    (e.g. url response headers) become dicts, sequences become lists and spilled
+    text is read back. name identifies the value in errors.
+    """
+
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return value
+
+    if isinstance(value, SpilledText):
+        return value.read()
+
+    if isinstance(value, collections.abc.Mapping):
+        return {
+            str(key): get_json_value(item, f"{name}.{key}")
+            for key, item in value.items()
+        }
+
+    if isinstance(value, (collections.abc.Sequence, collections.abc.Set)) and not (
+        isinstance(value, (bytes, bytearray))
+    ):
+        return [
+            get_json_value(item, f"{name}[{index}]") for index, item in enumerate(value)
+        ]
+
+    raise BdastRunException(
+        f"Var {name} can't be passed to an isolated python step: "
+        f"unsupported type {type(value).__name__}"
+    )
+
+
+def run_python_isolated(action_state, code, function, args, step_vars):
+
+    # Check incoming parameters
+    val_arg(
+        isinstance(step_vars, VarsView),
+        "Invalid vars passed to run_python_isolated",
+    )
+
+    request = {
+        "code": code,
+        "function": function,
+        "args": get_json_value(args, "args"),
+        "vars": {
+            key: get_json_value(value, key)
+            for key, value in step_vars.snapshot().items()
+        },
+    }
+
+    input_text = json.dumps(request)
+
+    handle, result_path = tempfile.mkstemp(prefix="bdast_python_", suffix=".json")
+    os.close(handle)
+
+    try:
+        returncode, _ = run_process(
+            action_state,
+            [sys.executable, "-c", PYTHON_RUNNER, result_path],
+            {
+                "env": action_state.get_process_env({}),
+                "stdout": None,
+                "stderr": subprocess.STDOUT,
+            },
+            input_text=input_text,
+            timeout=action_state.time_remaining(),
+        )
+
+        val_run(
+            returncode == 0, f"Python step exited with non-zero exit code: {returncode}"
+        )
+
+        with open(result_path, "r", encoding="utf-8") as file:
+            return json.load(file)
+    finally:
+        os.remove(result_path)
+
+
 class ActionState:
-    def __init__(self, action_name, action_arg):
+    def __init__(self, action_name, action_arg, run_options=None):
 
         # Check incoming parameters
         val_arg(
@@ -447,10 +4060,123 @@ class ActionState:
         )
         val_arg(action_name != "", "Empty action name passed to ActionState")
         val_arg(isinstance(action_arg, str), "Invalid action arg passed to ActionState")
+        val_arg(
+            isinstance(run_options, (dict, type(None))),
+            "Invalid run options passed to ActionState",
+        )
 
         self.action_name = action_name
         self.action_arg = action_arg
 
+        # Duplicate the run options to allow validation of keys
+        run_options = {} if run_options is None else run_options.copy()
+
+        # Spill threshold - size above which captured values are stored on disk
+        # A value of 0 disables spilling
+        self.spill_threshold = obslib.extract_property(
+            run_options, "spill_threshold", on_missing=None
+        )
+        self.spill_threshold = obslib.coerce_value(
+            self.spill_threshold, (int, type(None))
+        )
+        if self.spill_threshold is None:
+            self.spill_threshold = DEFAULT_SPILL_THRESHOLD
+        val_arg(self.spill_threshold >= 0, "spill_threshold must not be negative")
+
+        # Http_pool_size - connections kept open to each host by url steps
+        self.http_pool_size = obslib.extract_property(
+            run_options, "http_pool_size", on_missing=None
+        )
+        self.http_pool_size = obslib.coerce_value(
+            self.http_pool_size, (int, type(None))
+        )
+        if self.http_pool_size is None:
+            self.http_pool_size = DEFAULT_HTTP_POOL_SIZE
+        val_arg(self.http_pool_size > 0, "http_pool_size must be greater than 0")
+
+        # Http_keep_alive - whether url steps keep connections open for reuse
+        self.http_keep_alive = obslib.extract_property(
+            run_options, "http_keep_alive", on_missing=None
+        )
+        self.http_keep_alive = obslib.coerce_value(
+            self.http_keep_alive, (bool, type(None))
+        )
+        if self.http_keep_alive is None:
+            self.http_keep_alive = True
+
+        # Http_cache_dir - directory holding responses cached by url steps
+        self.http_cache_dir = obslib.extract_property(
+            run_options, "http_cache_dir", on_missing=None
+        )
+        self.http_cache_dir = obslib.coerce_value(
+            self.http_cache_dir, (str, type(None))
+        )
+        if self.http_cache_dir is None or self.http_cache_dir == "":
+            self.http_cache_dir = get_default_http_cache_dir()
+
+        # Http_record - directory to record url step responses to
+        self.http_record = obslib.extract_property(
+            run_options, "http_record", on_missing=None
+        )
+        self.http_record = obslib.coerce_value(self.http_record, (str, type(None)))
+
+        # Http_replay - directory to replay recorded url step responses from
+        self.http_replay = obslib.extract_property(
+            run_options, "http_replay", on_missing=None
+        )
+        self.http_replay = obslib.coerce_value(self.http_replay, (str, type(None)))
+
+        val_arg(
+            self.http_record is None or self.http_replay is None,
+            "http_record and http_replay can't be used together",
+        )
+
+        # Deadline - time in seconds allowed for the whole action
+        deadline = obslib.extract_property(run_options, "deadline", on_missing=None)
+        deadline = obslib.coerce_value(deadline, (int, float, type(None)))
+        val_arg(deadline is None or deadline > 0, "deadline must be greater than 0")
+
+        # Validate no unknown run options
+        val_arg(
+            len(run_options) == 0,
+            f"Unknown run options passed to ActionState: {run_options.keys()}",
+        )
+
+        # Temporary directory holding spilled values. Only created when required
+        self._spill_dir = None
+
+        # Long running interpreters for steps with reuse_interpreter. Only created
+        # when required
+        self._interpreter_pool = None
+
+        # Sessions for url steps, holding connections open between steps. Only
+        # created when required
+        self._http_pool = None
+
+        # Number of processes started and the total time taken to start them
+        self.spawn_count = 0
+        self.spawn_time = 0.0
+
+        # Background service processes, as (service, stop_after step id) tuples
+        self._services = []
+
+        # The state that owns the processes, services and spilled values shared by
+        # forks of this state, and a lock for changes to them
+        self._root = self
+        self._lock = threading.Lock()
+
+        # Vars set on a fork of the state, to merge back in to the original state
+        self.var_updates = None
+
+        # Current deadline, as a (monotonic time, message) tuple, from the action
+        # deadline or step timeouts
+        self.deadline = None
+        if deadline is not None:
+            self.deadline = (
+                time.monotonic() + deadline,
+                f"Action exceeded deadline of {deadline} seconds",
+            )
+
         # List of steps that are active in this action
         self.active_step_map = {}
 
@@ -464,6 +4190,224 @@ class ActionState:
         # the base env and bdast vars
         self.update_vars({})
 
+    def fork(self):
+        """
+        Create a copy of the action state, for a step run concurrently with other
+        steps. The copy has its own vars and deadline, but shares processes, services
+        and spilled values with this state. Vars set on the copy are recorded in
+        var_updates, to be merged back in to this state.
+        """
+
+        state = copy.copy(self)
+        state._vars = self._vars.copy()
+        state.var_updates = {}
+        state.update_vars({})
+
+        return state
+
+    def spill_text(self, text):
+
+        # Check parameters
+        val_arg(isinstance(text, str), "Invalid text passed to ActionState spill_text")
+
+        # Leave the value in memory if spilling is disabled or the value is small.
+        # A character is at most four bytes when encoded, so only encode when the
+        # value could be over the threshold
+        if self.spill_threshold == 0 or len(text) * 4 <= self.spill_threshold:
+            return text
+
+        content = text.encode("utf-8")
+        if len(content) <= self.spill_threshold:
+            return text
+
+        # Write the value to a file in the spill directory
+        file, path = self.create_spill_file()
+        with file:
+            file.write(content)
+
+        logger.debug("Spilled %s bytes to %s", len(content), path)
+
+        return SpilledText(
+            path, len(content), len(text), hashlib.sha256(content).hexdigest()
+        )
+
+    def create_spill_file(self):
+
+        # Create a new file in the spill directory and return a binary file object
+        # for it, along with the path
+        root = self._root
+        with root._lock:
+            if root._spill_dir is None:
+                root._spill_dir = tempfile.mkdtemp(prefix="bdast-")
+
+        handle, path = tempfile.mkstemp(dir=root._spill_dir, suffix=".txt")
+
+        return os.fdopen(handle, "wb"), path
+
+    def get_process_env(self, new_envs):
+
+        # Check parameters
+        val_arg(
+            isinstance(new_envs, dict),
+            "Invalid envs passed to ActionState get_process_env",
+        )
+
+        # The environment is read as each process is started, so changes made by
+        # in-process python steps reach later processes
+        envs = os.environ.copy()
+        envs.update(new_envs)
+
+        return envs
+
+    def limit_deadline(self, timeout, message):
+        """
+        Apply a timeout from now, if it ends before the current deadline.
+        Returns the previous deadline, to be restored when the timeout no longer
+        applies.
+        """
+
+        # Check parameters
+        val_arg(
+            isinstance(timeout, (int, float)),
+            "Invalid timeout passed to ActionState limit_deadline",
+        )
+        val_arg(
+            isinstance(message, str),
+            "Invalid message passed to ActionState limit_deadline",
+        )
+
+        previous = self.deadline
+        expiry = time.monotonic() + timeout
+
+        if self.deadline is None or expiry < self.deadline[0]:
+            self.deadline = (expiry, message)
+
+        return previous
+
+    def time_remaining(self):
+
+        if self.deadline is None:
+            return None
+
+        return max(self.deadline[0] - time.monotonic(), 0)
+
+    def timeout_message(self):
+
+        if self.deadline is None:
+            return "Timed out"
+
+        return self.deadline[1]
+
+    def check_deadline(self):
+
+        remaining = self.time_remaining()
+        val_run(remaining is None or remaining > 0, self.timeout_message())
+
+    def record_spawn(self, elapsed):
+
+        root = self._root
+        with root._lock:
+            root.spawn_count += 1
+            root.spawn_time += elapsed
+
+    def add_service(self, service, stop_after=None):
+
+        # Check parameters
+        val_arg(
+            isinstance(service, ServiceProcess),
+            "Invalid service passed to ActionState add_service",
+        )
+        val_arg(
+            isinstance(stop_after, (str, type(None))),
+            "Invalid stop_after passed to ActionState add_service",
+        )
+
+        root = self._root
+        with root._lock:
+            root._services.append((service, stop_after))
+
+    def stop_services(self, step_id=None):
+        """
+        Stop the services to be stopped after the step, or all services if step_id
+        is None
+        """
+
+        # Check parameters
+        val_arg(
+            isinstance(step_id, (str, type(None))),
+            "Invalid step id passed to ActionState stop_services",
+        )
+
+        root = self._root
+        stopping = []
+
+        with root._lock:
+            remaining = []
+            for service, stop_after in root._services:
+                if step_id is None or stop_after == step_id:
+                    stopping.append(service)
+                else:
+                    remaining.append((service, stop_after))
+
+            root._services = remaining
+
+        for service in stopping:
+            service.stop()
+
+    def get_interpreter_pool(self):
+
+        root = self._root
+        with root._lock:
+            if root._interpreter_pool is None:
+                root._interpreter_pool = InterpreterPool()
+
+        return root._interpreter_pool
+
+    def get_http_pool(self):
+
+        root = self._root
+        with root._lock:
+            if root._http_pool is None:
+                root._http_pool = HttpSessionPool(
+                    pool_size=self.http_pool_size,
+                    keep_alive=self.http_keep_alive,
+                    record_dir=self.http_record,
+                    replay_dir=self.http_replay,
+                )
+
+        return root._http_pool
+
+    def close(self):
+
+        # Shared resources are only released by the original state, not forks
+        if self._root is not self:
+            return
+
+        if self.spawn_count > 0:
+            logger.debug(
+                "Started %s processes, average start time %.2f ms",
+                self.spawn_count,
+                self.spawn_time * 1000 / self.spawn_count,
+            )
+
+        # Stop any services still running
+        self.stop_services()
+
+        # Close connections held by url steps
+        if self._http_pool is not None:
+            self._http_pool.close()
+            self._http_pool = None
+
+        # Stop any long running interpreters
+        if self._interpreter_pool is not None:
+            self._interpreter_pool.close()
+            self._interpreter_pool = None
+
+        # Remove any spilled values
+        if self._spill_dir is not None:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+            self._spill_dir = None
+
     def update_vars(self, new_vars):
 
         # Check parameters
@@ -474,6 +4418,9 @@ class ActionState:
         # Update vars
         self._vars.update(new_vars)
 
+        if self.var_updates is not None:
+            self.var_updates.update(new_vars)
+
         # Ensure particular keys are set appropriately
         bdast_vars = {"action_name": self.action_name, "action_arg": self.action_arg}
 
@@ -552,18 +4499,19 @@ class BdastStep:
             self._convert_plus_reference(self.after, ":end")
 
         # Extract name
+        # The name is templated when the step is run, so it can reference vars
+        # set by earlier steps
         self.name = obslib.extract_property(step_def, "name", on_missing=None)
-        self.name = session.resolve(self.name, (str, type(None)), on_none="")
+        if self.name is None:
+            self.name = ""
 
         # Extract when
+        # Conditions are only evaluated when the step is run
         self.when = obslib.extract_property(step_def, "when", on_missing=None)
-        self.when = session.resolve(
-            self.when, (list, str, type(None)), depth=0, on_none=[]
-        )
-        if isinstance(self.when, str):
-            self.when = [self.when]
 
-        self.when = [session.resolve(x, str) for x in self.when]
+        # Extract timeout
+        # Time in seconds allowed for the step. Resolved when the step is run
+        self.timeout = obslib.extract_property(step_def, "timeout", on_missing=None)
 
         # There should be single key or none left on the step.
         # With a single key, this is the command type to run.
@@ -605,48 +4553,102 @@ class BdastStep:
                 items.remove(item)
                 items.add(item[1:] + suffix)
 
+    def _check_when(self, session):
+
+        # Validate incoming arguments
+        val_arg(
+            isinstance(session, obslib.Session),
+            "Invalid session passed to _check_when",
+        )
+
+        when = session.resolve(self.when, (list, str, type(None)), depth=0, on_none=[])
+        if isinstance(when, str):
+            when = [when]
+
+        # Stop at the first false condition. Later conditions are not resolved
+        for condition in when:
+            condition = session.resolve(condition, str)
+            if not session.resolve("{{" + condition + "}}", bool):
+                return False
+
+        return True
+
     def run(self):
 
         # Session from action state
         action_state = self._action_state
         session = action_state.session
 
-        step_name = "(unnamed)"
-        if isinstance(self.name, str) and self.name != "":
-            step_name = self.name
+        # Check whether to run this step. This happens before anything else on the
+        # step is resolved, so nothing further is templated or validated for
+        # a skipped step
+        if not self._check_when(session):
+            logger.info("Skipping step due to conditional: %s", self.name)
+            return
+
+        step_name = session.resolve(self.name, (str, type(None)), on_none="")
+        if step_name == "":
+            step_name = "(unnamed)"
 
         log_raw("")
         log_raw(f"**************** STEP: {step_name}")
 
-        # Check whether to run this step
-        for condition in self.when:
-            result = session.resolve("{{" + condition + "}}", bool)
-            if not result:
-                logger.info("Skipping step due to conditional")
-                return
+        # Apply any step timeout, for this step and any nested steps
+        timeout = session.resolve(self.timeout, (int, float, type(None)))
+        val_run(timeout is None or timeout > 0, "Step timeout must be greater than 0")
+
+        previous_deadline = action_state.deadline
+        if timeout is not None:
+            action_state.limit_deadline(
+                timeout, f"Step '{step_name}' exceeded timeout of {timeout} seconds"
+            )
+
+        try:
+            self._run_impl(action_state)
+        finally:
+            action_state.deadline = previous_deadline
+
+    def _run_impl(self, action_state):
+
+        # Don't start the step if there is no time left
+        action_state.check_deadline()
+
+        # Work with a copy of the implementation configuration, as processing
+        # removes properties from it
+        impl_config = copy.deepcopy(self._impl_config)
 
         # Load the specific step type here
         if self._step_type in ("command", "bash", "pwsh"):
-            process_step_command(action_state, self._impl_config, self._step_type)
+            process_step_command(action_state, impl_config, self._step_type)
         elif self._step_type == "semver":
-            process_step_semver(action_state, self._impl_config)
+            process_step_semver(action_state, impl_config)
         elif self._step_type == "url":
-            process_step_url(action_state, self._impl_config)
+            process_step_url(action_state, impl_config)
         elif self._step_type == "nop":
-            process_step_nop(action_state, self._impl_config)
+            process_step_nop(action_state, impl_config)
         elif self._step_type == "block":
-            process_step_block(action_state, self._impl_config)
+            process_step_block(action_state, impl_config)
         elif self._step_type == "vars":
-            process_step_vars(action_state, self._impl_config)
+            process_step_vars(action_state, impl_config)
+        elif self._step_type == "python":
+            process_step_python(action_state, impl_config)
+        elif self._step_type == "service":
+            process_step_service(action_state, impl_config)
+        elif self._step_type == "matrix":
+            process_step_matrix(action_state, impl_config)
+        elif self._step_type == "wait_for":
+            process_step_wait_for(action_state, impl_config)
+        elif self._step_type == "git":
+            process_step_git(action_state, impl_config)
         else:
             raise BdastRunException(f"unknown step type: {self._step_type}")
 
         # Make sure the implementation extracted all properties and there are
         # no remaining unknown properties
-        if isinstance(self._impl_config, dict):
+        if isinstance(impl_config, dict):
             val_run(
-                len(self._impl_config) == 0,
-                f"Unknown properties in step config: {self._impl_config.keys()}",
+                len(impl_config) == 0,
+                f"Unknown properties in step config: {impl_config.keys()}",
             )
 
 
@@ -685,6 +4687,14 @@ class BdastAction:
         self._vars.update(action_vars)
         session = get_obslib_session(self._vars)
 
+        # Vars are resolved when used, as they can reference vars set by steps,
+        # but circular references between them can be found now
+        _, unresolvable = get_var_order(self._vars, allow_self_ref=False)
+        val_load(
+            len(unresolvable) == 0,
+            f"Circular references between vars: {sorted(unresolvable)}",
+        )
+
         # Extract steps from the action
         # Steps in the action can be either a string (referencing another step) or
         # a dict (inline step definition)
@@ -701,7 +4711,7 @@ class BdastAction:
             f"Invalid properties on action: {action_spec.keys()}",
         )
 
-    def run(self, action_arg):
+    def run(self, action_arg, run_options=None):
 
         # Validate incoming parameters
         val_arg(
@@ -709,7 +4719,21 @@ class BdastAction:
         )
 
         # Create an ActionState to hold the running state of the action
-        action_state = ActionState(self._action_name, action_arg)
+        action_state = ActionState(self._action_name, action_arg, run_options)
+
+        try:
+            self._run(action_state)
+        finally:
+            action_state.close()
+
+    def _run(self, action_state):
+
+        # Validate incoming parameters
+        val_arg(
+            isinstance(action_state, ActionState),
+            "Invalid action state passed to BdastAction _run",
+        )
+
         action_state.update_vars(self._vars)
 
         # Copy known steps to the action state step library
@@ -983,6 +5007,9 @@ class BdastAction:
             completed.add(step_match)
             active_step_map.pop(step_match)
 
+            # Stop any services that only run until this step
+            action_state.stop_services(step_match)
+
 
 class BdastSpec:
     def __init__(self, spec):
@@ -1122,13 +5149,16 @@ class BdastSpec:
         return action
 
 
-def process_spec(spec_file, action_name, action_arg):
+def process_spec(spec_file, action_name, action_arg, run_options=None):
 
     # Validate arguments
     val_arg(spec_file is not None and spec_file != "", "Specification filename missing")
     val_arg(os.path.isfile(spec_file), "Spec file does not exist or is not a file")
     val_arg(isinstance(action_name, str), "Invalid action name specified")
     val_arg(action_name != "", "Empty action name specified")
+    val_arg(
+        isinstance(run_options, (dict, type(None))), "Invalid run options specified"
+    )
 
     # Make sure action_arg is a string
     action_arg = str(action_arg) if action_arg is not None else ""
@@ -1149,4 +5179,4 @@ def process_spec(spec_file, action_name, action_arg):
     log_raw("")
     log_raw(f"**************** ACTION: {action_name}")
 
-    action.run(action_arg)
+    action.run(action_arg, run_options)
@@ -50,10 +50,11 @@ exit 1
 """
 
 
-def load_spec(spec_file, action_name, action_arg):
+def load_spec(spec_file, action_name, action_arg, run_options=None):
     """
     Loads and parses the YAML specification from file, sets the working directory, and
-    calls the appropriate processor for the version of the specification
+    calls the appropriate processor for the version of the specification.
+    run_options are passed through to the version 2 processor.
     """
 
     # Check for spec file
@@ -101,7 +102,7 @@ def load_spec(spec_file, action_name, action_arg):
         bdast_v1.process_spec(spec_file, action_name, action_arg)
     if version in ("2alpha"):
         logger.info("Processing spec as version 2")
-        bdast_v2.process_spec(spec_file, action_name, action_arg)
+        bdast_v2.process_spec(spec_file, action_name, action_arg, run_options)
     else:
         raise SpecLoadException(f"Invalid version in spec file: {version}")
 
@@ -146,6 +147,18 @@ def process_wrapper(args):
     return 0
 
 
+def get_abs_path(path):
+    """
+    Convert a path from the command line to an absolute path, as the working
+    directory changes to the spec file directory before it is used
+    """
+
+    if path is None or path == "":
+        return path
+
+    return os.path.abspath(path)
+
+
 def process_run(args):
     """
     Process the 'run' subcommand.
@@ -153,8 +166,19 @@ def process_run(args):
     Run bdast for the provided bdast configuration file, executing the requested action
     """
 
+    # Options affecting how the action is run
+    run_options = {
+        "spill_threshold": args.spill_threshold,
+        "deadline": args.deadline,
+        "http_pool_size": args.http_pool_size,
+        "http_keep_alive": args.http_keep_alive,
+        "http_cache_dir": get_abs_path(args.http_cache_dir),
+        "http_record": get_abs_path(args.http_record),
+        "http_replay": get_abs_path(args.http_replay),
+    }
+
     try:
-        load_spec(args.spec, args.action, " ".join(args.action_arg))
+        load_spec(args.spec, args.action, " ".join(args.action_arg), run_options)
     except Exception as e:  # pylint: disable=broad-exception-caught
         if args.verbose:
             logger.error(e, exc_info=True, stack_info=True)
@@ -214,6 +238,72 @@ def process_args() -> int:
         help="Path to bdast configuration file (default: bdast.yaml)",
     )
 
+    sub_run.add_argument(
+        "--spill-threshold",
+        action="store",
+        dest="spill_threshold",
+        type=int,
+        default=None,
+        help="Size in bytes above which captured output is held on disk "
+        "rather than in memory (0 to disable, default: 1048576)",
+    )
+
+    sub_run.add_argument(
+        "--deadline",
+        action="store",
+        dest="deadline",
+        type=float,
+        default=None,
+        help="Time in seconds allowed for the action. Running commands are "
+        "stopped when the deadline is reached (default: no deadline)",
+    )
+
+    sub_run.add_argument(
+        "--http-pool-size",
+        action="store",
+        dest="http_pool_size",
+        type=int,
+        default=None,
+        help="Number of connections kept open to each host by url steps "
+        "(default: 10)",
+    )
+
+    sub_run.add_argument(
+        "--no-http-keep-alive",
+        action="store_false",
+        dest="http_keep_alive",
+        help="Close url step connections after each request, rather than "
+        "reusing them",
+    )
+
+    sub_run.add_argument(
+        "--http-cache-dir",
+        action="store",
+        dest="http_cache_dir",
+        default=None,
+        help="Directory for responses cached by url steps "
+        "(default: $XDG_CACHE_HOME/bdast/http)",
+    )
+
+    http_cassette = sub_run.add_mutually_exclusive_group()
+
+    http_cassette.add_argument(
+        "--http-record",
+        action="store",
+        dest="http_record",
+        default=None,
+        help="Directory to save url step requests and responses to",
+    )
+
+    http_cassette.add_argument(
+        "--http-replay",
+        action="store",
+        dest="http_replay",
+        default=None,
+        help="Directory to serve url step responses from, as saved by "
+        "--http-record, without network access",
+    )
+
     sub_run.add_argument(action="store", dest="action", help="Action name")
 
     sub_run.add_argument(
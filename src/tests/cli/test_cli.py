@@ -1,6 +1,8 @@
+import os
 import sys
 import bdast
 import pytest
+import yaml
 
 
 class TestCli:
@@ -23,3 +25,43 @@ class TestCli:
         res = bdast.cli.process_args()
 
         assert res == 0
+
+    def run_spec(self, tmp_path, step, options):
+        # Run a spec in a subdirectory, from tmp_path
+        spec_dir = tmp_path / "spec"
+        spec_dir.mkdir(exist_ok=True)
+        spec = {"version": "2alpha", "actions": {"test": {"steps": [step]}}}
+        (spec_dir / "bdast.yaml").write_text(yaml.safe_dump(spec))
+
+        cwd = os.getcwd()
+        os.chdir(tmp_path)
+        try:
+            sys.argv = ["bdast", "run", "-f", "spec/bdast.yaml", *options, "test"]
+            return bdast.cli.process_args()
+        finally:
+            os.chdir(cwd)
+
+    def test_http_record1(self, http_server, tmp_path):
+        # Relative cassette paths are relative to the working directory, not the
+        # spec file directory
+        http_server.routes["/data"] = (200, {}, "recorded")
+        step = {"url": {"url": f"{http_server.url}/data", "method": "get"}}
+
+        for option in ("--http-record", "--http-replay"):
+            assert self.run_spec(tmp_path, step, [option, "cassettes"]) == 0
+
+        assert len(list((tmp_path / "cassettes").iterdir())) > 0
+        assert not (tmp_path / "spec" / "cassettes").exists()
+        assert len(http_server.requests) == 1
+
+    def test_http_cache1(self, http_server, tmp_path):
+        # Relative cache paths are relative to the working directory
+        http_server.routes["/data"] = (200, {"ETag": '"v1"'}, "cached")
+        step = {
+            "url": {"url": f"{http_server.url}/data", "method": "get", "cache": True}
+        }
+
+        assert self.run_spec(tmp_path, step, ["--http-cache-dir", "cache"]) == 0
+
+        assert len(list((tmp_path / "cache").iterdir())) > 0
+        assert not (tmp_path / "spec" / "cache").exists()
@@ -0,0 +1,80 @@
+import http.server
+import threading
+import pytest
+
+
+class LocalHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_request(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length > 0 else b""
+
+        with self.server.lock:
+            self.server.requests.append(
+                {
+                    "method": self.command,
+                    "path": self.path,
+                    "headers": dict(self.headers),
+                    "body": body,
+                }
+            )
+
+        route = self.server.routes.get(self.path.split("?")[0])
+        if route is None:
+            status, headers, content = 404, {}, b"not found"
+        elif callable(route):
+            status, headers, content = route(self, body)
+        else:
+            status, headers, content = route
+
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+
+        if self.command != "HEAD":
+            self.wfile.write(content)
+
+    do_GET = handle_request
+    do_POST = handle_request
+    do_PUT = handle_request
+    do_HEAD = handle_request
+    do_DELETE = handle_request
+
+
+@pytest.fixture
+def http_server():
+    """
+    Local HTTP/1.1 server. Responses are set in 'routes', keyed by path, as
+    (status, headers, body) tuples or callables returning them. Requests received
+    and the number of connections accepted are recorded.
+    """
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), LocalHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.routes = {}
+    server.requests = []
+    server.connections = 0
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,80 @@
+import os
+import pytest
+import yaml
+import bdast
+from bdast import bdast_v1
+from bdast.exception import SpecRunException
+
+
+class TestEnvFiles:
+    def test_1(self, tmp_path):
+        # Env files are merged in to the scope envs
+        env_file = tmp_path / "vars.yaml"
+        env_file.write_text("A: 1\nB: text\n")
+
+        state = bdast_v1.ScopeState()
+        bdast_v1.merge_spec_envs({"env_files": [str(env_file)]}, state)
+
+        assert state.envs["A"] == "1"
+        assert state.envs["B"] == "text"
+
+    def test_2(self, tmp_path, monkeypatch):
+        # Env files are only parsed once per run
+        env_file = tmp_path / "vars.yaml"
+        env_file.write_text("A: 1\n")
+
+        calls = []
+        safe_load = yaml.safe_load
+
+        def counting_load(stream):
+            calls.append(stream)
+            return safe_load(stream)
+
+        monkeypatch.setattr(bdast_v1.yaml, "safe_load", counting_load)
+
+        state = bdast_v1.ScopeState()
+        for _ in range(5):
+            scope = bdast_v1.ScopeState(parent=state)
+            bdast_v1.merge_spec_envs({"env_files": [str(env_file)]}, scope)
+            assert scope.envs["A"] == "1"
+
+        assert len(calls) == 1
+
+    def test_3(self, tmp_path):
+        # Modified env files are parsed again
+        env_file = tmp_path / "vars.yaml"
+        env_file.write_text("A: 1\n")
+
+        state = bdast_v1.ScopeState()
+        bdast_v1.merge_spec_envs({"env_files": [str(env_file)]}, state)
+        assert state.envs["A"] == "1"
+
+        env_file.write_text("A: 2\n")
+        mtime = os.stat(env_file).st_mtime_ns + 1000000000
+        os.utime(env_file, ns=(mtime, mtime))
+
+        bdast_v1.merge_spec_envs({"env_files": [str(env_file)]}, state)
+        assert state.envs["A"] == "2"
+
+    def test_4(self, tmp_path):
+        # Env files must contain a dictionary
+        env_file = tmp_path / "vars.yaml"
+        env_file.write_text("- A\n")
+
+        state = bdast_v1.ScopeState()
+        with pytest.raises(SpecRunException):
+            bdast_v1.merge_spec_envs({"env_files": [str(env_file)]}, state)
+
+    def test_5(self, tmp_path):
+        # Cached content is not modified by scopes
+        env_file = tmp_path / "vars.yaml"
+        env_file.write_text("A: 1\n")
+
+        state = bdast_v1.ScopeState()
+        bdast_v1.merge_spec_envs(
+            {"env": {"B": "2"}, "env_files": [str(env_file)]}, state
+        )
+        bdast_v1.merge_spec_envs({"env_files": [str(env_file)]}, state)
+
+        cached = list(state.common.env_file_cache.values())[0][1]
+        assert cached == {"A": "1"}
@@ -0,0 +1,221 @@
+import json
+import pytest
+import yaml
+import bdast
+from bdast import bdast_v1
+from bdast.exception import SpecRunException
+
+
+def write_spec(tmp_path, spec):
+    spec_file = tmp_path / "bdast.yaml"
+    spec_file.write_text(yaml.safe_dump(spec))
+
+    return str(spec_file)
+
+
+def release_spec(http_server, step):
+    return {
+        "version": "1",
+        "steps": {
+            "release": {
+                "type": "github_release",
+                "owner": "owner",
+                "repo": "repo",
+                "token": "secret",
+                "payload": json.dumps({"tag_name": "v1.0.0"}),
+                "api_url": http_server.url,
+                **step,
+            }
+        },
+        "actions": {"test": {"steps": ["release"]}},
+    }
+
+
+def release_route(http_server):
+    upload_url = f"{http_server.url}/uploads/releases/1/assets{{?name,label}}"
+    assets_url = f"{http_server.url}/repos/owner/repo/releases/1/assets"
+
+    return (
+        201,
+        {},
+        json.dumps({"id": 1, "upload_url": upload_url, "assets_url": assets_url}),
+    )
+
+
+def existing_asset_route():
+    # The first upload fails after the server has stored the asset, so the retry
+    # finds the name in use
+    responses = [
+        (502, {}, "bad gateway"),
+        (422, {}, json.dumps({"errors": [{"code": "already_exists"}]})),
+        (201, {}, "{}"),
+    ]
+
+    return lambda handler, body: responses.pop(0)
+
+
+def asset_list_route(http_server, state):
+    asset = {
+        "name": "asset.bin",
+        "size": 7,
+        "state": state,
+        "url": f"{http_server.url}/repos/owner/repo/releases/assets/5",
+    }
+
+    return 200, {}, json.dumps([asset])
+
+
+class TestGithubRelease:
+    def test_release1(self, http_server, tmp_path):
+        # The release is created against the api url
+        http_server.routes["/repos/owner/repo/releases"] = release_route(http_server)
+
+        bdast_v1.process_spec(
+            write_spec(tmp_path, release_spec(http_server, {})), "test", ""
+        )
+
+        assert len(http_server.requests) == 1
+        request = http_server.requests[0]
+        assert request["method"] == "POST"
+        assert request["headers"]["Authorization"] == "token secret"
+        assert json.loads(request["body"]) == {"tag_name": "v1.0.0"}
+
+    def test_assets1(self, http_server, tmp_path, capfd):
+        # Assets are uploaded to the upload url from the release
+        http_server.routes["/repos/owner/repo/releases"] = release_route(http_server)
+        http_server.routes["/uploads/releases/1/assets"] = (201, {}, "{}")
+
+        assets = []
+        for index in range(5):
+            asset = tmp_path / f"asset{index}.tar.gz"
+            asset.write_bytes(bytes([index]) * (100000 + index))
+            assets.append(str(asset))
+
+        spec = release_spec(http_server, {"assets": assets, "upload_parallel": 2})
+        bdast_v1.process_spec(write_spec(tmp_path, spec), "test", "")
+
+        uploads = {
+            x["path"]: x for x in http_server.requests if x["path"].startswith("/up")
+        }
+        assert len(uploads) == 5
+
+        for index in range(5):
+            upload = uploads[f"/uploads/releases/1/assets?name=asset{index}.tar.gz"]
+            assert upload["body"] == bytes([index]) * (100000 + index)
+            assert upload["headers"]["Authorization"] == "token secret"
+            assert upload["headers"]["Content-Type"] == "application/octet-stream"
+
+        assert "Uploaded asset asset4.tar.gz (100004 bytes)" in capfd.readouterr().out
+
+    def test_assets2(self, http_server, tmp_path, monkeypatch):
+        # Failed uploads are retried
+        monkeypatch.setattr(bdast_v1, "UPLOAD_RETRY_BACKOFF", 0)
+        http_server.routes["/repos/owner/repo/releases"] = release_route(http_server)
+
+        responses = [(502, {}, "bad gateway"), (201, {}, "{}")]
+        http_server.routes["/uploads/releases/1/assets"] = (
+            lambda handler, body: responses.pop(0)
+        )
+
+        asset = tmp_path / "asset.bin"
+        asset.write_bytes(b"content")
+
+        spec = release_spec(http_server, {"assets": [str(asset)]})
+        bdast_v1.process_spec(write_spec(tmp_path, spec), "test", "")
+
+        uploads = [x for x in http_server.requests if x["path"].startswith("/up")]
+        assert [x["body"] for x in uploads] == [b"content", b"content"]
+
+    def test_assets3(self, http_server, tmp_path, monkeypatch, capfd):
+        # The step fails once retries are exhausted, after the other uploads
+        monkeypatch.setattr(bdast_v1, "UPLOAD_RETRY_BACKOFF", 0)
+        http_server.routes["/repos/owner/repo/releases"] = release_route(http_server)
+        http_server.routes["/uploads/releases/1/assets"] = lambda handler, body: (
+            (503, {}, "unavailable") if "bad" in handler.path else (201, {}, "{}")
+        )
+
+        assets = []
+        for name in ("good.bin", "bad.bin"):
+            (tmp_path / name).write_bytes(b"content")
+            assets.append(str(tmp_path / name))
+
+        spec = release_spec(http_server, {"assets": assets, "upload_retries": 2})
+        with pytest.raises(SpecRunException):
+            bdast_v1.process_spec(write_spec(tmp_path, spec), "test", "")
+
+        bad_uploads = [x for x in http_server.requests if "bad" in x["path"]]
+        assert len(bad_uploads) == 3
+        assert "Uploaded asset good.bin" in capfd.readouterr().out
+
+    def test_assets4(self, http_server, tmp_path):
+        # Missing assets fail the step before the release is created
+        spec = release_spec(http_server, {"assets": [str(tmp_path / "missing")]})
+
+        with pytest.raises(SpecRunException):
+            bdast_v1.process_spec(write_spec(tmp_path, spec), "test", "")
+
+        assert len(http_server.requests) == 0
+
+    def test_assets5(self, http_server, tmp_path, monkeypatch):
+        # Assets uploaded by a failed attempt are found when the retry conflicts
+        monkeypatch.setattr(bdast_v1, "UPLOAD_RETRY_BACKOFF", 0)
+        http_server.routes["/repos/owner/repo/releases"] = release_route(http_server)
+        http_server.routes["/uploads/releases/1/assets"] = existing_asset_route()
+        http_server.routes["/repos/owner/repo/releases/1/assets"] = asset_list_route(
+            http_server, "uploaded"
+        )
+
+        asset = tmp_path / "asset.bin"
+        asset.write_bytes(b"content")
+
+        spec = release_spec(http_server, {"assets": [str(asset)]})
+        bdast_v1.process_spec(write_spec(tmp_path, spec), "test", "")
+
+        uploads = [x for x in http_server.requests if x["path"].startswith("/up")]
+        assert len(uploads) == 2
+        assert not any(x["method"] == "DELETE" for x in http_server.requests)
+
+    def test_assets6(self, http_server, tmp_path, monkeypatch):
+        # Incomplete assets left by a failed attempt are replaced
+        monkeypatch.setattr(bdast_v1, "UPLOAD_RETRY_BACKOFF", 0)
+        http_server.routes["/repos/owner/repo/releases"] = release_route(http_server)
+        http_server.routes["/uploads/releases/1/assets"] = existing_asset_route()
+        http_server.routes["/repos/owner/repo/releases/1/assets"] = asset_list_route(
+            http_server, "starter"
+        )
+        http_server.routes["/repos/owner/repo/releases/assets/5"] = (204, {}, "")
+
+        asset = tmp_path / "asset.bin"
+        asset.write_bytes(b"content")
+
+        spec = release_spec(http_server, {"assets": [str(asset)]})
+        bdast_v1.process_spec(write_spec(tmp_path, spec), "test", "")
+
+        requests = [
+            (x["method"], x["path"].split("?")[0]) for x in http_server.requests
+        ]
+        assert requests[1:] == [
+            ("POST", "/uploads/releases/1/assets"),
+            ("POST", "/uploads/releases/1/assets"),
+            ("GET", "/repos/owner/repo/releases/1/assets"),
+            ("DELETE", "/repos/owner/repo/releases/assets/5"),
+            ("POST", "/uploads/releases/1/assets"),
+        ]
+
+    def test_assets7(self, http_server, tmp_path):
+        # Names already in use before the first attempt fail the step
+        http_server.routes["/repos/owner/repo/releases"] = release_route(http_server)
+        http_server.routes["/uploads/releases/1/assets"] = (
+            422,
+            {},
+            json.dumps({"errors": [{"code": "already_exists"}]}),
+        )
+
+        asset = tmp_path / "asset.bin"
+        asset.write_bytes(b"content")
+
+        spec = release_spec(http_server, {"assets": [str(asset)]})
+        with pytest.raises(SpecRunException):
+            bdast_v1.process_spec(write_spec(tmp_path, spec), "test", "")
+
+        assert [x["method"] for x in http_server.requests] == ["POST", "POST"]
@@ -0,0 +1,141 @@
+import pytest
+import yaml
+import bdast
+from bdast import bdast_v1
+from bdast.exception import SpecRunException
+
+
+def write_spec(tmp_path, spec):
+    spec_file = tmp_path / "bdast.yaml"
+    spec_file.write_text(yaml.safe_dump(spec))
+
+    return str(spec_file)
+
+
+class TestProcessSpec:
+    def test_depends_on1(self, tmp_path, capfd):
+        # Dependencies run first and their captures are visible to later steps
+        spec = {
+            "version": "1",
+            "steps": {
+                "a": {
+                    "type": "bash",
+                    "command": "echo value_a",
+                    "capture": "CAPTURE_A",
+                    "capture_strip": True,
+                },
+                "b": {
+                    "type": "bash",
+                    "depends_on": ["a"],
+                    "command": 'echo "b saw $CAPTURE_A"',
+                },
+                "c": {
+                    "type": "bash",
+                    "depends_on": ["b", "a"],
+                    "command": 'echo "c saw $CAPTURE_A"',
+                },
+            },
+            "actions": {"test": {"steps": ["c", "a"]}},
+        }
+
+        bdast_v1.process_spec(write_spec(tmp_path, spec), "test", "")
+
+        output = capfd.readouterr().out
+        assert "b saw value_a" in output
+        assert "c saw value_a" in output
+        assert output.index("STEP a") < output.index("STEP b")
+        assert output.index("STEP b") < output.index("STEP c")
+
+        # Steps in the action step list are always run
+        assert output.count("**************** STEP a") == 2
+
+    def test_depends_on2(self, tmp_path):
+        # Circular dependencies are reported
+        spec = {
+            "version": "1",
+            "steps": {
+                "a": {"type": "semver", "depends_on": ["b"]},
+                "b": {"type": "semver", "depends_on": ["a"]},
+            },
+            "actions": {"test": {"steps": ["a"]}},
+        }
+
+        with pytest.raises(SpecRunException):
+            bdast_v1.process_spec(write_spec(tmp_path, spec), "test", "")
+
+    def test_depends_on3(self, tmp_path):
+        # Dependencies must exist
+        spec = {
+            "version": "1",
+            "steps": {"a": {"type": "semver", "depends_on": ["missing"]}},
+            "actions": {"test": {"steps": ["a"]}},
+        }
+
+        with pytest.raises(SpecRunException):
+            bdast_v1.process_spec(write_spec(tmp_path, spec), "test", "")
+
+    def test_scope1(self, tmp_path, capfd):
+        # Step env is not visible to other steps
+        spec = {
+            "version": "1",
+            "env": {"GLOBAL": "global"},
+            "steps": {
+                "a": {
+                    "type": "bash",
+                    "env": {"LOCAL": "local"},
+                    "command": 'echo "a $GLOBAL $LOCAL"',
+                },
+                "b": {
+                    "type": "bash",
+                    "command": 'echo "b $GLOBAL ${LOCAL:-unset}"',
+                },
+            },
+            "actions": {"test": {"steps": ["a", "b"]}},
+        }
+
+        bdast_v1.process_spec(write_spec(tmp_path, spec), "test", "")
+
+        output = capfd.readouterr().out
+        assert "a global local" in output
+        assert "b global unset" in output
+
+    def test_depends_on4(self, tmp_path):
+        # Long dependency chains don't reach the recursion limit
+        count = 3000
+        steps = {"step0": {"type": "semver"}}
+        for index in range(1, count):
+            steps[f"step{index}"] = {
+                "type": "semver",
+                "depends_on": [f"step{index - 1}"],
+            }
+
+        spec = {
+            "version": "1",
+            "steps": steps,
+            "actions": {"test": {"steps": [f"step{count - 1}"]}},
+        }
+
+        bdast_v1.process_spec(write_spec(tmp_path, spec), "test", "")
+
+    def test_scope2(self, tmp_path, capfd):
+        # Captures are visible in all scopes, even where a scope has its own value
+        spec = {
+            "version": "1",
+            "steps": {
+                "a": {
+                    "type": "bash",
+                    "command": "echo captured",
+                    "capture": "VALUE",
+                    "capture_strip": True,
+                },
+                "b": {"type": "bash", "command": 'echo "b $VALUE"'},
+            },
+            "actions": {
+                "test": {"env": {"VALUE": "initial"}, "steps": ["a", "b"]},
+            },
+        }
+
+        bdast_v1.process_spec(write_spec(tmp_path, spec), "test", "")
+
+        output = capfd.readouterr().out
+        assert "b captured" in output
@@ -128,6 +128,90 @@ class TestIntActionState:
         # Make sure env looks correct
         assert action_state.session.resolve("{{ env.TESTER4 }}") == "OTHER4"
 
+    def test_spill1(self):
+        # Small values stay in memory
+
+        action_state = ActionState("test", "", {"spill_threshold": 100})
+
+        assert action_state.spill_text("small") == "small"
+        assert isinstance(action_state.spill_text("small"), str)
+
+        action_state.close()
+
+    def test_spill2(self):
+        # Large values are held on disk and read back when templated
+
+        action_state = ActionState("test", "", {"spill_threshold": 100})
+
+        value = action_state.spill_text("x" * 500)
+        assert isinstance(value, bdast_v2.SpilledText)
+        assert os.path.isfile(value.path)
+        assert value.size == 500
+
+        action_state.update_vars({"large": value})
+        assert action_state.session.resolve("{{ large }}") == "x" * 500
+        assert action_state.session.resolve("{{ large | length }}", int) == 500
+        assert action_state.session.resolve("{{ large.startswith('xx') }}", bool)
+
+        # Spilled values are removed with the action state
+        action_state.close()
+        assert not os.path.exists(value.path)
+
+    def test_spill3(self):
+        # Spilling can be disabled
+
+        action_state = ActionState("test", "", {"spill_threshold": 0})
+
+        assert isinstance(action_state.spill_text("x" * 5000000), str)
+
+    def test_spill4(self):
+        # Invalid run options
+
+        with pytest.raises(BdastArgumentException):
+            ActionState("test", "", {"spill_threshold": -1})
+
+        with pytest.raises(BdastArgumentException):
+            ActionState("test", "", {"unknown": 1})
+
+    def test_spill5(self, monkeypatch):
+        # Length and comparisons use the values recorded when spilling
+
+        action_state = ActionState("test", "", {"spill_threshold": 100})
+
+        value = action_state.spill_text("é" * 500)
+        other = action_state.spill_text("é" * 500)
+        assert value.size == 1000
+
+        def fail_read(self):
+            raise AssertionError("Spill file read")
+
+        monkeypatch.setattr(bdast_v2.SpilledText, "read", fail_read)
+
+        assert len(value) == 500
+        assert value == "é" * 500
+        assert value != "é" * 499 + "e"
+        assert value != 500
+        assert value == other
+
+        monkeypatch.undo()
+
+        # Values hash as the equivalent str, so can be used in sets and dicts
+        text = "é" * 500
+        assert hash(value) == hash(text) == hash(other)
+        assert len({value, other}) == 1
+        assert value in {text}
+        assert text in {value}
+        assert {text: 1}[value] == 1
+        assert {value: 1}[text] == 1
+
+        # Values read back match the recorded length and digest
+        text = "line\r\n" * 100
+        value = action_state.spill_text(text)
+        assert value.read() == text
+        assert value == text
+
+        action_state.close()
+
 
 # TODO testing
 # obslib session
@@ -1,3 +1,4 @@
+import time
 import pytest
 import bdast
 from bdast import bdast_v2
@@ -88,3 +89,105 @@ class TestIntBdastStep:
 
         assert "build:begin" in step.depends_on
         assert "build:end" in step.required_by
+
+    def test_when1(self):
+        # A skipped step is not templated or validated
+        step_def = {
+            "name": "{{ missing_name }}",
+            "when": "false",
+            "command": {"cmd": "{{ missing_cmd }}", "unknown": 1},
+        }
+
+        action_state = bdast.bdast_v2.ActionState("action_test", "")
+        step = bdast.bdast_v2.BdastStep(step_def, action_state)
+
+        step.run()
+
+    def test_when2(self):
+        # Conditions use the vars at the time the step is run
+        step_def = {
+            "name": "{{ step_name }}",
+            "when": ["enabled"],
+            "vars": {"set": {"ran": True}},
+        }
+
+        action_state = bdast.bdast_v2.ActionState("action_test", "")
+        step = bdast.bdast_v2.BdastStep(step_def, action_state)
+
+        action_state.update_vars({"enabled": True, "step_name": "test"})
+        step.run()
+
+        assert action_state._vars["ran"] is True
+
+    def test_when3(self):
+        # Conditions stop at the first false condition
+        step_def = {"when": ["false", "missing_var"]}
+
+        action_state = bdast.bdast_v2.ActionState("action_test", "")
+        step = bdast.bdast_v2.BdastStep(step_def, action_state)
+
+        step.run()
+
+    def test_when4(self):
+        # Unknown properties are still reported for steps that run
+        step_def = {"when": "true", "nop": {"unknown": 1}}
+
+        action_state = bdast.bdast_v2.ActionState("action_test", "")
+        step = bdast.bdast_v2.BdastStep(step_def, action_state)
+
+        with pytest.raises(BdastRunException):
+            step.run()
+
+    def test_timeout1(self):
+        # Commands running past the step timeout are stopped
+        step_def = {"name": "slow", "timeout": 0.5, "command": {"cmd": "sleep 30"}}
+
+        action_state = bdast.bdast_v2.ActionState("action_test", "")
+        step = bdast.bdast_v2.BdastStep(step_def, action_state)
+
+        start = time.monotonic()
+        with pytest.raises(BdastRunException, match="Step 'slow' exceeded timeout"):
+            step.run()
+
+        assert time.monotonic() - start < 10
+        assert action_state.deadline is None
+
+    def test_timeout2(self):
+        # Nested steps are limited by the timeout on the block
+        step_def = {
+            "name": "outer",
+            "timeout": "{{ limit }}",
+            "block": {"steps": [{"timeout": 60, "command": {"cmd": "sleep 30"}}]},
+        }
+
+        action_state = bdast.bdast_v2.ActionState("action_test", "")
+        action_state.update_vars({"limit": 0.5})
+        step = bdast.bdast_v2.BdastStep(step_def, action_state)
+
+        with pytest.raises(BdastRunException, match="Step 'outer' exceeded timeout"):
+            step.run()
+
+    def test_timeout3(self):
+        # Steps are not started after the action deadline
+        action_state = bdast.bdast_v2.ActionState(
+            "action_test", "", run_options={"deadline": 0.1}
+        )
+        step = bdast.bdast_v2.BdastStep({"vars": {"set": {"ran": True}}}, action_state)
+
+        time.sleep(0.2)
+
+        with pytest.raises(BdastRunException, match="Action exceeded deadline"):
+            step.run()
+
+        assert "ran" not in action_state._vars
+
+    def test_timeout4(self):
+        # Timeouts must be positive
+        action_state = bdast.bdast_v2.ActionState("action_test", "")
+        step = bdast.bdast_v2.BdastStep({"timeout": 0}, action_state)
+
+        with pytest.raises(BdastRunException):
+            step.run()
+
+        with pytest.raises(BdastArgumentException):
+            bdast.bdast_v2.ActionState("action_test", "", run_options={"deadline": -1})
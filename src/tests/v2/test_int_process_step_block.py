@@ -0,0 +1,142 @@
+import time
+import pytest
+import bdast
+from bdast import bdast_v2
+from bdast.exception import BdastRunException
+from bdast.exception import BdastLoadException
+from bdast.exception import BdastArgumentException
+
+
+class TestIntProcessStepBlock:
+    def test_sequential1(self):
+        # Steps run in order and can use vars set by earlier steps
+        action_state = bdast_v2.ActionState("test", "")
+
+        bdast_v2.process_step_block(
+            action_state,
+            {
+                "steps": [
+                    {"vars": {"set": {"a": 1}}},
+                    {"vars": {"set": {"b": "{{ a + 1 }}"}}},
+                ]
+            },
+        )
+
+        assert action_state._vars["b"] == "2"
+
+    def test_parallel1(self):
+        # Steps run concurrently
+        action_state = bdast_v2.ActionState("test", "")
+
+        start = time.monotonic()
+        bdast_v2.process_step_block(
+            action_state,
+            {
+                "parallel": True,
+                "steps": [{"command": {"cmd": "sleep 0.5"}} for _ in range(4)],
+            },
+        )
+
+        assert time.monotonic() - start < 1.5
+
+    def test_parallel2(self):
+        # Vars are merged in declaration order, regardless of completion order
+        action_state = bdast_v2.ActionState("test", "")
+
+        bdast_v2.process_step_block(
+            action_state,
+            {
+                "parallel": True,
+                "steps": [
+                    {"bash": {"cmd": "echo -n first", "capture": "out"}},
+                    {"bash": {"cmd": "sleep 0.3; echo -n second", "capture": "out"}},
+                    {"bash": {"cmd": "echo -n third", "capture": "third"}},
+                ],
+            },
+        )
+
+        assert action_state._vars["out"] == "second"
+        assert action_state._vars["third"] == "third"
+
+    def test_parallel3(self, capfd):
+        # Output from each step is displayed in one piece
+        action_state = bdast_v2.ActionState("test", "")
+
+        bdast_v2.process_step_block(
+            action_state,
+            {
+                "parallel": True,
+                "steps": [
+                    {
+                        "name": f"step {name}",
+                        "bash": {
+                            "cmd": f"for i in 1 2 3; do echo {name}$i; sleep 0.05; done"
+                        },
+                    }
+                    for name in ("a", "b", "c")
+                ],
+            },
+        )
+
+        out = capfd.readouterr().out
+        for name in ("a", "b", "c"):
+            index = out.index(f"STEP: step {name}")
+            assert out[index:].split("\n")[1:4] == [f"{name}1", f"{name}2", f"{name}3"]
+
+    def test_parallel4(self, tmp_path):
+        # With max_parallel and fail_fast, steps aren't started after a failure
+        action_state = bdast_v2.ActionState("test", "")
+
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_block(
+                action_state,
+                {
+                    "parallel": True,
+                    "max_parallel": 1,
+                    "steps": [
+                        {"bash": {"cmd": f"touch {tmp_path}/{n}; [ {n} -ne 1 ]"}}
+                        for n in (1, 2, 3)
+                    ],
+                },
+            )
+
+        assert sorted(x.name for x in tmp_path.iterdir()) == ["1"]
+
+    def test_parallel5(self, tmp_path):
+        # Without fail_fast, all steps run and vars from successful steps are kept
+        action_state = bdast_v2.ActionState("test", "")
+
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_block(
+                action_state,
+                {
+                    "parallel": True,
+                    "max_parallel": 1,
+                    "fail_fast": False,
+                    "steps": [
+                        {"bash": {"cmd": "exit 1"}},
+                        {"vars": {"set": {"ran": True}}},
+                    ],
+                },
+            )
+
+        assert action_state._vars["ran"] is True
+
+    def test_params1(self):
+        # max_parallel requires parallel
+        action_state = bdast_v2.ActionState("test", "")
+
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_block(
+                action_state, {"max_parallel": 2, "steps": [{"nop": {}}]}
+            )
+
+    def test_params2(self):
+        # fail_fast requires parallel
+        action_state = bdast_v2.ActionState("test", "")
+
+        for fail_fast in (True, False):
+            with pytest.raises(BdastRunException, match="fail_fast"):
+                bdast_v2.process_step_block(
+                    action_state, {"fail_fast": fail_fast, "steps": [{"nop": {}}]}
+                )
@@ -0,0 +1,671 @@
+import os
+import shutil
+import signal
+import time
+import subprocess
+import pytest
+import bdast
+from bdast import bdast_v2
+from bdast.exception import BdastRunException
+from bdast.exception import BdastLoadException
+from bdast.exception import BdastArgumentException
+
+
+class TestIntProcessStepCommand:
+    def test_capture1(self):
+        action_state = bdast_v2.ActionState("test", "")
+
+        bdast_v2.process_step_command(
+            action_state, {"cmd": "echo hello", "capture": "out"}, "command"
+        )
+
+        assert action_state.session.resolve("{{ out }}") == "hello\n"
+
+    def test_capture2(self):
+        action_state = bdast_v2.ActionState("test", "")
+
+        bdast_v2.process_step_command(
+            action_state,
+            {"cmd": "echo hello", "capture": "out", "capture_strip": True},
+            "bash",
+        )
+
+        assert action_state.session.resolve("{{ out }}") == "hello"
+
+    def test_capture_spill1(self):
+        # Large captures are held on disk
+        action_state = bdast_v2.ActionState("test", "", {"spill_threshold": 1000})
+
+        bdast_v2.process_step_command(
+            action_state,
+            {"cmd": "head -c 5000 /dev/zero | tr '\\0' 'a'", "capture": "out"},
+            "bash",
+        )
+
+        assert isinstance(action_state._vars["out"], bdast_v2.SpilledText)
+        assert action_state.session.resolve("{{ out }}") == "a" * 5000
+
+        action_state.close()
+
+    def test_capture_spill3(self):
+        # Spilled captures record their length and digest while writing
+        action_state = bdast_v2.ActionState("test", "", {"spill_threshold": 1000})
+
+        bdast_v2.process_step_command(
+            action_state,
+            {
+                "cmd": "for i in $(seq 1000); do printf '\\xc3\\xa9\\r\\n'; done; printf '\\xff'",
+                "capture": "out",
+            },
+            "bash",
+        )
+
+        expected = "é\n" * 1000 + "\ufffd"
+        out = action_state._vars["out"]
+        assert isinstance(out, bdast_v2.SpilledText)
+        assert out.read() == expected
+        assert out.size == len(expected.encode("utf-8"))
+        assert len(out) == len(expected)
+        assert out == expected
+        assert hash(out) == hash(action_state.spill_text(expected))
+
+        action_state.close()
+
+    def test_fail1(self):
+        action_state = bdast_v2.ActionState("test", "")
+
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_command(action_state, {"cmd": "false"}, "command")
+
+    def test_capture_tee1(self, capfd):
+        # Captured output is displayed as well as captured
+        action_state = bdast_v2.ActionState("test", "")
+
+        bdast_v2.process_step_command(
+            action_state,
+            {"cmd": "echo line1; echo line2 >&2", "capture": "out"},
+            "bash",
+        )
+
+        assert action_state.session.resolve("{{ out }}") == "line1\nline2\n"
+        assert "line1\nline2\n" in capfd.readouterr().out
+
+    def test_capture_tee2(self, capfd):
+        # Output is displayed for a failing command
+        action_state = bdast_v2.ActionState("test", "")
+
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_command(
+                action_state,
+                {"cmd": "echo failure output; exit 3", "capture": "out"},
+                "bash",
+            )
+
+        assert "failure output" in capfd.readouterr().out
+        assert "out" not in action_state._vars
+
+    def test_capture_max_bytes1(self):
+        # Only the beginning and end of the output are kept
+        action_state = bdast_v2.ActionState("test", "")
+
+        bdast_v2.process_step_command(
+            action_state,
+            {
+                "cmd": "printf 'head'; head -c 10000 /dev/zero | tr '\\0' 'x'; printf 'tail'",
+                "capture": "out",
+                "capture_max_bytes": 100,
+            },
+            "bash",
+        )
+
+        out = action_state._vars["out"]
+        assert out.startswith("headxxx")
+        assert out.endswith("xxxtail")
+        assert "[... 9908 bytes of output omitted ...]" in out
+
+    def test_capture_max_bytes2(self):
+        # Output within the limit is kept in full
+        action_state = bdast_v2.ActionState("test", "")
+
+        bdast_v2.process_step_command(
+            action_state,
+            {"cmd": "printf 'short'", "capture": "out", "capture_max_bytes": 100},
+            "bash",
+        )
+
+        assert action_state._vars["out"] == "short"
+
+    def test_capture_max_bytes3(self):
+        action_state = bdast_v2.ActionState("test", "")
+
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_command(
+                action_state,
+                {"cmd": "true", "capture": "out", "capture_max_bytes": 0},
+                "bash",
+            )
+
+    def test_capture_text1(self):
+        # Output is decoded as utf-8 with universal newlines
+        action_state = bdast_v2.ActionState("test", "")
+
+        bdast_v2.process_step_command(
+            action_state,
+            {"cmd": "printf 'caf\\xc3\\xa9\\r\\nend'", "capture": "out"},
+            "bash",
+        )
+
+        assert action_state._vars["out"] == "café\nend"
+
+    def test_capture_spill2(self):
+        # Spilled output can be stripped
+        action_state = bdast_v2.ActionState("test", "", {"spill_threshold": 1000})
+
+        bdast_v2.process_step_command(
+            action_state,
+            {
+                "cmd": "echo; head -c 5000 /dev/zero | tr '\\0' 'a'; echo",
+                "capture": "out",
+                "capture_strip": True,
+            },
+            "bash",
+        )
+
+        assert isinstance(action_state._vars["out"], bdast_v2.SpilledText)
+        assert action_state.session.resolve("{{ out }}") == "a" * 5000
+
+        action_state.close()
+
+    def test_input1(self):
+        # Large scripts don't block when the command produces output early
+        action_state = bdast_v2.ActionState("test", "")
+
+        script = "head -c 200000 /dev/zero\n" + ("# padding\n" * 20000)
+        bdast_v2.process_step_command(
+            action_state, {"cmd": script, "capture": "out"}, "bash"
+        )
+
+        assert len(action_state._vars["out"]) == 200000
+
+    def test_capture_file1(self, tmp_path, capfd):
+        # Output is written to the file, not the console
+        action_state = bdast_v2.ActionState("test", "")
+        target = tmp_path / "output.bin"
+
+        bdast_v2.process_step_command(
+            action_state,
+            {
+                "cmd": "printf 'file content'; echo error output >&2",
+                "capture_file": str(target),
+                "capture": "out",
+            },
+            "bash",
+        )
+
+        assert target.read_bytes() == b"file content"
+        assert action_state._vars["out"] == {"path": str(target), "size": 12}
+
+        output = capfd.readouterr()
+        assert "file content" not in output.out
+        assert "error output" in output.err
+
+    def test_capture_file2(self, tmp_path):
+        # capture is optional with capture_file
+        action_state = bdast_v2.ActionState("test", "")
+        target = tmp_path / "output.bin"
+
+        bdast_v2.process_step_command(
+            action_state,
+            {"cmd": "echo content", "capture_file": str(target)},
+            "command",
+        )
+
+        assert target.read_text() == "content\n"
+
+    def test_capture_file3(self, tmp_path):
+        # capture_strip doesn't apply to files
+        action_state = bdast_v2.ActionState("test", "")
+
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_command(
+                action_state,
+                {
+                    "cmd": "true",
+                    "capture_file": str(tmp_path / "output.bin"),
+                    "capture_strip": True,
+                },
+                "bash",
+            )
+
+    def test_reuse_interpreter1(self):
+        # Steps share the same interpreter
+        action_state = bdast_v2.ActionState("test", "")
+
+        for name in ("first", "second"):
+            bdast_v2.process_step_command(
+                action_state,
+                {"cmd": "echo $$", "capture": name, "reuse_interpreter": True},
+                "bash",
+            )
+
+        assert action_state._vars["first"] == action_state._vars["second"]
+
+        action_state.close()
+
+    def test_reuse_interpreter2(self, tmp_path):
+        # Working directory, vars and env are not shared between steps
+        action_state = bdast_v2.ActionState("test", "")
+        cwd = os.getcwd()
+
+        bdast_v2.process_step_command(
+            action_state,
+            {
+                "cmd": f"export BDAST_TEST_VAR=1; LOCAL=2; cd {tmp_path}",
+                "reuse_interpreter": True,
+            },
+            "bash",
+        )
+        bdast_v2.process_step_command(
+            action_state,
+            {
+                "cmd": 'echo "${BDAST_TEST_VAR:-unset} ${LOCAL:-unset} $PWD"',
+                "capture": "out",
+                "capture_strip": True,
+                "reuse_interpreter": True,
+            },
+            "bash",
+        )
+
+        assert action_state._vars["out"] == f"unset unset {cwd}"
+
+        action_state.close()
+
+    def test_reuse_interpreter3(self):
+        # Exit status is reported and the interpreter is still usable
+        action_state = bdast_v2.ActionState("test", "")
+
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_command(
+                action_state,
+                {"cmd": "echo partial; exit 3", "reuse_interpreter": True},
+                "bash",
+            )
+
+        bdast_v2.process_step_command(
+            action_state,
+            {
+                "cmd": "printf 'caf\\xc3\\xa9 no newline'",
+                "capture": "out",
+                "reuse_interpreter": True,
+            },
+            "bash",
+        )
+
+        assert action_state._vars["out"] == "café no newline"
+
+        action_state.close()
+
+    def test_reuse_interpreter4(self):
+        # Steps with different environments use different interpreters
+        action_state = bdast_v2.ActionState("test", "")
+
+        for name, value in (("first", "1"), ("second", "2"), ("third", "1")):
+            bdast_v2.process_step_command(
+                action_state,
+                {
+                    "cmd": 'echo "$$ $VALUE"',
+                    "capture": name,
+                    "env": {"VALUE": value},
+                    "reuse_interpreter": True,
+                },
+                "bash",
+            )
+
+        first = action_state._vars["first"].split()
+        second = action_state._vars["second"].split()
+        third = action_state._vars["third"].split()
+
+        assert first[1] == "1" and second[1] == "2" and third[1] == "1"
+        assert first[0] != second[0]
+        assert first[0] == third[0]
+
+        action_state.close()
+
+    def test_reuse_interpreter5(self):
+        # Scripts with multibyte characters, quotes and large output
+        action_state = bdast_v2.ActionState("test", "")
+
+        script = "echo 'ünïcödé \"quoted\"'\nhead -c 300000 /dev/zero | tr '\\0' 'z'\n"
+        bdast_v2.process_step_command(
+            action_state,
+            {"cmd": script, "capture": "out", "reuse_interpreter": True},
+            "bash",
+        )
+
+        out = action_state._vars["out"]
+        assert out.startswith('ünïcödé "quoted"\nzzz')
+        assert len(out) == 300000 + 17
+
+        action_state.close()
+
+    def test_reuse_interpreter6(self):
+        # Only bash and pwsh are supported
+        action_state = bdast_v2.ActionState("test", "")
+
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_command(
+                action_state,
+                {"cmd": "true", "reuse_interpreter": True},
+                "command",
+            )
+
+    @pytest.mark.skipif(shutil.which("pwsh") is None, reason="pwsh is not installed")
+    def test_reuse_interpreter8(self, capfd):
+        # pwsh steps report the script status and display output
+        action_state = bdast_v2.ActionState("test", "")
+
+        bdast_v2.process_step_command(
+            action_state,
+            {
+                "cmd": "Write-Output 'from pwsh'",
+                "capture": "out",
+                "capture_strip": True,
+                "reuse_interpreter": True,
+            },
+            "pwsh",
+        )
+
+        assert action_state._vars["out"] == "from pwsh"
+        assert "from pwsh" in capfd.readouterr().out
+
+        # A failing native command at the end of the script fails the step
+        with pytest.raises(BdastRunException, match="4"):
+            bdast_v2.process_step_command(
+                action_state,
+                {"cmd": "bash -c 'exit 4'", "reuse_interpreter": True},
+                "pwsh",
+            )
+
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_command(
+                action_state,
+                {"cmd": "Write-Error 'failed'", "reuse_interpreter": True},
+                "pwsh",
+            )
+
+        # Earlier failures don't fail a script that completes successfully
+        bdast_v2.process_step_command(
+            action_state,
+            {
+                "cmd": "bash -c 'exit 4'\nWrite-Output 'after'",
+                "reuse_interpreter": True,
+            },
+            "pwsh",
+        )
+        assert "after" in capfd.readouterr().out
+
+        action_state.close()
+
+    def test_reuse_interpreter7(self):
+        # Interpreters are stopped when the action state is closed
+        action_state = bdast_v2.ActionState("test", "")
+
+        bdast_v2.process_step_command(
+            action_state, {"cmd": "true", "reuse_interpreter": True}, "bash"
+        )
+
+        pool = action_state.get_interpreter_pool()
+        interpreters = list(pool._interpreters)
+        assert len(interpreters) == 1
+
+        action_state.close()
+
+        assert not interpreters[0].is_running()
+
+
+class TestSpawn:
+    def test_spawn1(self, capfd):
+        # Commands are started and the start is recorded
+        action_state = bdast_v2.ActionState("test", "")
+
+        bdast_v2.process_step_command(
+            action_state, {"cmd": "echo spawned", "capture": "out"}, "command"
+        )
+        bdast_v2.process_step_command(
+            action_state, {"cmd": "echo -n $VALUE", "env": {"VALUE": "x"}}, "bash"
+        )
+
+        assert action_state._vars["out"] == "spawned\n"
+        assert action_state.spawn_count == 2
+        assert action_state.spawn_time > 0
+
+        captured = capfd.readouterr()
+        assert "spawned" in captured.out
+        assert "x" in captured.out
+
+    def test_spawn2(self, monkeypatch):
+        # Process environments are read when each process is started
+        action_state = bdast_v2.ActionState("test", "")
+
+        first = action_state.get_process_env({"A": "1"})
+        monkeypatch.setenv("BDAST_SPAWN_TEST", "later")
+        second = action_state.get_process_env({"A": "2"})
+
+        assert first["A"] == "1" and second["A"] == "2"
+        assert "BDAST_SPAWN_TEST" not in first
+        assert second["BDAST_SPAWN_TEST"] == "later"
+        assert "PATH" in first
+
+        bdast_v2.process_step_command(
+            action_state,
+            {"cmd": "echo -n $BDAST_SPAWN_TEST", "capture": "out"},
+            "bash",
+        )
+        assert action_state._vars["out"] == "later"
+
+    def test_spawn3(self):
+        # Missing executables are reported
+        action_state = bdast_v2.ActionState("test", "")
+
+        with pytest.raises(FileNotFoundError):
+            bdast_v2.process_step_command(
+                action_state, {"cmd": "bdast-missing-executable"}, "command"
+            )
+
+    def test_spawn4(self):
+        # Spawned processes report the exit code and resources used, and support
+        # wait timeouts
+        proc, elapsed = bdast_v2.spawn_process(
+            ["sh", "-c", "sleep 0.3; exit 3"], {"env": os.environ.copy()}
+        )
+
+        assert isinstance(proc, subprocess.Popen)
+        assert elapsed >= 0
+
+        with pytest.raises(subprocess.TimeoutExpired):
+            proc.wait(timeout=0.05)
+
+        assert proc.wait() == 3
+        assert proc.rusage is not None
+
+    def test_spawn5(self):
+        # Processes can be started in their own process group
+        proc, _ = bdast_v2.spawn_process(["sleep", "5"], {"cwd": "/"}, new_group=True)
+
+        try:
+            assert os.getpgid(proc.pid) == proc.pid
+            assert os.getsid(proc.pid) == os.getsid(0)
+        finally:
+            proc.kill()
+            proc.wait()
+
+    def test_spawn6(self, capfd):
+        # Signals ignored by Python have their default handling in commands, so
+        # pipeline producers exit quietly on SIGPIPE
+        action_state = bdast_v2.ActionState("test", "")
+
+        bdast_v2.process_step_command(action_state, {"cmd": "yes | head -1"}, "bash")
+
+        captured = capfd.readouterr()
+        assert "y\n" in captured.out
+        assert "Broken pipe" not in captured.out
+        assert captured.err == ""
+
+        bdast_v2.process_step_command(
+            action_state,
+            {"cmd": "grep SigIgn /proc/self/status", "capture": "status"},
+            "command",
+        )
+
+        ignored = int(action_state._vars["status"].split()[1], 16)
+        assert ignored & (1 << (signal.SIGPIPE - 1)) == 0
+
+    def test_spawn7(self, tmp_path):
+        # Executables added to PATH after an earlier lookup are found
+        action_state = bdast_v2.ActionState("test", "")
+        path = f"{tmp_path}:{os.environ['PATH']}"
+
+        bdast_v2.process_step_command(
+            action_state, {"cmd": "true", "env": {"PATH": path}}, "command"
+        )
+
+        executable = tmp_path / "true"
+        executable.write_text("#!/bin/sh\necho replaced\n")
+        executable.chmod(0o755)
+
+        bdast_v2.process_step_command(
+            action_state,
+            {"cmd": "true", "env": {"PATH": path}, "capture": "out"},
+            "command",
+        )
+
+        assert action_state._vars["out"] == "replaced\n"
+
+
+class TestTimeout:
+    def process_state(self, pid):
+        # State of a process, or None if it no longer exists
+        try:
+            with open(f"/proc/{pid}/stat", encoding="utf-8") as file:
+                return file.read().rsplit(")", 1)[1].split()[0]
+        except FileNotFoundError:
+            return None
+
+    def test_timeout1(self, tmp_path):
+        # The whole process group is stopped on timeout
+        action_state = bdast_v2.ActionState("test", "")
+        action_state.limit_deadline(0.5, "test timeout")
+        pid_file = tmp_path / "pid"
+
+        with pytest.raises(BdastRunException, match="test timeout"):
+            bdast_v2.process_step_command(
+                action_state,
+                {"cmd": f"sleep 30 & echo $! > {pid_file}; wait"},
+                "bash",
+            )
+
+        pid = int(pid_file.read_text(encoding="utf-8"))
+        time.sleep(0.2)
+        assert self.process_state(pid) in (None, "Z")
+
+    def test_timeout2(self, monkeypatch):
+        # Processes ignoring SIGTERM are killed after the grace period
+        monkeypatch.setattr(bdast_v2, "TERMINATE_GRACE_PERIOD", 0.2)
+        action_state = bdast_v2.ActionState("test", "")
+        action_state.limit_deadline(0.3, "test timeout")
+
+        start = time.monotonic()
+        with pytest.raises(BdastRunException, match="test timeout"):
+            bdast_v2.process_step_command(
+                action_state,
+                {"cmd": "trap '' TERM; sleep 30", "capture": "out"},
+                "bash",
+            )
+
+        assert time.monotonic() - start < 10
+
+    def test_timeout3(self):
+        # Reused interpreters are stopped on timeout and not reused
+        action_state = bdast_v2.ActionState("test", "")
+        previous = action_state.limit_deadline(0.5, "test timeout")
+
+        with pytest.raises(BdastRunException, match="test timeout"):
+            bdast_v2.process_step_command(
+                action_state, {"cmd": "sleep 30", "reuse_interpreter": True}, "bash"
+            )
+
+        action_state.deadline = previous
+        bdast_v2.process_step_command(
+            action_state,
+            {"cmd": "echo -n ok", "capture": "out", "reuse_interpreter": True},
+            "bash",
+        )
+
+        assert action_state._vars["out"] == "ok"
+        action_state.close()
+
+    def test_timeout4(self):
+        # Commands finishing within the timeout are unaffected
+        action_state = bdast_v2.ActionState("test", "", run_options={"deadline": 30})
+
+        bdast_v2.process_step_command(
+            action_state, {"cmd": "echo -n ok", "capture": "out"}, "command"
+        )
+
+        assert action_state._vars["out"] == "ok"
+
+
+class TestResources:
+    def test_resources1(self, capfd):
+        # Resource usage is reported and stored
+        action_state = bdast_v2.ActionState("test", "")
+
+        bdast_v2.process_step_command(
+            action_state,
+            {
+                "cmd": "i=0; while [ $i -lt 20000 ]; do i=$((i+1)); done",
+                "resources": "usage",
+            },
+            "bash",
+        )
+
+        usage = action_state._vars["usage"]
+        assert usage["user_time"] + usage["system_time"] > 0
+        assert usage["max_rss"] > 1024 * 1024
+        assert usage["elapsed"] > 0
+        for key in (
+            "block_input",
+            "block_output",
+            "voluntary_switches",
+            "involuntary_switches",
+        ):
+            assert isinstance(usage[key], int)
+
+        assert "RESOURCES: elapsed" in capfd.readouterr().out
+
+    def test_resources2(self):
+        # Usage includes the children of the process
+        action_state = bdast_v2.ActionState("test", "")
+
+        bdast_v2.process_step_command(
+            action_state,
+            {
+                "cmd": "bash -c 'i=0; while [ $i -lt 50000 ]; do i=$((i+1)); done'",
+                "resources": "usage",
+                "capture": "out",
+            },
+            "bash",
+        )
+
+        assert action_state._vars["usage"]["user_time"] > 0.01
+
+    def test_resources3(self):
+        # Resources aren't available for reused interpreters
+        action_state = bdast_v2.ActionState("test", "")
+
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_command(
+                action_state,
+                {"cmd": "true", "resources": "usage", "reuse_interpreter": True},
+                "bash",
+            )
@@ -0,0 +1,164 @@
+import os
+import subprocess
+import pytest
+import bdast
+from bdast import bdast_v2
+from bdast.exception import BdastRunException
+from bdast.exception import BdastLoadException
+from bdast.exception import BdastArgumentException
+
+
+def git(repo, *args):
+    env = {
+        **os.environ,
+        "GIT_AUTHOR_NAME": "test",
+        "GIT_AUTHOR_EMAIL": "test@example.com",
+        "GIT_COMMITTER_NAME": "test",
+        "GIT_COMMITTER_EMAIL": "test@example.com",
+    }
+
+    proc = subprocess.run(
+        ["git", "-C", str(repo), *args],
+        check=True,
+        stdout=subprocess.PIPE,
+        text=True,
+        env=env,
+    )
+
+    return proc.stdout.strip()
+
+
+@pytest.fixture
+def repo(tmp_path):
+    path = tmp_path / "repo"
+    path.mkdir()
+    git(path, "init", "-q", "-b", "main")
+
+    for name in ("first", "second"):
+        (path / name).write_text(name)
+        git(path, "add", name)
+        git(path, "commit", "-q", "-m", name)
+
+    git(path, "tag", "v1.9.0", "HEAD~1")
+    git(path, "tag", "v1.10.0")
+    git(path, "tag", "-a", "-m", "release", "v1.10.0-annotated")
+
+    return path
+
+
+def run_git_step(path, **options):
+    action_state = bdast_v2.ActionState("test", "")
+    bdast_v2.process_step_git(
+        action_state, {"path": str(path), "store": "git", **options}
+    )
+
+    return action_state._vars["git"]
+
+
+class TestIntProcessStepGit:
+    def test_head1(self, repo, monkeypatch):
+        # Loose refs and objects are read without running git
+        def no_run(*args, **kwargs):
+            raise AssertionError("git was run")
+
+        monkeypatch.setattr(bdast_v2.subprocess, "run", no_run)
+        result = run_git_step(repo)
+        monkeypatch.undo()
+
+        assert result["branch"] == "main"
+        assert result["commit"] == git(repo, "rev-parse", "HEAD")
+        assert result["short_commit"] == result["commit"][:7]
+        assert result["detached"] is False
+        assert result["head_tags"] == ["v1.10.0", "v1.10.0-annotated"]
+        assert result["tags"] == ["v1.9.0", "v1.10.0", "v1.10.0-annotated"]
+
+    def test_head2(self, repo):
+        # Detached HEAD has no branch
+        git(repo, "checkout", "-q", "v1.9.0")
+
+        result = run_git_step(repo / "first")
+
+        assert result["branch"] == ""
+        assert result["detached"] is True
+        assert result["commit"] == git(repo, "rev-parse", "HEAD")
+        assert result["head_tags"] == ["v1.9.0"]
+
+    def test_packed1(self, repo, monkeypatch):
+        # Packed refs are read, with annotated tags peeled from packed-refs
+        git(repo, "pack-refs", "--all")
+        assert not (repo / ".git" / "refs" / "tags" / "v1.9.0").exists()
+
+        def no_run(*args, **kwargs):
+            raise AssertionError("git was run")
+
+        monkeypatch.setattr(bdast_v2.subprocess, "run", no_run)
+        result = run_git_step(repo)
+        monkeypatch.undo()
+
+        assert result["branch"] == "main"
+        assert result["commit"] == git(repo, "rev-parse", "HEAD")
+        assert result["head_tags"] == ["v1.10.0", "v1.10.0-annotated"]
+        assert result["tags"] == ["v1.9.0", "v1.10.0", "v1.10.0-annotated"]
+
+    def test_packed2(self, repo):
+        # Tag objects only available in a pack are resolved with git
+        git(repo, "gc", "-q")
+        tag_object = git(repo, "rev-parse", "v1.10.0-annotated")
+        (repo / ".git" / "refs" / "tags" / "copy").write_text(tag_object + "\n")
+
+        bdast_v2.PEELED_OBJECT_CACHE.pop(tag_object, None)
+        result = run_git_step(repo)
+
+        assert "copy" in result["head_tags"]
+        assert result["commit"] == git(repo, "rev-parse", "HEAD")
+
+    def test_packed3(self, repo, monkeypatch):
+        # A missing git binary is reported when packed objects need resolving
+        git(repo, "gc", "-q")
+        tag_object = git(repo, "rev-parse", "v1.10.0-annotated")
+        (repo / ".git" / "refs" / "tags" / "copy").write_text(tag_object + "\n")
+
+        bdast_v2.PEELED_OBJECT_CACHE.pop(tag_object, None)
+        monkeypatch.setenv("PATH", "")
+
+        with pytest.raises(BdastRunException, match="git binary"):
+            run_git_step(repo)
+
+    def test_symref1(self, repo):
+        # Symbolic ref cycles are reported
+        heads = repo / ".git" / "refs" / "heads"
+        (heads / "loop1").write_text("ref: refs/heads/loop2\n")
+        (heads / "loop2").write_text("ref: refs/heads/loop1\n")
+        (repo / ".git" / "HEAD").write_text("ref: refs/heads/loop1\n")
+
+        with pytest.raises(BdastRunException):
+            run_git_step(repo)
+
+    def test_worktree1(self, repo, tmp_path):
+        # Linked worktrees have their own HEAD, sharing refs with the repository
+        worktree = tmp_path / "worktree"
+        git(repo, "worktree", "add", "-q", "-b", "feature", str(worktree), "v1.9.0")
+
+        result = run_git_step(worktree)
+
+        assert result["branch"] == "feature"
+        assert result["commit"] == git(worktree, "rev-parse", "HEAD")
+        assert result["head_tags"] == ["v1.9.0"]
+        assert len(result["tags"]) == 3
+
+    def test_unborn1(self, tmp_path):
+        # Repositories without commits have a branch, but no commit
+        git(tmp_path, "init", "-q", "-b", "main")
+
+        result = run_git_step(tmp_path)
+
+        assert result["branch"] == "main"
+        assert result["commit"] == ""
+        assert result["tags"] == []
+
+    def test_params1(self, tmp_path):
+        with pytest.raises(BdastRunException):
+            run_git_step(tmp_path)
+
+        with pytest.raises(BdastRunException):
+            run_git_step(tmp_path, store="")
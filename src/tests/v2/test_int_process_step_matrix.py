@@ -0,0 +1,166 @@
+import os
+import time
+import pytest
+import bdast
+from bdast import bdast_v2
+from bdast.exception import BdastRunException
+from bdast.exception import BdastLoadException
+from bdast.exception import BdastArgumentException
+
+
+class TestIntProcessStepMatrix:
+    def test_matrix1(self):
+        # A step is run for each combination, with results stored by combination
+        action_state = bdast_v2.ActionState("test", "")
+        action_state.update_vars({"suffix": "x"})
+
+        bdast_v2.process_step_matrix(
+            action_state,
+            {
+                "axes": {"python": ["3.11", "3.12"], "arch": ["amd64", "arm64"]},
+                "step": {
+                    "command": {
+                        "cmd": "echo -n {{ matrix.python }}-{{ matrix.arch }}-{{ suffix }}",
+                        "capture": "out",
+                    }
+                },
+                "store": "results",
+            },
+        )
+
+        results = action_state._vars["results"]
+        assert list(results.keys()) == [
+            "python=3.11,arch=amd64",
+            "python=3.11,arch=arm64",
+            "python=3.12,arch=amd64",
+            "python=3.12,arch=arm64",
+        ]
+        assert results["python=3.12,arch=arm64"] == {"out": "3.12-arm64-x"}
+
+        # Vars set by combinations are only available through the store
+        assert "out" not in action_state._vars
+        assert "matrix" not in action_state._vars
+
+    def test_matrix2(self):
+        # Combinations run concurrently, up to max_parallel
+        action_state = bdast_v2.ActionState("test", "")
+
+        start = time.monotonic()
+        bdast_v2.process_step_matrix(
+            action_state,
+            {
+                "axes": {"n": [1, 2, 3, 4]},
+                "step": {"command": {"cmd": "sleep 0.5"}},
+                "max_parallel": 2,
+            },
+        )
+
+        elapsed = time.monotonic() - start
+        assert 0.9 < elapsed < 1.8
+
+    def test_matrix3(self, capfd):
+        # Output from each combination is displayed in one piece
+        action_state = bdast_v2.ActionState("test", "")
+
+        bdast_v2.process_step_matrix(
+            action_state,
+            {
+                "axes": {"n": ["a", "b"]},
+                "step": {
+                    "name": "step {{ matrix.n }}",
+                    "bash": {
+                        "cmd": "for i in 1 2 3; do echo {{ matrix.n }}$i; sleep 0.05; done"
+                    },
+                },
+            },
+        )
+
+        out = capfd.readouterr().out
+        for name in ("a", "b"):
+            index = out.index(f"STEP: step {name}")
+            assert out[index:].split("\n")[1:4] == [f"{name}1", f"{name}2", f"{name}3"]
+
+    def test_matrix4(self):
+        # Failed combinations fail the step
+        action_state = bdast_v2.ActionState("test", "")
+
+        with pytest.raises(BdastRunException, match="1 of 3 matrix combinations"):
+            bdast_v2.process_step_matrix(
+                action_state,
+                {
+                    "axes": {"code": [0, 1, 0]},
+                    "step": {"command": {"cmd": "sh -c 'exit {{ matrix.code }}'"}},
+                    "fail_fast": False,
+                },
+            )
+
+    def test_matrix5(self, tmp_path):
+        # With fail_fast, combinations aren't started after a failure
+        action_state = bdast_v2.ActionState("test", "")
+
+        with pytest.raises(BdastRunException, match="1 of 3 matrix combinations"):
+            bdast_v2.process_step_matrix(
+                action_state,
+                {
+                    "axes": {"n": [1, 2, 3]},
+                    "step": {
+                        "bash": {
+                            "cmd": f"touch {tmp_path}/{{{{ matrix.n }}}}; "
+                            "[ {{ matrix.n }} -ne 1 ]"
+                        }
+                    },
+                    "max_parallel": 1,
+                },
+            )
+
+        assert sorted(x.name for x in tmp_path.iterdir()) == ["1"]
+
+    def test_params1(self):
+        action_state = bdast_v2.ActionState("test", "")
+
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_matrix(
+                action_state, {"axes": {}, "step": {"nop": {}}}
+            )
+
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_matrix(
+                action_state, {"axes": {"a": []}, "step": {"nop": {}}}
+            )
+
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_matrix(
+                action_state,
+                {"axes": {"a": [1]}, "step": {"nop": {}}, "max_parallel": 0},
+            )
+
+
+class TestIntActionStateFork:
+    def test_fork1(self):
+        # Forks have their own vars and record updates
+        action_state = bdast_v2.ActionState("test", "")
+        action_state.update_vars({"a": 1})
+
+        fork = action_state.fork()
+        fork.update_vars({"b": 2})
+
+        assert fork._vars["a"] == 1
+        assert "b" not in action_state._vars
+        assert fork.var_updates == {"b": 2}
+        assert action_state.var_updates is None
+
+    def test_fork2(self):
+        # Forks share processes and spilled values with the original state
+        action_state = bdast_v2.ActionState("test", "")
+        fork = action_state.fork()
+
+        assert fork.get_interpreter_pool() is action_state.get_interpreter_pool()
+
+        file, path = fork.create_spill_file()
+        file.close()
+
+        fork.close()
+        assert os.path.exists(path)
+
+        action_state.close()
+        assert not os.path.exists(path)
@@ -0,0 +1,170 @@
+import pytest
+import bdast
+from bdast import bdast_v2
+from bdast.exception import BdastRunException
+from bdast.exception import BdastLoadException
+from bdast.exception import BdastArgumentException
+
+HELPER_MODULE = """
+def bump(step_vars, amount=1):
+    return {"count": step_vars["count"] + amount}
+
+
+class Helpers:
+    @staticmethod
+    def name(step_vars):
+        return {"name": step_vars["bdast"]["action_name"]}
+"""
+
+
+class TestIntProcessStepPython:
+    def test_code1(self):
+        # Code can read resolved vars and return vars through 'result'
+        action_state = bdast_v2.ActionState("test", "")
+        action_state.update_vars({"base": 2, "text": "value {{ base }}"})
+
+        bdast_v2.process_step_python(
+            action_state,
+            {"code": "result = {'double': vars['base'] * 2, 'copy': vars['text']}"},
+        )
+
+        assert action_state._vars["double"] == 4
+        assert action_state._vars["copy"] == "value 2"
+
+    def test_code2(self):
+        # Code without a result leaves vars unchanged and vars are read only
+        action_state = bdast_v2.ActionState("test", "")
+        action_state.update_vars({"a": 1})
+
+        bdast_v2.process_step_python(action_state, {"code": "x = {'a': 2}"})
+        assert action_state._vars["a"] == 1
+
+        with pytest.raises(TypeError):
+            bdast_v2.process_step_python(action_state, {"code": "vars['a'] = 2"})
+
+    def test_code3(self):
+        # Results must be a dict
+        action_state = bdast_v2.ActionState("test", "")
+
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_python(action_state, {"code": "result = [1]"})
+
+    def test_function1(self, tmp_path, monkeypatch):
+        # Functions are imported relative to the working directory
+        (tmp_path / "bdast_test_helpers.py").write_text(HELPER_MODULE, encoding="utf-8")
+        monkeypatch.chdir(tmp_path)
+
+        action_state = bdast_v2.ActionState("test", "")
+        action_state.update_vars({"count": 1})
+
+        bdast_v2.process_step_python(
+            action_state,
+            {"function": "bdast_test_helpers:bump", "args": {"amount": 5}},
+        )
+        bdast_v2.process_step_python(
+            action_state, {"function": "bdast_test_helpers:Helpers.name"}
+        )
+
+        assert action_state._vars["count"] == 6
+        assert action_state._vars["name"] == "test"
+
+    def test_params1(self):
+        # Exactly one of code or function is required
+        action_state = bdast_v2.ActionState("test", "")
+
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_python(action_state, {})
+
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_python(
+                action_state, {"code": "pass", "function": "os:getcwd"}
+            )
+
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_python(
+                action_state, {"code": "pass", "args": {"a": 1}}
+            )
+
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_python(action_state, {"function": "os.getcwd"})
+
+    def test_isolate1(self, capfd):
+        # Isolated code runs in a separate process, with a copy of the vars
+        action_state = bdast_v2.ActionState("test", "")
+        action_state.update_vars({"base": 3, "later": "{{ not_set_yet }}"})
+
+        bdast_v2.process_step_python(
+            action_state,
+            {
+                "code": "import os\n"
+                "print('isolated output')\n"
+                "result = {'pid': os.getpid(), 'value': vars['base'] + 1,\n"
+                "          'has_later': 'later' in vars}\n",
+                "isolate": True,
+            },
+        )
+
+        import os
+
+        assert action_state._vars["pid"] != os.getpid()
+        assert action_state._vars["value"] == 4
+        assert action_state._vars["has_later"] is False
+        assert "isolated output" in capfd.readouterr().out
+
+    def test_isolate2(self, tmp_path, monkeypatch):
+        # Isolated functions and failures
+        (tmp_path / "bdast_test_helpers.py").write_text(HELPER_MODULE, encoding="utf-8")
+        monkeypatch.chdir(tmp_path)
+
+        action_state = bdast_v2.ActionState("test", "")
+        action_state.update_vars({"count": 1})
+
+        bdast_v2.process_step_python(
+            action_state,
+            {
+                "function": "bdast_test_helpers:bump",
+                "args": {"amount": 2},
+                "isolate": True,
+            },
+        )
+        assert action_state._vars["count"] == 3
+
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_python(
+                action_state, {"code": "raise ValueError()", "isolate": True}
+            )
+
+    def test_isolate3(self, http_server):
+        # Stored url responses reach isolated code as mappings, as for in-process
+        # code
+        http_server.routes["/data"] = (200, {"X-Test": "1"}, "content")
+        action_state = bdast_v2.ActionState("test", "")
+
+        bdast_v2.process_step_url(
+            action_state,
+            {"url": f"{http_server.url}/data", "method": "get", "store": "response"},
+        )
+
+        code = (
+            "result = {'header': vars['response']['headers']['X-Test'],\n"
+            "          'text': vars['response']['text']}\n"
+        )
+        for isolate in (False, True):
+            bdast_v2.process_step_python(
+                action_state, {"code": code, "isolate": isolate}
+            )
+
+            assert action_state._vars["header"] == "1"
+            assert action_state._vars["text"] == "content"
+
+        action_state.close()
+
+    def test_isolate4(self):
+        # Vars that can't be passed to the isolated process are reported
+        action_state = bdast_v2.ActionState("test", "")
+        action_state.update_vars({"value": object()})
+
+        with pytest.raises(BdastRunException, match="value"):
+            bdast_v2.process_step_python(
+                action_state, {"code": "result = None", "isolate": True}
+            )
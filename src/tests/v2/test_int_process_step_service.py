@@ -0,0 +1,208 @@
+import socket
+import sys
+import time
+import pytest
+import bdast
+from bdast import bdast_v2
+from bdast.exception import BdastRunException
+from bdast.exception import BdastLoadException
+from bdast.exception import BdastArgumentException
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class TestIntProcessStepService:
+    def test_tcp1(self):
+        # Services are left running once the tcp probe succeeds
+        action_state = bdast_v2.ActionState("test", "")
+        port = free_port()
+
+        bdast_v2.process_step_service(
+            action_state,
+            {
+                "cmd": f"{sys.executable} -m http.server --bind 127.0.0.1 {port}",
+                "ready": {"tcp": f"127.0.0.1:{port}", "timeout": 20},
+            },
+        )
+
+        assert bdast_v2.probe_tcp(f"127.0.0.1:{port}")
+
+        action_state.close()
+        assert not bdast_v2.probe_tcp(f"127.0.0.1:{port}")
+
+    def test_http1(self):
+        # http probes wait for a successful response
+        action_state = bdast_v2.ActionState("test", "")
+        port = free_port()
+
+        bdast_v2.process_step_service(
+            action_state,
+            {
+                "cmd": f"{sys.executable} -m http.server --bind 127.0.0.1 {port}",
+                "ready": {"http": f"http://127.0.0.1:{port}/", "timeout": 20},
+            },
+        )
+
+        bdast_v2.process_step_url(
+            action_state,
+            {"url": f"http://127.0.0.1:{port}/", "method": "get", "store": "response"},
+        )
+        assert action_state._vars["response"]["status_code"] == 200
+
+        action_state.close()
+
+    def test_http2(self, http_server, tmp_path):
+        # http probes reach the service, even when url steps replay responses
+        http_server.routes["/health"] = (200, {}, "ok")
+        action_state = bdast_v2.ActionState(
+            "test", "", run_options={"http_replay": str(tmp_path)}
+        )
+
+        bdast_v2.process_step_service(
+            action_state,
+            {"cmd": "sleep 30", "ready": {"http": f"{http_server.url}/health"}},
+        )
+
+        assert len(http_server.requests) == 1
+        assert action_state.get_http_pool().get_stats() == {}
+
+        action_state.close()
+
+    def test_log1(self, capfd):
+        # Log probes match service output
+        action_state = bdast_v2.ActionState("test", "")
+
+        start = time.monotonic()
+        bdast_v2.process_step_service(
+            action_state,
+            {
+                "cmd": "echo starting; sleep 0.2; echo 'listening on 1234'; sleep 30",
+                "shell": True,
+                "ready": {"log": "listening on [0-9]+"},
+            },
+        )
+
+        assert time.monotonic() - start < 10
+        action_state.close()
+
+        assert "listening on 1234" in capfd.readouterr().out
+
+    def test_file1(self, tmp_path):
+        # File probes wait for the file to exist
+        action_state = bdast_v2.ActionState("test", "")
+        ready_file = tmp_path / "ready"
+
+        bdast_v2.process_step_service(
+            action_state,
+            {
+                "cmd": f"sleep 0.2; touch {ready_file}; sleep 30",
+                "shell": True,
+                "ready": {"file": str(ready_file)},
+            },
+        )
+
+        assert ready_file.exists()
+        action_state.close()
+
+    def test_file2(self, tmp_path):
+        # Probes continue after a service closes its output and keeps running
+        action_state = bdast_v2.ActionState("test", "")
+        ready_file = tmp_path / "ready"
+
+        bdast_v2.process_step_service(
+            action_state,
+            {
+                "cmd": f"exec >/dev/null 2>&1; sleep 0.3; touch {ready_file}; sleep 30",
+                "shell": True,
+                "ready": {"file": str(ready_file), "timeout": 10},
+            },
+        )
+
+        assert ready_file.exists()
+        action_state.close()
+
+    def test_fail1(self):
+        # Services exiting before they are ready fail the step
+        action_state = bdast_v2.ActionState("test", "")
+
+        with pytest.raises(BdastRunException, match="exited before it was ready"):
+            bdast_v2.process_step_service(
+                action_state,
+                {"cmd": "exit 3", "shell": True, "ready": {"log": "never"}},
+            )
+
+        action_state.close()
+
+    def test_fail2(self):
+        # Services not ready within the timeout fail the step
+        action_state = bdast_v2.ActionState("test", "")
+
+        with pytest.raises(BdastRunException, match="not ready within"):
+            bdast_v2.process_step_service(
+                action_state,
+                {"cmd": "sleep 30", "ready": {"log": "never", "timeout": 0.3}},
+            )
+
+        action_state.close()
+
+    def test_params1(self):
+        # Only a single, known probe is accepted
+        action_state = bdast_v2.ActionState("test", "")
+
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_service(
+                action_state,
+                {"cmd": "true", "ready": {"log": "a", "file": "b"}},
+            )
+
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_service(
+                action_state, {"cmd": "true", "ready": {"unknown": 1}}
+            )
+
+
+class TestSpecStepService:
+    def test_stop_after1(self):
+        # Services are stopped after the end of the group
+        port = free_port()
+        closed = (
+            "import socket, sys; sock = socket.socket(); "
+            f"sys.exit(sock.connect_ex(('127.0.0.1', {port})) == 0)"
+        )
+        opened = f"import socket; socket.create_connection(('127.0.0.1', {port}))"
+
+        spec = bdast_v2.BdastSpec(
+            {
+                "version": "2alpha",
+                "steps": {
+                    "+server": {},
+                    "server": {
+                        "during": ["+server"],
+                        "service": {
+                            "cmd": f"{sys.executable} -m http.server --bind 127.0.0.1 {port}",
+                            "ready": {"tcp": f"127.0.0.1:{port}"},
+                            "stop_after": "+server",
+                        },
+                    },
+                    "test": {
+                        "during": ["+server"],
+                        "after": ["server"],
+                        "command": {"cmd": f'{sys.executable} -c "{opened}"'},
+                    },
+                    "after": {
+                        "after": ["+server"],
+                        "command": {"cmd": f'{sys.executable} -c "{closed}"'},
+                    },
+                },
+                "actions": {"test": {"steps": ["+server", "after"]}},
+            }
+        )
+
+        action = spec.get_action("test")
+        action.run("")
+
+        assert not bdast_v2.probe_tcp(f"127.0.0.1:{port}")
@@ -0,0 +1,944 @@
+import hashlib
+import json
+import logging
+import pytest
+import bdast
+from bdast import bdast_v2
+from bdast.exception import BdastRunException
+from bdast.exception import BdastLoadException
+from bdast.exception import BdastArgumentException
+
+import requests
+import threading
+import time
+
+
+class TestIntProcessStepUrl:
+    def test_store1(self, http_server):
+        http_server.routes["/data"] = (200, {"X-Test": "1"}, "content")
+        action_state = bdast_v2.ActionState("test", "")
+
+        bdast_v2.process_step_url(
+            action_state,
+            {"url": f"{http_server.url}/data", "method": "get", "store": "response"},
+        )
+
+        response = action_state._vars["response"]
+        assert response["status_code"] == 200
+        assert response["text"] == "content"
+        assert response["headers"]["X-Test"] == "1"
+
+        action_state.close()
+
+    def test_pool1(self, http_server):
+        # Connections are reused between url steps to the same host
+        http_server.routes["/api"] = (200, {}, "ok")
+        action_state = bdast_v2.ActionState("test", "")
+
+        for _ in range(10):
+            bdast_v2.process_step_url(
+                action_state, {"url": f"{http_server.url}/api", "method": "get"}
+            )
+
+        assert len(http_server.requests) == 10
+        assert http_server.connections == 1
+
+        stats = action_state.get_http_pool().get_stats()
+        assert stats[http_server.url] == (10, 1)
+
+        action_state.close()
+
+    def test_pool2(self, http_server):
+        # Connections can be closed after each request
+        http_server.routes["/api"] = (200, {}, "ok")
+        action_state = bdast_v2.ActionState(
+            "test", "", run_options={"http_keep_alive": False}
+        )
+
+        for _ in range(3):
+            bdast_v2.process_step_url(
+                action_state, {"url": f"{http_server.url}/api", "method": "get"}
+            )
+
+        assert http_server.connections == 3
+
+        action_state.close()
+
+    def test_pool3(self, http_server, caplog):
+        # Sessions are separate by verify setting and stats are logged on close
+        http_server.routes["/api"] = (200, {}, "ok")
+        action_state = bdast_v2.ActionState("test", "")
+
+        pool = action_state.get_http_pool()
+        assert pool.get_session(http_server.url, True) is pool.get_session(
+            http_server.url + "/other", True
+        )
+        assert pool.get_session(http_server.url, True) is not pool.get_session(
+            http_server.url, False
+        )
+
+        bdast_v2.process_step_url(
+            action_state, {"url": f"{http_server.url}/api", "method": "get"}
+        )
+
+        with caplog.at_level(logging.DEBUG, logger="bdast.bdast_v2"):
+            action_state.close()
+
+        assert "1 requests over 1 connections" in caplog.text
+
+    def test_pool4(self):
+        with pytest.raises(BdastArgumentException):
+            bdast_v2.ActionState("test", "", run_options={"http_pool_size": 0})
+
+    def test_pool5(self, http_server):
+        # Cookies set by a response aren't sent by later url steps
+        http_server.routes["/login"] = (200, {"Set-Cookie": "token=secret"}, "ok")
+        http_server.routes["/api"] = (200, {}, "ok")
+        action_state = bdast_v2.ActionState("test", "")
+
+        for path in ("/login", "/api"):
+            bdast_v2.process_step_url(
+                action_state,
+                {"url": f"{http_server.url}{path}", "method": "get", "store": "r"},
+            )
+
+        assert "Cookie" not in http_server.requests[1]["headers"]
+        assert http_server.connections == 1
+
+        action_state.close()
+
+
+class TestIntProcessStepUrlDownload:
+    def test_download1(self, http_server, tmp_path):
+        # Content is written to the file and the file details are stored
+        content = bytes(range(256)) * 4096
+        http_server.routes["/file"] = (200, {}, content)
+        action_state = bdast_v2.ActionState("test", "")
+        target = tmp_path / "file.bin"
+
+        bdast_v2.process_step_url(
+            action_state,
+            {
+                "url": f"{http_server.url}/file",
+                "method": "get",
+                "download": str(target),
+                "checksum": "sha256:" + hashlib.sha256(content).hexdigest().upper(),
+                "store": "result",
+            },
+        )
+
+        assert target.read_bytes() == content
+
+        result = action_state._vars["result"]
+        assert result["path"] == str(target)
+        assert result["size"] == len(content)
+        assert result["sha256"] == hashlib.sha256(content).hexdigest()
+        assert result["status_code"] == 200
+        assert "text" not in result
+
+        action_state.close()
+
+    def test_download2(self, http_server, tmp_path):
+        # A checksum mismatch leaves the existing file in place
+        http_server.routes["/file"] = (200, {}, b"new content")
+        action_state = bdast_v2.ActionState("test", "")
+        target = tmp_path / "file.bin"
+        target.write_bytes(b"old content")
+
+        with pytest.raises(BdastRunException, match="Checksum mismatch"):
+            bdast_v2.process_step_url(
+                action_state,
+                {
+                    "url": f"{http_server.url}/file",
+                    "method": "get",
+                    "download": str(target),
+                    "checksum": hashlib.sha256(b"other").hexdigest(),
+                },
+            )
+
+        assert target.read_bytes() == b"old content"
+        assert [x.name for x in tmp_path.iterdir()] == ["file.bin"]
+
+        action_state.close()
+
+    def test_download3(self, http_server, tmp_path):
+        # Failed requests don't create the file
+        action_state = bdast_v2.ActionState("test", "")
+        target = tmp_path / "file.bin"
+
+        with pytest.raises(requests.exceptions.HTTPError):
+            bdast_v2.process_step_url(
+                action_state,
+                {
+                    "url": f"{http_server.url}/missing",
+                    "method": "get",
+                    "download": str(target),
+                },
+            )
+
+        assert list(tmp_path.iterdir()) == []
+
+        action_state.close()
+
+    def test_params1(self):
+        action_state = bdast_v2.ActionState("test", "")
+
+        # checksum requires download
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_url(
+                action_state,
+                {"url": "http://127.0.0.1:1/", "checksum": "0" * 64},
+            )
+
+        # checksum must be a sha256 digest
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_url(
+                action_state,
+                {"url": "http://127.0.0.1:1/", "download": "x", "checksum": "abc"},
+            )
+
+
+class TestIntProcessStepUrlCache:
+    def etag_route(self, content, etag='"v1"'):
+        # Respond with 304 when the client has the current version
+        def route(handler, body):
+            if handler.headers.get("If-None-Match") == etag:
+                return 304, {"ETag": etag, "X-Checked": "yes"}, b""
+
+            return 200, {"ETag": etag, "Content-Type": "text/plain"}, content
+
+        return route
+
+    def test_cache1(self, http_server, tmp_path):
+        # Unmodified responses are served from the cache
+        http_server.routes["/meta"] = self.etag_route("metadata")
+        run_options = {"http_cache_dir": str(tmp_path)}
+        step = {
+            "url": f"{http_server.url}/meta",
+            "method": "get",
+            "cache": True,
+            "store": "response",
+        }
+
+        results = []
+        for _ in range(2):
+            action_state = bdast_v2.ActionState("test", "", run_options=run_options)
+            bdast_v2.process_step_url(action_state, step.copy())
+            results.append(action_state._vars["response"])
+            action_state.close()
+
+        assert results[0]["cached"] is False
+        assert results[1]["cached"] is True
+        assert results[1]["text"] == "metadata"
+        assert results[1]["status_code"] == 200
+        assert results[1]["headers"]["content-type"] == "text/plain"
+        assert results[1]["headers"]["X-Checked"] == "yes"
+
+        assert "If-None-Match" not in http_server.requests[0]["headers"]
+        assert http_server.requests[1]["headers"]["If-None-Match"] == '"v1"'
+
+    def test_cache2(self, http_server, tmp_path):
+        # Modified responses replace the cached response
+        http_server.routes["/meta"] = self.etag_route("first", '"v1"')
+        run_options = {"http_cache_dir": str(tmp_path)}
+        step = {
+            "url": f"{http_server.url}/meta",
+            "method": "get",
+            "cache": True,
+            "store": "response",
+        }
+
+        action_state = bdast_v2.ActionState("test", "", run_options=run_options)
+        bdast_v2.process_step_url(action_state, step.copy())
+
+        http_server.routes["/meta"] = self.etag_route("second", '"v2"')
+        bdast_v2.process_step_url(action_state, step.copy())
+        assert action_state._vars["response"]["text"] == "second"
+        assert action_state._vars["response"]["cached"] is False
+
+        bdast_v2.process_step_url(action_state, step.copy())
+        assert action_state._vars["response"]["text"] == "second"
+        assert action_state._vars["response"]["cached"] is True
+
+        action_state.close()
+
+    def test_cache3(self, http_server, tmp_path):
+        # Cache entries are selected by the chosen headers and Last-Modified is used
+        # when there is no ETag
+        modified = "Wed, 21 Oct 2015 07:28:00 GMT"
+
+        def route(handler, body):
+            if handler.headers.get("If-Modified-Since") == modified:
+                return 304, {}, b""
+
+            return 200, {"Last-Modified": modified}, handler.headers["Accept"]
+
+        http_server.routes["/meta"] = route
+        action_state = bdast_v2.ActionState(
+            "test", "", run_options={"http_cache_dir": str(tmp_path)}
+        )
+
+        texts = []
+        for accept in ("a", "b", "a"):
+            bdast_v2.process_step_url(
+                action_state,
+                {
+                    "url": f"{http_server.url}/meta",
+                    "method": "get",
+                    "headers": {"Accept": accept},
+                    "cache": True,
+                    "cache_headers": ["accept"],
+                    "store": "response",
+                },
+            )
+            texts.append(action_state._vars["response"]["text"])
+
+        assert texts == ["a", "b", "a"]
+        assert action_state._vars["response"]["cached"] is True
+
+        action_state.close()
+
+    def test_cache4(self, http_server, tmp_path):
+        # Responses without validators aren't cached
+        http_server.routes["/meta"] = (200, {}, "content")
+        action_state = bdast_v2.ActionState(
+            "test", "", run_options={"http_cache_dir": str(tmp_path)}
+        )
+
+        bdast_v2.process_step_url(
+            action_state,
+            {"url": f"{http_server.url}/meta", "method": "get", "cache": True},
+        )
+
+        assert list(tmp_path.iterdir()) == []
+        action_state.close()
+
+    def test_params1(self):
+        action_state = bdast_v2.ActionState("test", "")
+
+        # Only idempotent methods can be cached
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_url(
+                action_state, {"url": "http://127.0.0.1:1/", "cache": True}
+            )
+
+        # cache_headers requires cache
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_url(
+                action_state,
+                {
+                    "url": "http://127.0.0.1:1/",
+                    "method": "get",
+                    "cache_headers": ["accept"],
+                },
+            )
+
+
+class TestIntProcessStepUrlMulti:
+    def counting_route(self, counts):
+        # Record the most requests in progress at once
+        lock = threading.Lock()
+
+        def route(handler, body):
+            with lock:
+                counts["active"] += 1
+                counts["max"] = max(counts["max"], counts["active"])
+
+            time.sleep(0.2)
+
+            with lock:
+                counts["active"] -= 1
+
+            return 200, {}, handler.path
+
+        return route
+
+    def test_requests1(self, http_server):
+        # A list of requests is run concurrently, with results in request order
+        counts = {"active": 0, "max": 0}
+        http_server.routes["/notify"] = self.counting_route(counts)
+        action_state = bdast_v2.ActionState("test", "")
+
+        bdast_v2.process_step_url(
+            action_state,
+            {
+                "requests": [
+                    {"url": f"{http_server.url}/notify?n={x}", "method": "get"}
+                    for x in range(4)
+                ],
+                "store": "responses",
+            },
+        )
+
+        responses = action_state._vars["responses"]
+        assert [x["text"] for x in responses] == [f"/notify?n={x}" for x in range(4)]
+        assert counts["max"] == 4
+
+        action_state.close()
+
+    def test_requests2(self, http_server):
+        # A dict of requests stores results by name
+        http_server.routes["/a"] = (200, {}, "first")
+        http_server.routes["/b"] = (201, {}, "second")
+        action_state = bdast_v2.ActionState("test", "")
+
+        bdast_v2.process_step_url(
+            action_state,
+            {
+                "requests": {
+                    "a": {"url": f"{http_server.url}/a", "method": "get"},
+                    "b": {"url": f"{http_server.url}/b", "body": "data"},
+                },
+                "store": "responses",
+            },
+        )
+
+        responses = action_state._vars["responses"]
+        assert responses["a"]["text"] == "first"
+        assert responses["b"]["status_code"] == 201
+        assert sorted(x["body"] for x in http_server.requests) == [b"", b"data"]
+
+        action_state.close()
+
+    def test_items1(self, http_server):
+        # The request template is run for each item, limited by max_concurrency
+        counts = {"active": 0, "max": 0}
+        http_server.routes["/pkg"] = self.counting_route(counts)
+        action_state = bdast_v2.ActionState("test", "")
+        action_state.update_vars({"base": http_server.url})
+
+        bdast_v2.process_step_url(
+            action_state,
+            {
+                "request": {"url": "{{ base }}/pkg?name={{ item }}", "method": "get"},
+                "items": ["one", "two", "three", "four"],
+                "max_concurrency": 2,
+                "store": "responses",
+            },
+        )
+
+        responses = action_state._vars["responses"]
+        assert [x["text"] for x in responses] == [
+            f"/pkg?name={x}" for x in ("one", "two", "three", "four")
+        ]
+        assert counts["max"] == 2
+        assert "item" not in action_state._vars
+
+        action_state.close()
+
+    def test_items2(self, http_server):
+        # Concurrency defaults to the http pool size
+        counts = {"active": 0, "max": 0}
+        http_server.routes["/pkg"] = self.counting_route(counts)
+        action_state = bdast_v2.ActionState(
+            "test", "", run_options={"http_pool_size": 3}
+        )
+        action_state.update_vars({"base": http_server.url})
+
+        bdast_v2.process_step_url(
+            action_state,
+            {
+                "request": {"url": "{{ base }}/pkg?n={{ item }}", "method": "get"},
+                "items": list(range(6)),
+                "store": "responses",
+            },
+        )
+
+        assert len(action_state._vars["responses"]) == 6
+        assert counts["max"] == 3
+
+        action_state.close()
+
+    def test_failure1(self, http_server, capfd):
+        # All requests are run and failures reported before the step fails
+        http_server.routes["/ok"] = (200, {}, "ok")
+        http_server.routes["/bad"] = (500, {}, "bad")
+        action_state = bdast_v2.ActionState("test", "")
+
+        with pytest.raises(BdastRunException, match="1 of 3 url requests failed"):
+            bdast_v2.process_step_url(
+                action_state,
+                {
+                    "requests": {
+                        "first": {"url": f"{http_server.url}/ok", "method": "get"},
+                        "second": {"url": f"{http_server.url}/bad", "method": "get"},
+                        "third": {"url": f"{http_server.url}/ok", "method": "get"},
+                    },
+                },
+            )
+
+        assert len(http_server.requests) == 3
+        assert "Url request failed: second" in capfd.readouterr().out
+
+        action_state.close()
+
+    def test_params1(self, http_server):
+        http_server.routes["/ok"] = (200, {}, "ok")
+        action_state = bdast_v2.ActionState("test", "")
+
+        # requests can't be combined with a template
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_url(
+                action_state,
+                {"requests": [], "request": {"url": "http://127.0.0.1:1/"}},
+            )
+
+        # items requires request
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_url(action_state, {"items": [1]})
+
+        # Requests can't store their own result
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_url(
+                action_state,
+                {"requests": [{"url": "http://127.0.0.1:1/", "store": "x"}]},
+            )
+
+        # Unknown properties on a request fail the step
+        with pytest.raises(BdastRunException, match="1 of 1 url requests failed"):
+            bdast_v2.process_step_url(
+                action_state,
+                {"requests": [{"url": f"{http_server.url}/ok", "unknown": 1}]},
+            )
+
+
+class TestIntProcessStepUrlRetry:
+    def flaky_route(self, responses):
+        # Return each of the responses in turn, then the last one
+        def route(handler, body):
+            if len(responses) > 1:
+                return responses.pop(0)
+
+            return responses[0]
+
+        return route
+
+    def test_retry1(self, http_server, caplog):
+        # Retryable responses are retried with backoff
+        http_server.routes["/hook"] = self.flaky_route(
+            [(503, {}, "unavailable"), (502, {}, "bad gateway"), (200, {}, "ok")]
+        )
+        action_state = bdast_v2.ActionState("test", "")
+
+        start = time.monotonic()
+        with caplog.at_level(logging.INFO, logger="bdast.bdast_v2"):
+            bdast_v2.process_step_url(
+                action_state,
+                {
+                    "url": f"{http_server.url}/hook",
+                    "retries": 3,
+                    "backoff": 0.1,
+                    "store": "response",
+                },
+            )
+
+        assert time.monotonic() - start >= 0.3
+        assert action_state._vars["response"]["text"] == "ok"
+        assert len(http_server.requests) == 3
+        assert "Retry 1 of 3 in 0.10s" in caplog.text
+        assert "Retry 2 of 3 in 0.20s" in caplog.text
+
+        action_state.close()
+
+    def test_retry2(self, http_server):
+        # The step fails once retries run out
+        http_server.routes["/hook"] = (500, {}, "error")
+        action_state = bdast_v2.ActionState("test", "")
+
+        with pytest.raises(requests.exceptions.HTTPError):
+            bdast_v2.process_step_url(
+                action_state,
+                {"url": f"{http_server.url}/hook", "retries": 2, "backoff": 0},
+            )
+
+        assert len(http_server.requests) == 3
+
+        action_state.close()
+
+    def test_retry3(self, http_server, caplog):
+        # Retry-After takes precedence over backoff
+        http_server.routes["/hook"] = self.flaky_route(
+            [(429, {"Retry-After": "1"}, "slow down"), (200, {}, "ok")]
+        )
+        action_state = bdast_v2.ActionState("test", "")
+
+        start = time.monotonic()
+        with caplog.at_level(logging.INFO, logger="bdast.bdast_v2"):
+            bdast_v2.process_step_url(
+                action_state,
+                {"url": f"{http_server.url}/hook", "retries": 1, "backoff": 0},
+            )
+
+        assert time.monotonic() - start >= 1
+        assert "status code 429" in caplog.text
+
+        action_state.close()
+
+    def test_retry4(self, http_server):
+        # No retry is made when the delay would exceed the retry budget
+        http_server.routes["/hook"] = (503, {"Retry-After": "30"}, "unavailable")
+        action_state = bdast_v2.ActionState("test", "")
+
+        start = time.monotonic()
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_url(
+                action_state,
+                {
+                    "url": f"{http_server.url}/hook",
+                    "retries": 5,
+                    "retry_budget": 5,
+                    "status_check": 200,
+                },
+            )
+
+        assert time.monotonic() - start < 5
+        assert len(http_server.requests) == 1
+
+        action_state.close()
+
+    def test_retry5(self, http_server):
+        # Only the statuses in retry_on are retried, and statuses accepted by
+        # status_check are never retried
+        http_server.routes["/hook"] = (503, {}, "unavailable")
+        action_state = bdast_v2.ActionState("test", "")
+
+        with pytest.raises(requests.exceptions.HTTPError):
+            bdast_v2.process_step_url(
+                action_state,
+                {"url": f"{http_server.url}/hook", "retries": 2, "retry_on": [500]},
+            )
+
+        bdast_v2.process_step_url(
+            action_state,
+            {
+                "url": f"{http_server.url}/hook",
+                "retries": 2,
+                "status_check": [503],
+            },
+        )
+
+        assert len(http_server.requests) == 2
+
+        action_state.close()
+
+    def test_retry6(self):
+        # Connection errors are retried
+        action_state = bdast_v2.ActionState("test", "")
+
+        start = time.monotonic()
+        with pytest.raises(requests.exceptions.ConnectionError):
+            bdast_v2.process_step_url(
+                action_state,
+                {"url": "http://127.0.0.1:1/", "retries": 2, "backoff": 0.1},
+            )
+
+        assert time.monotonic() - start >= 0.3
+
+        action_state.close()
+
+    def test_retry7(self, monkeypatch):
+        # Read timeouts are only retried for idempotent methods, unless enabled
+        calls = []
+
+        def request(self, **args):
+            calls.append(args["method"])
+            raise requests.exceptions.ReadTimeout("read timed out")
+
+        monkeypatch.setattr(requests.Session, "request", request)
+        action_state = bdast_v2.ActionState("test", "")
+
+        for method, options, count in (
+            ("post", {}, 1),
+            ("patch", {}, 1),
+            ("put", {}, 3),
+            ("get", {}, 3),
+            ("post", {"retry_unsafe": True}, 3),
+        ):
+            calls.clear()
+            with pytest.raises(requests.exceptions.ReadTimeout):
+                bdast_v2.process_step_url(
+                    action_state,
+                    {
+                        "url": "http://127.0.0.1:1/",
+                        "method": method,
+                        "retries": 2,
+                        "backoff": 0,
+                        **options,
+                    },
+                )
+
+            assert len(calls) == count
+
+        action_state.close()
+
+    def test_retry_after1(self):
+        response = requests.Response()
+        assert bdast_v2.get_retry_after(response) is None
+
+        response.headers["Retry-After"] = "120"
+        assert bdast_v2.get_retry_after(response) == 120
+
+        response.headers["Retry-After"] = "Wed, 21 Oct 2015 07:28:00 GMT"
+        assert bdast_v2.get_retry_after(response) == 0
+
+        response.headers["Retry-After"] = "invalid"
+        assert bdast_v2.get_retry_after(response) is None
+
+
+class TestIntProcessStepUrlFormat:
+    def run_step(self, http_server, content, **options):
+        http_server.routes["/data"] = (200, {}, content)
+        action_state = bdast_v2.ActionState("test", "")
+
+        try:
+            bdast_v2.process_step_url(
+                action_state,
+                {
+                    "url": f"{http_server.url}/data",
+                    "method": "get",
+                    "store": "response",
+                    **options,
+                },
+            )
+        finally:
+            action_state.close()
+
+        return action_state._vars["response"]
+
+    def test_format1(self, http_server):
+        # The body is decoded in place of the text
+        content = json.dumps({"name": "bdast", "versions": [1, 2]})
+        response = self.run_step(http_server, content, format="json")
+
+        assert response["data"] == {"name": "bdast", "versions": [1, 2]}
+        assert "text" not in response
+
+        response = self.run_step(http_server, "name: bdast\n", format="yaml")
+        assert response["data"] == {"name": "bdast"}
+
+        response = self.run_step(http_server, "one\ntwo\n", format="lines")
+        assert response["data"] == ["one", "two"]
+
+    def test_format2(self, http_server):
+        # Large JSON arrays are decoded in full
+        items = [{"id": x, "name": f"item{x}", "tags": ["a", "b"]} for x in range(5000)]
+        response = self.run_step(http_server, json.dumps(items), format="json")
+
+        assert response["data"] == items
+
+    def test_select1(self, http_server):
+        items = [{"id": x, "name": f"item{x}"} for x in range(100)]
+
+        # Wildcards select a list of matches
+        response = self.run_step(
+            http_server, json.dumps(items), format="json", select="$[*].name"
+        )
+        assert response["data"] == [f"item{x}" for x in range(100)]
+
+        # Indexes select a single value
+        response = self.run_step(
+            http_server, json.dumps(items), format="json", select="$[5].id"
+        )
+        assert response["data"] == 5
+
+        response = self.run_step(
+            http_server, json.dumps(items), format="json", select="[-1]"
+        )
+        assert response["data"] == {"id": 99, "name": "item99"}
+
+    def test_select2(self, http_server):
+        content = json.dumps(
+            {"release": {"assets": [{"name": "a.tgz"}, {"name": "b.tgz"}]}}
+        )
+
+        response = self.run_step(
+            http_server, content, format="json", select="release.assets[*].name"
+        )
+        assert response["data"] == ["a.tgz", "b.tgz"]
+
+        response = self.run_step(
+            http_server, content, format="yaml", select="$['release']['assets'][1]"
+        )
+        assert response["data"] == {"name": "b.tgz"}
+
+        # Paths without a wildcard must match
+        with pytest.raises(BdastRunException):
+            self.run_step(http_server, content, format="json", select="$.missing")
+
+    def test_invalid1(self, http_server):
+        with pytest.raises(BdastRunException):
+            self.run_step(http_server, "[1, 2", format="json")
+
+        with pytest.raises(BdastRunException):
+            self.run_step(http_server, "{'a':", format="json")
+
+        with pytest.raises(BdastRunException):
+            self.run_step(http_server, "a: [", format="yaml")
+
+    def test_params1(self, http_server):
+        with pytest.raises(BdastRunException):
+            self.run_step(http_server, "", format="xml")
+
+        # select requires a decoded format
+        with pytest.raises(BdastRunException):
+            self.run_step(http_server, "", select="$.a")
+
+        with pytest.raises(BdastRunException):
+            self.run_step(http_server, "", format="json", select="$..a")
+
+    def test_iter_json_array1(self):
+        content = json.dumps([1, 2.5, -3e5, True, None, "é", {"a": [1]}]).encode()
+
+        # Elements split across chunks are decoded
+        for size in (1, 3, 8):
+            chunks = [content[x : x + size] for x in range(0, len(content), size)]
+            elements = list(bdast_v2.iter_json_array(chunks, "utf-8"))
+            assert elements == json.loads(content)
+
+        with pytest.raises(ValueError):
+            list(bdast_v2.iter_json_array([b"[1 2]"], "utf-8"))
+
+        with pytest.raises(ValueError):
+            list(bdast_v2.iter_json_array([b"[1]", b"2"], "utf-8"))
+
+    def test_iter_json_array2(self, monkeypatch):
+        # Elements are only decoded once the chunks containing them are complete
+        content = json.dumps(['a\\"]', {"b": ["x" * 1000, "]}"]}, 10]).encode()
+        chunks = [content[x : x + 7] for x in range(0, len(content), 7)]
+        expected = json.loads(content)
+
+        original = json.JSONDecoder.raw_decode
+        calls = []
+
+        def raw_decode(self, text, idx=0):
+            calls.append(idx)
+            return original(self, text, idx)
+
+        monkeypatch.setattr(json.JSONDecoder, "raw_decode", raw_decode)
+
+        elements = list(bdast_v2.iter_json_array(chunks, "utf-8"))
+        assert elements == expected
+        assert len(calls) == 3
+
+    def test_encoding1(self, http_server):
+        # JSON is decoded as UTF-8 unless a charset is given
+        content = json.dumps(["é"], ensure_ascii=False)
+
+        for body, content_type in (
+            (content, "text/plain"),
+            (content, "application/json"),
+            (content.encode("latin-1"), "text/plain; charset=ISO-8859-1"),
+        ):
+            http_server.routes["/data"] = (200, {"Content-Type": content_type}, body)
+            action_state = bdast_v2.ActionState("test", "")
+            bdast_v2.process_step_url(
+                action_state,
+                {
+                    "url": f"{http_server.url}/data",
+                    "method": "get",
+                    "format": "json",
+                    "select": "$[0]",
+                    "store": "response",
+                },
+            )
+            action_state.close()
+
+            assert action_state._vars["response"]["data"] == "é"
+
+
+class TestIntProcessStepUrlReplay:
+    def run_requests(self, run_options, base_url, paths):
+        action_state = bdast_v2.ActionState("test", "", run_options=run_options)
+
+        results = []
+        for path in paths:
+            bdast_v2.process_step_url(
+                action_state,
+                {
+                    "url": f"{base_url}{path}",
+                    "method": "get",
+                    "status_check": [200, 404],
+                    "store": "response",
+                },
+            )
+            results.append(action_state._vars["response"])
+
+        action_state.close()
+
+        return results
+
+    def test_replay1(self, http_server, tmp_path):
+        # Recorded responses are replayed without contacting the server
+        counter = iter(range(100))
+        http_server.routes["/counter"] = lambda handler, body: (
+            200,
+            {"X-Test": "1"},
+            str(next(counter)),
+        )
+        paths = ["/counter", "/counter", "/missing", "/counter"]
+
+        recorded = self.run_requests(
+            {"http_record": str(tmp_path)}, http_server.url, paths
+        )
+        assert [x["text"] for x in recorded] == ["0", "1", "not found", "2"]
+
+        request_count = len(http_server.requests)
+        replayed = self.run_requests(
+            {"http_replay": str(tmp_path)}, http_server.url, paths
+        )
+
+        assert len(http_server.requests) == request_count
+        assert [x["text"] for x in replayed] == ["0", "1", "not found", "2"]
+        assert [x["status_code"] for x in replayed] == [200, 200, 404, 200]
+        assert replayed[0]["headers"]["X-Test"] == "1"
+
+        # Requests made more often than recorded receive the last response
+        replayed = self.run_requests(
+            {"http_replay": str(tmp_path)}, http_server.url, ["/counter"] * 4
+        )
+        assert [x["text"] for x in replayed] == ["0", "1", "2", "2"]
+
+    def test_replay2(self, http_server, tmp_path):
+        # Streamed and decoded responses are recorded
+        http_server.routes["/data"] = (200, {}, json.dumps([1, 2, 3]))
+        step = {
+            "url": f"{http_server.url}/data",
+            "method": "get",
+            "format": "json",
+            "store": "response",
+        }
+
+        for run_options in (
+            {"http_record": str(tmp_path)},
+            {"http_replay": str(tmp_path)},
+        ):
+            action_state = bdast_v2.ActionState("test", "", run_options=run_options)
+            bdast_v2.process_step_url(action_state, step.copy())
+            assert action_state._vars["response"]["data"] == [1, 2, 3]
+            action_state.close()
+
+        assert len(http_server.requests) == 1
+
+    def test_replay3(self, tmp_path):
+        # Requests that weren't recorded fail
+        action_state = bdast_v2.ActionState(
+            "test", "", run_options={"http_replay": str(tmp_path)}
+        )
+
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_url(
+                action_state, {"url": "http://127.0.0.1:1/", "method": "get"}
+            )
+
+        action_state.close()
+
+    def test_params1(self, tmp_path):
+        with pytest.raises(BdastArgumentException):
+            bdast_v2.ActionState(
+                "test",
+                "",
+                run_options={
+                    "http_record": str(tmp_path),
+                    "http_replay": str(tmp_path),
+                },
+            )
@@ -0,0 +1,79 @@
+import pytest
+import bdast
+from bdast import bdast_v2
+from bdast.exception import BdastRunException
+from bdast.exception import BdastLoadException
+from bdast.exception import BdastArgumentException
+
+
+class TestIntProcessStepVars:
+    def test_set1(self):
+        action_state = bdast_v2.ActionState("test", "")
+
+        bdast_v2.process_step_vars(action_state, {"set": {"a": 1, "b": "text"}})
+
+        assert action_state._vars["a"] == 1
+        assert action_state._vars["b"] == "text"
+
+    def test_set2(self):
+        # Vars in a set can reference each other, in any order
+        action_state = bdast_v2.ActionState("test", "")
+
+        bdast_v2.process_step_vars(
+            action_state,
+            {
+                "set": {
+                    "full": "{{ name }}-{{ version }}",
+                    "version": "{{ major }}.{{ minor }}",
+                    "major": 1,
+                    "minor": 2,
+                    "name": "pkg",
+                }
+            },
+        )
+
+        assert action_state._vars["version"] == "1.2"
+        assert action_state._vars["full"] == "pkg-1.2"
+
+    def test_set3(self):
+        # A self reference refers to the existing value
+        action_state = bdast_v2.ActionState("test", "")
+        action_state.update_vars({"count": 1})
+
+        bdast_v2.process_step_vars(
+            action_state,
+            {"set": {"count": "{{ count + 1 }}", "other": "{{ count }}"}},
+        )
+
+        assert action_state._vars["count"] == "2"
+        assert action_state._vars["other"] == "2"
+
+    def test_set4(self):
+        # Circular references can't be resolved
+        action_state = bdast_v2.ActionState("test", "")
+
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_vars(
+                action_state, {"set": {"a": "{{ b }}", "b": "{{ a }}"}}
+            )
+
+    def test_set5(self):
+        # Nested values are resolved
+        action_state = bdast_v2.ActionState("test", "")
+
+        bdast_v2.process_step_vars(
+            action_state,
+            {"set": {"items": ["{{ first }}", {"key": "{{ first }}"}], "first": "a"}},
+        )
+
+        assert action_state._vars["items"] == ["a", {"key": "a"}]
+
+    def test_set6(self):
+        # Session is only rebuilt once for the whole set
+        action_state = bdast_v2.ActionState("test", "")
+        session = action_state.session
+
+        bdast_v2.process_step_vars(action_state, {"set": {"a": 1, "b": "{{ a }}"}})
+
+        assert action_state.session is not session
+        assert action_state.session.resolve("{{ b }}") == "1"
@@ -0,0 +1,180 @@
+import socket
+import threading
+import time
+import pytest
+import bdast
+from bdast import bdast_v2
+from bdast.exception import BdastRunException
+from bdast.exception import BdastLoadException
+from bdast.exception import BdastArgumentException
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class TestIntProcessStepWaitFor:
+    def test_file1(self, tmp_path):
+        # Wait for a file created later
+        path = tmp_path / "ready"
+        threading.Timer(0.3, path.touch).start()
+        action_state = bdast_v2.ActionState("test", "")
+
+        start = time.monotonic()
+        bdast_v2.process_step_wait_for(
+            action_state,
+            {"conditions": [{"file": str(path)}], "interval": 0.05, "timeout": 5},
+        )
+
+        assert 0.3 <= time.monotonic() - start < 2
+
+    def test_http1(self, http_server):
+        # Http conditions match the status and body
+        responses = [(503, {}, "starting"), (200, {}, "starting"), (200, {}, "ok")]
+        http_server.routes["/health"] = lambda handler, body: (
+            responses.pop(0) if len(responses) > 1 else responses[0]
+        )
+        action_state = bdast_v2.ActionState("test", "")
+
+        bdast_v2.process_step_wait_for(
+            action_state,
+            {
+                "conditions": [
+                    {"http": f"{http_server.url}/health", "status": 200, "body": "^ok$"}
+                ],
+                "interval": 0.05,
+            },
+        )
+
+        assert len(http_server.requests) == 3
+
+        action_state.close()
+
+    def test_all1(self, http_server, tmp_path):
+        # All conditions must be satisfied
+        http_server.routes["/health"] = (200, {}, "ok")
+        host, port = http_server.server_address
+        path = tmp_path / "ready"
+        threading.Timer(0.3, path.touch).start()
+        action_state = bdast_v2.ActionState("test", "")
+
+        bdast_v2.process_step_wait_for(
+            action_state,
+            {
+                "conditions": [
+                    {"http": f"{http_server.url}/health"},
+                    {"tcp": f"{host}:{port}"},
+                    {"file": str(path)},
+                ],
+                "interval": 0.05,
+                "store": "result",
+            },
+        )
+
+        assert path.exists()
+        assert action_state._vars["result"] == [True, True, True]
+
+        action_state.close()
+
+    def test_any1(self, tmp_path):
+        # A single satisfied condition is enough with mode any
+        path = tmp_path / "ready"
+        path.touch()
+        action_state = bdast_v2.ActionState("test", "")
+
+        start = time.monotonic()
+        bdast_v2.process_step_wait_for(
+            action_state,
+            {
+                "conditions": [
+                    {"tcp": f"127.0.0.1:{free_port()}"},
+                    {"file": str(path)},
+                ],
+                "mode": "any",
+                "store": "result",
+            },
+        )
+
+        assert time.monotonic() - start < 2
+        assert action_state._vars["result"] == [False, True]
+
+    def test_timeout1(self, tmp_path, capfd):
+        # Unsatisfied conditions fail the step once the timeout expires
+        path = tmp_path / "ready"
+        path.touch()
+        action_state = bdast_v2.ActionState("test", "")
+
+        start = time.monotonic()
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_wait_for(
+                action_state,
+                {
+                    "conditions": [
+                        {"file": str(tmp_path / "missing")},
+                        {"file": str(path)},
+                    ],
+                    "timeout": 0.5,
+                    "interval": 0.05,
+                },
+            )
+
+        assert 0.5 <= time.monotonic() - start < 2
+        output = capfd.readouterr().out
+        assert "not satisfied: file" in output
+        assert str(tmp_path / "missing") in output
+
+    def test_backoff1(self):
+        # Checks back off exponentially, with jitter, up to max_interval
+        calls = []
+        stop = threading.Event()
+
+        def check():
+            calls.append(time.monotonic())
+            return False
+
+        assert not bdast_v2.wait_condition(check, time.monotonic() + 1, 0.05, 0.2, stop)
+
+        delays = [y - x for x, y in zip(calls, calls[1:])]
+        assert 5 <= len(calls) <= 12
+        assert delays[0] >= 0.025
+        assert max(delays) <= 0.25
+
+    def test_params1(self, tmp_path):
+        action_state = bdast_v2.ActionState("test", "")
+
+        # Conditions require a single target
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_wait_for(
+                action_state, {"conditions": [{"file": "a", "tcp": "b:1"}]}
+            )
+
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_wait_for(action_state, {"conditions": []})
+
+        # status only applies to http conditions
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_wait_for(
+                action_state, {"conditions": [{"file": "a", "status": 200}]}
+            )
+
+        with pytest.raises(BdastRunException):
+            bdast_v2.process_step_wait_for(
+                action_state, {"conditions": [{"file": "a"}], "mode": "some"}
+            )
+
+
+class TestSpecStepWaitFor:
+    def test_spec1(self, tmp_path):
+        # wait_for is available as a step type
+        path = tmp_path / "ready"
+        path.touch()
+        action_state = bdast_v2.ActionState("test", "")
+
+        step = bdast_v2.BdastStep(
+            {"wait_for": {"conditions": [{"file": str(path)}]}},
+            action_state,
+            support_deps=False,
+        )
+        step.run()
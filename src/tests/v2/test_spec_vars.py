@@ -0,0 +1,71 @@
+import pytest
+import bdast
+from bdast import bdast_v2
+from bdast.exception import BdastRunException
+from bdast.exception import BdastLoadException
+from bdast.exception import BdastArgumentException
+
+
+class TestSpecVars:
+    def test_1(self):
+        # Vars can reference each other
+        spec = bdast_v2.BdastSpec(
+            {
+                "version": "2alpha",
+                "vars": {"a": "{{ b }}", "b": 1},
+                "actions": {"test": {"vars": {"c": "{{ a }}"}}},
+            }
+        )
+
+        spec.get_action("test").run("")
+
+    def test_2(self):
+        # Circular references are found on load
+        spec = bdast_v2.BdastSpec(
+            {
+                "version": "2alpha",
+                "vars": {"a": "{{ b }}", "b": "{{ a }}"},
+                "actions": {"test": {}},
+            }
+        )
+
+        with pytest.raises(BdastLoadException):
+            spec.get_action("test")
+
+    def test_3(self):
+        # Circular references through action vars
+        spec = bdast_v2.BdastSpec(
+            {
+                "version": "2alpha",
+                "vars": {"a": "{{ b }}"},
+                "actions": {"test": {"vars": {"b": "{{ a }}"}}},
+            }
+        )
+
+        with pytest.raises(BdastLoadException):
+            spec.get_action("test")
+
+    def test_4(self):
+        # References to vars that are not defined yet are left for run time
+        spec = bdast_v2.BdastSpec(
+            {
+                "version": "2alpha",
+                "vars": {"a": "{{ captured }}"},
+                "actions": {"test": {}},
+            }
+        )
+
+        spec.get_action("test")
+
+    def test_5(self):
+        # Invalid template syntax in a var is reported on load
+        spec = bdast_v2.BdastSpec(
+            {
+                "version": "2alpha",
+                "vars": {"a": 1, "broken": "{{ a "},
+                "actions": {"test": {}},
+            }
+        )
+
+        with pytest.raises(BdastLoadException, match="var broken"):
+            spec.get_action("test")